@@ -1,4 +1,35 @@
 """Work with ISA-Tab structured metadata: http://isatab.sourceforge.net
+The names below are imported from their modules when first used, so
+importing the package does not load the parser.
 """
-from bcbio.isatab.parser import parse
+import sys
 
+_lazy_names = {"parse": "parser", "update": "parser", "iter_assay_rows": "parser",
+               "iter_nodes": "parser", "ParseCache": "cache", "ParseStats": "stats",
+               "ProcessGraph": "graph", "load_table": "columnar", "RowIndex": "rowindex",
+               "AttributeIndex": "query", "NodeStorage": "store"}
+
+__all__ = sorted(_lazy_names)
+
+def __getattr__(name):
+    try:
+        module = _lazy_names[name]
+    except KeyError:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(__import__("bcbio.isatab." + module, fromlist=[name]), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_names))
+
+# module __getattr__ needs Python 3.7
+if sys.version_info < (3, 7):
+    from bcbio.isatab.parser import parse, update, iter_assay_rows, iter_nodes
+    from bcbio.isatab.cache import ParseCache
+    from bcbio.isatab.stats import ParseStats
+    from bcbio.isatab.graph import ProcessGraph
+    from bcbio.isatab.columnar import load_table
+    from bcbio.isatab.rowindex import RowIndex
+    from bcbio.isatab.query import AttributeIndex
+    from bcbio.isatab.store import NodeStorage
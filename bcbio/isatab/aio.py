@@ -0,0 +1,80 @@
+"""Parse ISA-Tab from asyncio code without blocking the event loop.
+parse_async returns the same ISATabRecord as bcbio.isatab.parse. File
+reading and tokenizing run in an executor, the default thread pool unless
+another concurrent.futures executor is given. Independent study and assay
+files are scanned concurrently, at most limit at a time. Cancelling the
+parse cancels files not yet started; files already being scanned finish in
+the executor and their results are dropped.
+Requires Python 3.7 or later.
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+from bcbio.isatab.parser import (StudyAssayParser, _find_investigation, _read_investigation,
+                                 _scan_table_file)
+from bcbio.isatab.stats import phase
+from bcbio.isatab.terms import TermTable
+
+
+async def parse_async(isatab_ref, limit=4, executor=None, cache=None, compact=False,
+                      stats=None, use_mmap=False, attribute_index=False, terms=False,
+                      storage=None):
+    """Entry point to parse an ISA-Tab directory or investigation file from a coroutine.
+    limit is the number of study and assay files scanned at once. With a
+    ProcessPoolExecutor, files are scanned in worker processes as with
+    parse(workers=...); other executors scan in threads. cache, compact,
+    stats, use_mmap, attribute_index, terms and storage work as for parse;
+    with a NodeStorage, each file is scanned in memory and its nodes stored
+    once it has been read.
+    """
+    loop = asyncio.get_running_loop()
+    isatab_ref, rec = await loop.run_in_executor(None, _load_investigation, isatab_ref,
+                                                 cache, stats)
+    s_parser = StudyAssayParser(isatab_ref, cache, compact, stats, use_mmap, attribute_index,
+                                storage)
+    semaphore = asyncio.Semaphore(limit)
+    in_process = isinstance(executor, ProcessPoolExecutor)
+
+    async def scan(fname, node_types):
+        async with semaphore:
+            if not in_process:
+                return await loop.run_in_executor(executor, s_parser._scan_cached_detached,
+                                                  fname, node_types)
+            result = await loop.run_in_executor(None, s_parser._cache_get, fname, node_types)
+            if result is None:
+                fingerprint = await loop.run_in_executor(None, s_parser._cache_fingerprint,
+                                                         fname)
+                result, file_stats = await loop.run_in_executor(
+                    executor, _scan_table_file, isatab_ref, fname, node_types, compact,
+                    stats is not None, use_mmap)
+                for info in file_stats:
+                    stats.add(info)
+                await loop.run_in_executor(None, s_parser._cache_put, fname, node_types, result,
+                                           fingerprint)
+            return result
+
+    with phase(stats, "tables"):
+        jobs = s_parser._table_jobs(rec)
+        tasks = [asyncio.ensure_future(scan(fname, node_types)) for _, fname, node_types in jobs]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        results = dict(zip([key for key, _, _ in jobs], results))
+        # attaching stores nodes and builds attribute indexes, so it stays
+        # off the event loop like the scans
+        rec = await loop.run_in_executor(None, s_parser._assemble, rec,
+                                         lambda key, fname, node_types, owner:
+                                         s_parser._attach(results[key], owner))
+    if terms:
+        with phase(stats, "terms"):
+            rec.terms = await loop.run_in_executor(None, TermTable.from_record, rec)
+    return rec
+
+def _load_investigation(isatab_ref, cache, stats):
+    with phase(stats, "discovery"):
+        isatab_ref = _find_investigation(isatab_ref)
+    with phase(stats, "investigation"):
+        return isatab_ref, _read_investigation(isatab_ref, cache, stats)
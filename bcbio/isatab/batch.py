@@ -0,0 +1,191 @@
+"""Parse every ISA-Tab investigation below a directory tree.
+find_investigations walks the tree once, picking out investigation files
+(i_*.txt, or *.idf.txt for MAGE-TAB) instead of searching each directory
+separately. parse_all parses them serially or across a pool of worker
+processes, keeping a bounded number of investigations in flight, and
+yields a BatchResult for each as soon as it completes. An investigation
+that fails to parse, or whose worker crashes or cannot pickle its result,
+gives a result with the error instead of stopping the batch. BatchSummary
+adds up counts, bytes and time for the run.
+The isatab-batch command line tool writes one JSON line per investigation
+to standard output, followed by a last line with the summary.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import fnmatch
+import argparse
+import traceback
+
+from bcbio.isatab.parser import parse
+from bcbio.isatab.stats import ParseStats, clock
+
+_investigation_patterns = ("i_*.txt", "*.idf.txt")
+
+
+def find_investigations(root):
+    """Iterate over investigation files below a directory, in a single walk.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            if any(fnmatch.fnmatch(fname, pat) for pat in _investigation_patterns):
+                yield os.path.join(dirpath, fname)
+
+def parse_all(refs, workers=None, max_pending=None, transform=None, **parse_kwargs):
+    """Parse many investigations, yielding a BatchResult for each as it completes.
+    refs is a directory to search with find_investigations, or a list of
+    investigation files or directories. With workers > 1 investigations
+    are parsed in a process pool, and at most max_pending (default twice
+    the workers) are queued or running at once, so memory stays bounded
+    however many investigations there are; results then come in order of
+    completion. Records are pickled back from the workers, so lazy records
+    need a transform: a picklable function applied to each record in the
+    worker, for instance to keep only the fields needed.
+    Other keyword arguments are passed to parse.
+    """
+    if isinstance(refs, (str, type(u""))):
+        refs = find_investigations(refs)
+    if workers is None or workers <= 1:
+        for ref in refs:
+            yield _parse_one(ref, transform, parse_kwargs)
+        return
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    if max_pending is None:
+        max_pending = 2 * workers
+    refs = iter(refs)
+    pending = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while 1:
+            for ref in refs:
+                try:
+                    pending[executor.submit(_parse_one, ref, transform, parse_kwargs)] = ref
+                except Exception:
+                    yield _failed_result(ref)
+                    continue
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                ref = pending.pop(future)
+                try:
+                    yield future.result()
+                except Exception:
+                    yield _failed_result(ref)
+
+def _parse_one(ref, transform, parse_kwargs):
+    """Parse one investigation, capturing any error in the result.
+    """
+    stats = ParseStats()
+    start = clock()
+    try:
+        rec = parse(ref, stats=stats, **parse_kwargs)
+        if transform is not None:
+            rec = transform(rec)
+        error = None
+    except Exception:
+        rec = None
+        error = traceback.format_exc()
+    nbytes = sum(info["bytes_read"] or 0 for info in stats.files)
+    return BatchResult(ref, rec, error, clock() - start, nbytes)
+
+def _failed_result(ref):
+    """Result for an investigation whose worker failed outside of parsing.
+    Covers a crashed (broken) pool and arguments or results that do not pickle.
+    """
+    return BatchResult(ref, None, traceback.format_exc(), 0.0, 0)
+
+
+class BatchResult:
+    """Outcome of parsing one investigation in a batch.
+      - ref -- investigation file or directory
+      - record -- parsed ISATabRecord (or transformed value), None on error
+      - error -- formatted traceback when parsing failed, None otherwise
+      - seconds, bytes -- parse time and bytes read from ISA-Tab files
+    """
+    def __init__(self, ref, record, error, seconds, nbytes):
+        self.ref = ref
+        self.record = record
+        self.error = error
+        self.seconds = seconds
+        self.bytes = nbytes
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def as_dict(self):
+        out = {"investigation": self.ref, "ok": self.ok, "seconds": self.seconds,
+               "bytes": self.bytes}
+        if self.error is not None:
+            out["error"] = self.error.strip().split("\n")[-1]
+        return out
+
+
+class BatchSummary:
+    """Aggregate counts and throughput of a batch run.
+    """
+    def __init__(self):
+        self.parsed = 0
+        self.failed = 0
+        self.bytes = 0
+        self.parse_seconds = 0.0
+        self._start = clock()
+
+    def add(self, result):
+        if result.ok:
+            self.parsed += 1
+        else:
+            self.failed += 1
+        self.bytes += result.bytes
+        self.parse_seconds += result.seconds
+        return result
+
+    def as_dict(self):
+        elapsed = clock() - self._start
+        total = self.parsed + self.failed
+        return {"investigations": total, "parsed": self.parsed, "failed": self.failed,
+                "bytes": self.bytes, "seconds": elapsed, "parse_seconds": self.parse_seconds,
+                "investigations_per_second": total / elapsed if elapsed else None,
+                "megabytes_per_second": self.bytes / 1e6 / elapsed if elapsed else None}
+
+
+def main(args=None):
+    """Command line entry point: parse all investigations below a directory.
+    """
+    arg_parser = argparse.ArgumentParser(
+        description="Parse all ISA-Tab investigations below a directory.")
+    arg_parser.add_argument("root", help="Directory tree to search for investigations")
+    arg_parser.add_argument("-w", "--workers", type=int, default=1,
+                            help="Number of worker processes")
+    arg_parser.add_argument("--max-pending", type=int, default=None,
+                            help="Investigations queued or running at once (default 2 * workers)")
+    arg_parser.add_argument("--lazy", action="store_true",
+                            help="Only read investigation files")
+    args = arg_parser.parse_args(args)
+    summary = BatchSummary()
+    for result in parse_all(args.root, args.workers, args.max_pending, record_counts,
+                            lazy=args.lazy):
+        summary.add(result)
+        out = result.as_dict()
+        if result.ok:
+            out.update(result.record)
+        print(json.dumps(out))
+        sys.stdout.flush()
+    print(json.dumps(summary.as_dict()))
+    return 1 if summary.failed else 0
+
+def record_counts(rec):
+    """Summarize a record as counts of studies and assays.
+    Used as a transform, so workers only send back the counts.
+    """
+    return {"studies": len(rec.studies),
+            "assays": sum(len(s.assays) for s in rec.studies)}
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""Persistent on-disk cache of parsed ISA-Tab files.
+Parsing an unchanged ISA-Tab directory again gives the same records, so
+the parse function can store the result for each investigation, study and
+assay file in a ParseCache and load it back on later runs.
+Each file is cached on its own, keyed by its path, and only reused while
+its size, modification time and content hash are unchanged; changing one
+assay file only re-parses that assay. Entries are pickled and compressed,
+and the least recently used entries are evicted once the cache grows past
+its size limit.
+"""
+import os
+import zlib
+import pickle
+import hashlib
+import tempfile
+
+# bump when the layout of cached records changes
+CACHE_VERSION = 5
+
+_entry_ext = ".isacache"
+
+
+def file_fingerprint(path, content_hash=True):
+    """Identify the current state of a file by size, modification time and hash.
+    """
+    st = os.stat(path)
+    digest = _file_digest(path) if content_hash else None
+    return (st.st_size, st.st_mtime, digest)
+
+def _file_digest(path):
+    sha = hashlib.sha1()
+    with open(path, "rb") as in_handle:
+        while 1:
+            chunk = in_handle.read(1024 * 1024)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ParseCache:
+    """Store parsed ISA-Tab records in a directory, bounded by a total size.
+      - hits, misses, evictions -- counters since the cache was opened
+    """
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, path, kind):
+        """Retrieve the cached value for a file, or None if missing or out of date.
+        kind distinguishes different values cached for the same file.
+        """
+        entry = self._entry_file(path, kind)
+        try:
+            st = os.stat(path)
+            with open(entry, "rb") as in_handle:
+                version, size, mtime, digest = pickle.load(in_handle)
+                if version == CACHE_VERSION and (size, mtime) == (st.st_size, st.st_mtime) \
+                   and digest == _file_digest(path):
+                    value = pickle.loads(zlib.decompress(in_handle.read()))
+                else:
+                    value = None
+        except (IOError, OSError, EOFError, pickle.UnpicklingError, zlib.error):
+            value = None
+        if value is None:
+            self.misses += 1
+            self._remove(entry)
+        else:
+            self.hits += 1
+            os.utime(entry, None)
+        return value
+
+    def fingerprint(self, path):
+        """Identify the state of a file before reading it, for put; None if missing.
+        """
+        try:
+            return file_fingerprint(path)
+        except (IOError, OSError):
+            return None
+
+    def put(self, path, kind, value, fingerprint=None):
+        """Store the value parsed from a file, evicting old entries when over size.
+        fingerprint should be taken with fingerprint() before the file is
+        read, so a file changed while it was parsed is not stored as up to
+        date; by default the file is fingerprinted now.
+        """
+        if fingerprint is None:
+            fingerprint = self.fingerprint(path)
+            if fingerprint is None:
+                return
+        size, mtime, digest = fingerprint
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as out_handle:
+            pickle.dump((CACHE_VERSION, size, mtime, digest), out_handle,
+                        pickle.HIGHEST_PROTOCOL)
+            out_handle.write(zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+        entry = self._entry_file(path, kind)
+        getattr(os, "replace", os.rename)(tmp_file, entry)
+        self._evict()
+
+    def invalidate(self, path, kind=None):
+        """Remove cached values for a file; all known kinds if kind is None.
+        """
+        if kind is not None:
+            self._remove(self._entry_file(path, kind))
+        else:
+            prefix = self._path_key(path)
+            for fname in os.listdir(self.cache_dir):
+                if fname.startswith(prefix):
+                    self._remove(os.path.join(self.cache_dir, fname))
+
+    def clear(self):
+        """Remove every cached entry.
+        """
+        for entry, _, _ in self._entries():
+            self._remove(entry)
+
+    def stats(self):
+        """Summarize cache usage as a dictionary.
+        """
+        entries = self._entries()
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "entries": len(entries),
+                "bytes": sum(size for _, size, _ in entries),
+                "max_bytes": self.max_bytes}
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes.
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for entry, size, _ in sorted(entries, key=lambda x: x[2]):
+            if total <= self.max_bytes:
+                break
+            self._remove(entry)
+            self.evictions += 1
+            total -= size
+
+    def _entries(self):
+        out = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith(_entry_ext):
+                entry = os.path.join(self.cache_dir, fname)
+                try:
+                    st = os.stat(entry)
+                except OSError:
+                    continue
+                out.append((entry, st.st_size, st.st_mtime))
+        return out
+
+    def _path_key(self, path):
+        return hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+
+    def _entry_file(self, path, kind):
+        kind_key = hashlib.sha1(repr(kind).encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.cache_dir, "%s-%s%s" % (self._path_key(path), kind_key,
+                                                        _entry_ext))
+
+    def _remove(self, entry):
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
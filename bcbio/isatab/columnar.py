@@ -0,0 +1,259 @@
+"""Load ISA-Tab study and assay files into column arrays.
+The record objects from the parser are organized around nodes; for
+analysis across a whole assay it is often easier to work with the table
+directly, one array per column. load_table reads an s_ or a_ file once,
+interpreting the header like StudyAssayParser (including synonyms such as
+Array Data File for Raw Data File), and returns a ColumnTable.
+Node name columns are kept as lists of strings. All other columns
+(Protocol REF, Characteristics, Term Source REF, Unit...) are dictionary
+encoded: a list of distinct values plus an integer code per row, so
+filtering compares integers and repeated values are stored once.
+Codes are single bytes while a column has at most 256 distinct values,
+which covers nearly all ISA-Tab columns. Filters compare the code array
+with NumPy when it is installed; otherwise single byte codes are marked
+with bytes.translate and wider codes with a set lookup mapped over the
+array, and matching rows are picked with itertools.compress, so no
+Python code runs per row either way.
+NumPy, pandas and pyarrow are not required, but tables convert to them
+when they are installed.
+"""
+import os
+import array
+import itertools
+
+from bcbio.isatab.parser import StudyAssayParser
+
+
+def load_table(fname):
+    """Read a study or assay file into a ColumnTable.
+    """
+    s_parser = StudyAssayParser(fname)
+    in_handle, plan, reader = s_parser._read_table(os.path.basename(fname))
+    with in_handle:
+        node_cols = set(plan.hgroups[i][0] for i, htype in enumerate(plan.htypes)
+                        if htype in ("node", "node_assay"))
+        columns = [Column() if i in node_cols else DictColumn()
+                   for i in range(len(plan.header))]
+        ncols = len(columns)
+        for line in reader:
+            if not line:
+                continue
+            if len(line) < ncols:
+                line = line + [""] * (ncols - len(line))
+            for col, val in zip(columns, line):
+                col.append(val)
+    return ColumnTable(plan.header, columns, plan.hgroups, plan.htypes)
+
+
+class Column:
+    """Plain column of string values.
+    """
+    def __init__(self, values=None):
+        self.values = values if values is not None else []
+
+    def append(self, val):
+        self.values.append(val)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    def to_list(self):
+        return list(self.values)
+
+    def where(self, val):
+        """Retrieve the rows holding a value.
+        """
+        return [i for i, x in enumerate(self.values) if x == val]
+
+    def isin(self, vals):
+        """Retrieve the rows holding any of a set of values.
+        """
+        vals = set(vals)
+        return [i for i, x in enumerate(self.values) if x in vals]
+
+    def take(self, rows):
+        return Column([self.values[i] for i in rows])
+
+
+# distinct values a column can hold with single byte codes
+_byte_codes = 256
+
+class DictColumn:
+    """Dictionary encoded column of string values.
+      - categories -- distinct values in order of first appearance
+      - codes -- integer array with the category of each row; unsigned
+        bytes up to 256 categories, wider integers beyond
+    """
+    def __init__(self, categories=None, codes=None):
+        self.categories = categories if categories is not None else []
+        if codes is None:
+            codes = array.array("B" if len(self.categories) <= _byte_codes else "i")
+        self.codes = codes
+        self._lookup = dict((x, i) for i, x in enumerate(self.categories))
+
+    def append(self, val):
+        try:
+            code = self._lookup[val]
+        except KeyError:
+            code = len(self.categories)
+            self._lookup[val] = code
+            self.categories.append(val)
+            if code == _byte_codes and self.codes.typecode == "B":
+                self.codes = array.array("i", self.codes)
+        self.codes.append(code)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.categories[self.codes[i]]
+
+    def to_list(self):
+        return [self.categories[c] for c in self.codes]
+
+    def code(self, val):
+        """Retrieve the integer code of a value, or None if it does not occur.
+        """
+        return self._lookup.get(val)
+
+    def where(self, val):
+        """Retrieve the rows holding a value, comparing integer codes.
+        """
+        code = self._lookup.get(val)
+        if code is None:
+            return []
+        return self._rows_with(set([code]))
+
+    def isin(self, vals):
+        """Retrieve the rows holding any of a set of values.
+        """
+        codes = set(self._lookup[x] for x in vals if x in self._lookup)
+        if not codes:
+            return []
+        return self._rows_with(codes)
+
+    def take(self, rows):
+        return DictColumn(list(self.categories),
+                          array.array(self.codes.typecode, [self.codes[i] for i in rows]))
+
+    def _rows_with(self, codes):
+        """Retrieve the rows whose code is in a set, with numpy when it is installed.
+        """
+        numpy = _numpy()
+        if numpy is not None:
+            found = numpy.isin(numpy.frombuffer(self.codes, dtype=self.codes.typecode),
+                               sorted(codes))
+            return numpy.flatnonzero(found).tolist()
+        if self.codes.typecode == "B":
+            table = bytearray(_byte_codes)
+            for code in codes:
+                table[code] = 1
+            found = bytearray(self.codes).translate(table)
+        else:
+            found = map(codes.__contains__, self.codes)
+        return list(itertools.compress(range(len(self.codes)), found))
+
+
+_numpy_module = []
+
+def _numpy():
+    """Retrieve numpy if installed, importing it on first use; None otherwise.
+    """
+    if not _numpy_module:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_module.append(numpy)
+    return _numpy_module[0]
+
+
+class ColumnTable:
+    """Columns of a study or assay file.
+      - names -- header names after synonym replacement; may repeat
+      - columns -- Column or DictColumn for each name
+      - hgroups, htypes -- header groups and their types, as in StudyAssayParser
+    """
+    def __init__(self, names, columns, hgroups=None, htypes=None):
+        self.names = list(names)
+        self.columns = columns
+        self.hgroups = hgroups
+        self.htypes = htypes
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def column(self, name, occurrence=0):
+        """Retrieve a column by name; occurrence selects among repeated names.
+        """
+        indexes = [i for i, x in enumerate(self.names) if x == name]
+        try:
+            return self.columns[indexes[occurrence]]
+        except IndexError:
+            raise KeyError(name)
+
+    def where(self, name, val, occurrence=0):
+        """Retrieve the rows where a column holds a value.
+        """
+        return self.column(name, occurrence).where(val)
+
+    def take(self, rows):
+        """Retrieve a new table with a subset of rows.
+        """
+        return ColumnTable(self.names, [c.take(rows) for c in self.columns],
+                           self.hgroups, self.htypes)
+
+    def row(self, i):
+        """Retrieve the values of a single row as a list.
+        """
+        return [c[i] for c in self.columns]
+
+    def to_numpy(self):
+        """Retrieve numpy arrays per column: codes for encoded columns, objects otherwise.
+        """
+        import numpy
+        out = []
+        for col in self.columns:
+            if isinstance(col, DictColumn):
+                out.append(numpy.frombuffer(col.codes, dtype=col.codes.typecode)
+                           if len(col.codes) else numpy.zeros(0, dtype=col.codes.typecode))
+            else:
+                out.append(numpy.array(col.values, dtype=object))
+        return out
+
+    def to_pandas(self):
+        """Retrieve a pandas DataFrame, with categorical encoded columns.
+        """
+        import pandas
+        data = []
+        for col in self.columns:
+            if isinstance(col, DictColumn):
+                data.append(pandas.Categorical.from_codes(list(col.codes), col.categories))
+            else:
+                data.append(col.values)
+        df = pandas.concat([pandas.Series(x) for x in data], axis=1, ignore_index=True)
+        df.columns = self.names
+        return df
+
+    def to_arrow(self):
+        """Retrieve a pyarrow Table, with dictionary arrays for encoded columns.
+        """
+        import pyarrow
+        arrays = []
+        for col in self.columns:
+            if isinstance(col, DictColumn):
+                arrays.append(pyarrow.DictionaryArray.from_arrays(
+                    pyarrow.array(col.codes, type=pyarrow.int32()),
+                    pyarrow.array(col.categories, type=pyarrow.string())))
+            else:
+                arrays.append(pyarrow.array(col.values, type=pyarrow.string()))
+        return pyarrow.Table.from_arrays(arrays, names=self.names)
@@ -0,0 +1,104 @@
+"""Query provenance of nodes through the process nodes of ISA-Tab records.
+Process nodes link input nodes to output nodes (for instance sources to
+samples in a Study file, samples to extracts in an Assay file), and are
+stored per study and assay as ProcessNodeRecord objects with input and
+output lists. ProcessGraph indexes these links in both directions so
+provenance questions like the sources a data file was derived from, or
+the data files produced from a sample, are answered by walking the
+indexes instead of scanning every process node.
+Node indexes are the keys used in the nodes dictionaries of study and
+assay records (source-..., sample-..., rawdatafile-...).
+"""
+import collections
+
+
+class ProcessGraph:
+    """Indexed graph of process nodes from one or more studies and assays.
+      - inputs, outputs -- ProcessNodeRecord -> set of node indexes
+      - producers -- node index -> set of processes with the node as output
+      - consumers -- node index -> set of processes with the node as input
+    """
+    def __init__(self, process_nodes=None):
+        self.inputs = {}
+        self.outputs = {}
+        self.producers = collections.defaultdict(set)
+        self.consumers = collections.defaultdict(set)
+        if process_nodes:
+            self.add(process_nodes)
+
+    @classmethod
+    def from_study(cls, study):
+        """Build the graph of a study together with all of its assays.
+        """
+        graph = cls(study.process_nodes)
+        for assay in study.assays:
+            graph.add(assay.process_nodes)
+        return graph
+
+    @classmethod
+    def from_record(cls, rec):
+        """Build the graph of every study and assay in an ISATabRecord.
+        """
+        graph = cls()
+        for study in rec.studies:
+            graph.add(study.process_nodes)
+            for assay in study.assays:
+                graph.add(assay.process_nodes)
+        return graph
+
+    def add(self, process_nodes):
+        """Index a dictionary of process nodes, as stored on study and assay records.
+        """
+        for process_node in process_nodes.values():
+            self.inputs[process_node] = set(process_node.inputs)
+            self.outputs[process_node] = set(process_node.outputs)
+            for node_index in process_node.inputs:
+                self.consumers[node_index].add(process_node)
+            for node_index in process_node.outputs:
+                self.producers[node_index].add(process_node)
+        return self
+
+    def __contains__(self, node_index):
+        return node_index in self.producers or node_index in self.consumers
+
+    def parents(self, node_index):
+        """Retrieve the nodes a node was directly produced from.
+        """
+        return set(x for p in self.producers.get(node_index, ()) for x in self.inputs[p])
+
+    def children(self, node_index):
+        """Retrieve the nodes directly produced from a node.
+        """
+        return set(x for p in self.consumers.get(node_index, ()) for x in self.outputs[p])
+
+    def upstream(self, node_index):
+        """Retrieve all nodes a node was derived from, following processes back.
+        """
+        return self._walk(node_index, self.parents)
+
+    def downstream(self, node_index):
+        """Retrieve all nodes derived from a node, following processes forward.
+        """
+        return self._walk(node_index, self.children)
+
+    def sources(self, node_index):
+        """Retrieve the origins of a node: upstream nodes not produced by any process.
+        """
+        return set(x for x in self.upstream(node_index) if not self.producers.get(x))
+
+    def data_files(self, node_index):
+        """Retrieve raw and derived data files downstream of a node.
+        """
+        return set(x for x in self.downstream(node_index)
+                   if x and x.startswith(("rawdatafile-", "deriveddatafile-")))
+
+    def _walk(self, node_index, neighbors):
+        seen = set()
+        queue = collections.deque([node_index])
+        while queue:
+            for x in neighbors(queue.popleft()):
+                if x not in seen:
+                    seen.add(x)
+                    queue.append(x)
+        seen.discard(node_index)
+        return seen
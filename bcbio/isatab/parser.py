@@ -24,27 +24,29 @@ collapsing the data across the samples and raw data.
 """
 from __future__ import with_statement
 
+import gc
+import io
 import os
 import re
 import csv
+import mmap
 import glob
 import collections
-import pprint
+import operator
 import bisect
-import codecs
+import weakref
 
+from bcbio.isatab.stats import ParseStats, TimedCall, clock, phase
+from bcbio.isatab.query import AttributeIndex
+from bcbio.isatab.terms import TermTable
 
-def unicode_csv_reader(unicode_csv_data, dialect=csv.excel, **kwargs):
-    # csv.py doesn't do Unicode; encode temporarily as UTF-8:
-    csv_reader = csv.reader(utf_8_encoder(unicode_csv_data),
-                            dialect=dialect, **kwargs)
-    for row in csv_reader:
-        # decode UTF-8 back to Unicode, cell by cell:
-        yield [unicode(cell, 'utf-8') for cell in row]
 
-def utf_8_encoder(unicode_csv_data):
-    for line in unicode_csv_data:
-        yield line.encode('utf-8')
+def _investigation_rows(text):
+    """Split the text of an investigation file into rows of cells.
+    """
+    if isinstance(text, bytes):
+        text = text.decode("utf-8", "replace")
+    return csv.reader(io.StringIO(text, newline=""), dialect="excel-tab")
 
 def find_lt(a, x):
     """Find rightmost value less than x"""
@@ -61,11 +63,103 @@ def find_gt(a, x):
         return a[i]
     raise ValueError
 
-def parse(isatab_ref):
+_attr_name_pat = re.compile(r"[\W]+")
+_attrs_record_types = {}
+
+def attrs_record_type(names):
+    """Retrieve the shared Attrs named tuple type for a set of attribute names.
+    Types are created once per distinct set of names and reused by every
+    row; instances pickle by their field names, so no module level class
+    is needed to load them back.
+    """
+    names = tuple(names)
+    try:
+        return _attrs_record_types[names]
+    except KeyError:
+        base = collections.namedtuple("Attrs", names)
+        attrs_type = type("Attrs", (base,), {"__slots__": (),
+                                             "__reduce__": _reduce_attrs})
+        _attrs_record_types[names] = attrs_type
+        return attrs_type
+
+def _reduce_attrs(attrs):
+    return (_load_attrs, (attrs._fields, tuple(attrs)))
+
+def _load_attrs(names, vals):
+    return attrs_record_type(names)(*vals)
+
+# below this combined size of study and assay files, a process pool costs
+# more to start than it saves, so parsing stays serial
+PARALLEL_MIN_BYTES = 8 * 1024 * 1024
+
+def parse(isatab_ref, workers=None, executor=None, min_parallel_bytes=None,
+          lazy=False, cache=None, compact=False, stats=None, use_mmap=False,
+          attribute_index=False, terms=False, storage=None, pause_gc=True):
     """Entry point to parse an ISA-Tab directory.
     isatab_ref can point to a directory of ISA-Tab data, in which case we
     search for the investigator file, or be a reference to the high level
     investigation file.
+    Study and assay files can be parsed concurrently by passing a number of
+    worker processes or a concurrent.futures executor; see
+    StudyAssayParser.parse.
+    With lazy=True only the investigation file is read, and study and assay
+    files are parsed when their nodes are first accessed; see
+    StudyAssayParser.parse_lazy.
+    A bcbio.isatab.cache.ParseCache reuses results stored by previous parses
+    for every file that has not changed since.
+    compact=True builds CompactNodeRecord and CompactProcessNodeRecord
+    objects, and shares repeated names and attribute values between nodes,
+    to reduce memory use on large studies.
+    A bcbio.isatab.stats.ParseStats object passed as stats records the time
+    spent in each phase and statistics for every file read.
+    use_mmap=True reads study and assay files through memory maps; see
+    MappedTableReader. It is not faster on typical files.
+    attribute_index=True gives every study and assay an attribute_index
+    for selecting nodes by metadata values; see bcbio.isatab.query.
+    terms=True collects ontology terms into rec.terms and replaces term
+    attributes in node metadata by integer term ids; see
+    bcbio.isatab.terms. It requires all files to be read, so not lazy.
+    A bcbio.isatab.store.NodeStorage passed as storage keeps nodes and
+    process nodes in its database, holding only recently used nodes in
+    memory; see StudyAssayParser.
+    Cyclic garbage collection is switched off while parsing, as the many
+    small records built otherwise trigger repeated full collections, and
+    switched back on afterwards if it was on before. This affects the whole
+    process, so pass pause_gc=False when another thread turns collection on
+    or off meanwhile.
+    """
+    if lazy and terms:
+        raise ValueError("Term tables need study and assay files parsed up front, not lazily")
+    if not pause_gc or not gc.isenabled():
+        return _parse(isatab_ref, workers, executor, min_parallel_bytes, lazy, cache, compact,
+                      stats, use_mmap, attribute_index, terms, storage)
+    gc.disable()
+    try:
+        return _parse(isatab_ref, workers, executor, min_parallel_bytes, lazy, cache, compact,
+                      stats, use_mmap, attribute_index, terms, storage)
+    finally:
+        gc.enable()
+
+def _parse(isatab_ref, workers, executor, min_parallel_bytes, lazy, cache, compact, stats,
+           use_mmap, attribute_index, terms, storage):
+    with phase(stats, "discovery"):
+        isatab_ref = _find_investigation(isatab_ref)
+    with phase(stats, "investigation"):
+        rec = _read_investigation(isatab_ref, cache, stats)
+    s_parser = StudyAssayParser(isatab_ref, cache, compact, stats, use_mmap, attribute_index,
+                                storage)
+    with phase(stats, "tables"):
+        if lazy:
+            rec = s_parser.parse_lazy(rec)
+        else:
+            rec = s_parser.parse(rec, workers, executor, min_parallel_bytes)
+    if terms:
+        with phase(stats, "terms"):
+            rec.terms = TermTable.from_record(rec)
+    return rec
+
+def _find_investigation(isatab_ref):
+    """Retrieve the investigation file of an ISA-Tab directory or file reference.
     """
     if os.path.isdir(isatab_ref):
         fnames = glob.glob(os.path.join(isatab_ref, "i_*.txt")) + \
@@ -73,11 +167,100 @@ def parse(isatab_ref):
         assert len(fnames) == 1
         isatab_ref = fnames[0]
     assert os.path.exists(isatab_ref), "Did not find investigation file: %s" % isatab_ref
-    i_parser = InvestigationParser()
-    with codecs.open(isatab_ref, "rU",encoding='utf-8') as in_handle:
-        rec = i_parser.parse(in_handle)
-    s_parser = StudyAssayParser(isatab_ref)
-    rec = s_parser.parse(rec)
+    return isatab_ref
+
+def _read_investigation(isatab_ref, cache=None, stats=None):
+    """Parse an investigation file, reusing and updating the parse cache.
+    """
+    start = clock()
+    rec = cache.get(isatab_ref, "investigation") if cache is not None else None
+    cached = rec is not None
+    if rec is None:
+        fingerprint = cache.fingerprint(isatab_ref) if cache is not None else None
+        i_parser = InvestigationParser()
+        with io.open(isatab_ref, encoding="utf-8", errors="replace", newline="") as in_handle:
+            rec = i_parser.parse(in_handle)
+        if cache is not None:
+            cache.put(isatab_ref, "investigation", rec, fingerprint)
+    if stats is not None:
+        stats.add_file(isatab_ref, "investigation", clock() - start, cached=cached)
+    return rec
+
+def iter_assay_rows(fname):
+    """Iterate over the rows of a study or assay file with constant memory.
+    Rows are dictionaries mapping header keys to lists of values, interpreted
+    as in StudyAssayParser: node columns give names, while attribute and
+    Protocol REF columns give Attrs tuples with their qualifiers.
+    """
+    s_parser = StudyAssayParser(fname)
+    in_handle, plan, reader = s_parser._read_table(os.path.basename(fname))
+    with in_handle:
+        for line in reader:
+            if line:
+                yield plan.row(line)
+
+def iter_nodes(fname, node_types=None, unique=True):
+    """Iterate over (node index, NodeRecord) pairs of a study or assay file.
+    Nodes are yielded in row order as soon as they are first seen, with the
+    same metadata StudyAssayParser would give them. node_types defaults to
+    the study node types for s_ files and the assay node types otherwise.
+    Only the indexes of seen nodes are kept in memory; with unique=False
+    even those are dropped and a node is yielded for every row naming it.
+    """
+    s_parser = StudyAssayParser(fname)
+    if node_types is None:
+        if os.path.basename(fname).startswith("s_"):
+            node_types = s_parser._study_node_types
+        else:
+            node_types = s_parser._assay_node_types
+    seen = set()
+    in_handle, plan, reader = s_parser._read_table(os.path.basename(fname))
+    with in_handle:
+        scanners = s_parser._node_scanners(plan, node_types)
+        for line in reader:
+            if not line:
+                continue
+            keyvals = None
+            for node_type, name_index, _ in scanners:
+                name = line[name_index]
+                if (not name) or name in plan.header_names:
+                    continue
+                node_index = build_node_index(node_type, name)
+                if unique:
+                    if node_index in seen:
+                        continue
+                    seen.add(node_index)
+                if keyvals is None:
+                    keyvals = plan.keyvals(line, collections.defaultdict(set))
+                node = NodeRecord(name, node_type)
+                node.metadata = keyvals
+                yield node_index, s_parser._finalize_metadata(node)
+
+def update(rec, changed_files):
+    """Bring a parsed ISATabRecord up to date with changed study and assay files.
+    Rows appended since the last parse are read from the last known offset
+    and merged into the existing nodes and process nodes of the study or
+    assay; files whose header changed are parsed again in full. Changes to
+    the investigation file itself require a new parse.
+    Parsing does not keep the process graph of a file, so updating a study
+    or assay with process nodes also reads its earlier rows again, without
+    building their nodes, to rebuild its process nodes.
+    """
+    changed = set(os.path.abspath(f) for f in changed_files)
+    terms = rec.__dict__.get("terms")
+    for study in rec.studies:
+        for record in [study] + list(study.assays):
+            state = getattr(record, "_table_state", None)
+            if state is not None and os.path.abspath(state.path) in changed:
+                indexed = "attribute_index" in record.__dict__
+                StudyAssayParser(state.path, compact=state.compact,
+                                 attribute_index=indexed and terms is None,
+                                 storage=getattr(state, "storage", None)
+                                 ).update_record(record)
+                if terms is not None:
+                    terms.encode_nodes(record.nodes)
+                    if indexed:
+                        record.attribute_index = AttributeIndex.from_nodes(record.nodes, terms)
     return rec
 
 
@@ -99,6 +282,8 @@ class InvestigationParser:
         self._nolist = ["metadata"]
 
     def parse(self, in_handle):
+        """Parse an investigation file from a handle of decoded text.
+        """
         line_iter = self._line_iter(in_handle)
         # parse top level investigation details
         rec = ISATabRecord()
@@ -126,10 +311,10 @@ class InvestigationParser:
 
         if keyvals:
             rec.metadata = keyvals[0]
-        while section and section[0] != "STUDY":
+        while section and section != "STUDY":
             had_info = True
             keyvals, next_section = self._parse_keyvals(line_iter)
-            attr_name = self._sections[section[0]]
+            attr_name = self._sections[section]
             if attr_name in self._nolist:
                 try:
                     keyvals = keyvals[0]
@@ -142,36 +327,43 @@ class InvestigationParser:
 
     def _line_iter(self, in_handle):
         """Read tab delimited file, handling ISA-Tab special case headers.
+        The file is read in one go and split into rows; yields (section, row)
+        pairs where section is the header name for section header lines and
+        None for key/value lines.
         """
-        reader = unicode_csv_reader(in_handle, dialect="excel-tab")
-        for line in reader:
-            if len(line) > 0 and line[0]:
-                # check for section headers; all uppercase and a single value
-                if line[0].upper() == line[0] and "".join(line[1:]) == "":
-                    line = [line[0]]
-                yield line
+        sections = self._sections
+        for line in _investigation_rows(in_handle.read()):
+            if line and line[0]:
+                key = line[0]
+                # section headers are all uppercase with a single value
+                if not any(line[1:]) and (key in sections or key.upper() == key):
+                    yield key, None
+                else:
+                    yield None, line
 
     def _parse_keyvals(self, line_iter):
         """Generate dictionary from key/value pairs.
+        Values are gathered per column, trimmed to the columns with values on
+        the first line, and turned into one dictionary per column.
         """
-        out = None
-        line = None
-        for line in line_iter:
-            if len(line) == 1 and line[0].upper() == line[0]:
+        keys = []
+        columns = None
+        section = None
+        for section, line in line_iter:
+            if section is not None:
                 break
-            else:
-                # setup output dictionaries, trimming off blank columns
-                if out is None:
-                    while not line[-1]:
-                        line = line[:-1]
-                    out = [{} for _ in line[1:]]
-                # add blank values if the line is stripped
-                while len(line) < len(out) + 1:
-                    line.append("")
-                for i in range(len(out)):
-                    out[i][line[0]] = line[i+1].strip()
-                line = None
-        return out, line
+            if columns is None:
+                ncols = len(line) - 1
+                while not line[ncols]:
+                    ncols -= 1
+                columns = [[] for _ in range(ncols)]
+            keys.append(line[0])
+            nvals = len(line) - 1
+            for i, column in enumerate(columns):
+                column.append(line[i + 1].strip() if i < nvals else "")
+        if columns is None:
+            return None, section
+        return [dict(zip(keys, column)) for column in columns], section
 
 
 class StudyAssayParser:
@@ -181,9 +373,30 @@ class StudyAssayParser:
     in the record objects.
     This is coded generally, so can be expanded to more cases. It is biased
     towards microarray and next-gen sequencing data.
+    With a NodeStorage, nodes and process nodes are moved into NodeStore
+    objects. Serial parses without a cache write nodes to the store as
+    they are found; other scans are stored once each file is read.
+    Process nodes of a file are stored once it is read, and their graph
+    builder is dropped, so appended rows are merged by parsing the file again.
+    Memory still grows with the largest file: node indexes, process nodes
+    and unspilled scans are held until a file is read; see
+    bcbio.isatab.store.
     """
-    def __init__(self, base_file):
+    def __init__(self, base_file, cache=None, compact=False, stats=None, use_mmap=False,
+                 attribute_index=False, storage=None):
+        self._base_file = base_file
         self._dir = os.path.dirname(base_file)
+        self._cache = cache
+        self._stats = stats
+        self._use_mmap = use_mmap
+        self._attribute_index = attribute_index
+        self._storage = storage
+        # compact records use __slots__ classes and share repeated values
+        self._compact = compact
+        self._node_class = CompactNodeRecord if compact else NodeRecord
+        self._strings = {} if compact else None
+        # Attrs type -> cell values -> shared Attrs, filled by header plans
+        self._attrs_values = {} if compact else None
         self._col_quals = ("Performer", "Date", "Unit",
                            "Term Accession Number", "Term Source REF")
         self._col_types = {"attribute": ("Characteristics", "Factor Type",
@@ -194,6 +407,13 @@ class StudyAssayParser:
                                            "Assay Name", "Data Transformation Name",
                                            "Normalization Name"),
                            "processing": ("Protocol REF",)}
+        self._study_node_types = ["Source Name", "Sample Name", "Comment[ENA_SAMPLE]"]
+        self._assay_node_types = ["Sample Name", "Extract Name", "Raw Data File",
+                                  "Derived Data File", "Image File",
+                                  "Acquisition Parameter Data File",
+                                  "Free Induction Decay Data File"]
+        self._attrs_types = {}
+        self._plans = {}
         self._synonyms = {"Array Data File" : "Raw Data File",
                           "Free Induction Decay Data File": "Raw Data File",
                           "Derived Array Data File" : "Derived Data File",
@@ -202,149 +422,414 @@ class StudyAssayParser:
                           "Raw Spectral Data File": "Raw Data File",
                           "Derived Spectral Data File": "Derived Data File"}
 
-    def parse(self, rec):
+    def parse(self, rec, workers=None, executor=None, min_parallel_bytes=None):
         """Retrieve row data from files associated with the ISATabRecord.
+        Passing workers > 1, or a concurrent.futures executor, parses the
+        study and assay files concurrently in worker processes; results are
+        merged back in file order, so the record is the same as a serial
+        parse. Investigations whose files total less than min_parallel_bytes
+        (default PARALLEL_MIN_BYTES) are parsed serially, as are all
+        investigations on Python 2 without the futures package.
+        """
+        return self._assemble(rec, self._file_scanner(rec, workers, executor, min_parallel_bytes))
+
+    def _assemble(self, rec, scan):
+        """Fill in nodes and process nodes of studies and assays from a scan function.
+        scan takes a (study, assay) position key, file name, node types and
+        owning record, and returns nodes and process nodes. Studies without
+        nodes are dropped.
         """
         final_studies = []
-        for study in rec.studies:
-            source_data = self._parse_study(study.metadata["Study File Name"],
-                                            ["Source Name", "Sample Name", "Comment[ENA_SAMPLE]"])
+        for si, study in enumerate(rec.studies):
+            source_data, process_nodes = scan((si, None), study.metadata["Study File Name"],
+                                              self._study_node_types, study)
             if source_data:
                 study.nodes = source_data
                 final_assays = []
-                for assay in study.assays:
+                for ai, assay in enumerate(study.assays):
                     cur_assay = ISATabAssayRecord(assay)
-                    assay_data = self._parse_study(assay["Study Assay File Name"],
-                                                   ["Sample Name","Extract Name","Raw Data File","Derived Data File", "Image File", "Acquisition Parameter Data File", "Free Induction Decay Data File"])
+                    assay_data, assay_process_nodes = scan((si, ai), assay["Study Assay File Name"],
+                                                           self._assay_node_types, cur_assay)
                     cur_assay.nodes = assay_data
-                    self._get_process_nodes(assay["Study Assay File Name"], cur_assay)
+                    if assay_process_nodes is not None:
+                        cur_assay.process_nodes = assay_process_nodes
                     final_assays.append(cur_assay)
                 study.assays = final_assays
 
                 #get process nodes
-                self._get_process_nodes(study.metadata["Study File Name"], study)
+                if process_nodes is not None:
+                    study.process_nodes = process_nodes
                 final_studies.append(study)
         rec.studies = final_studies
         return rec
 
-    def _get_process_nodes(self, fname, study):
-        if not os.path.exists(os.path.join(self._dir, fname)):
-            return None
-        process_nodes = {}
+    def parse_lazy(self, rec):
+        """Attach study and assay files to the ISATabRecord without reading them.
+        Studies and assays become LazyStudyRecord and LazyAssayRecord objects,
+        which parse their file when nodes or process_nodes are first used.
+        Unlike parse, studies without nodes are kept, since finding out
+        requires reading the study file.
+        """
+        lazy_studies = []
+        for study in rec.studies:
+            lazy_study = LazyStudyRecord(self, study)
+            lazy_study.assays = [LazyAssayRecord(self, assay) for assay in study.assays]
+            lazy_studies.append(lazy_study)
+        rec.studies = lazy_studies
+        return rec
+
+    def _file_scanner(self, rec, workers, executor, min_parallel_bytes):
+        """Retrieve a function returning nodes and process nodes for each file.
+        Serial parsing scans files as they are requested; parallel parsing
+        scans every study and assay file up front in a process pool.
+        """
+        if executor is None and (workers is None or workers <= 1):
+            return lambda key, fname, node_types, owner: self._scan_cached(fname, node_types, owner)
+        results = {}
+        fingerprints = {}
+        jobs = []
+        for key, fname, node_types in self._table_jobs(rec):
+            cached = self._cache_get(fname, node_types)
+            if cached is not None:
+                results[key] = cached
+            else:
+                fingerprints[key] = self._cache_fingerprint(fname)
+                jobs.append((key, fname, node_types))
+        if min_parallel_bytes is None:
+            min_parallel_bytes = PARALLEL_MIN_BYTES
+        total_bytes = sum(os.path.getsize(os.path.join(self._dir, fname))
+                          for _, fname, _ in jobs
+                          if os.path.exists(os.path.join(self._dir, fname)))
+        parallel = total_bytes >= min_parallel_bytes
+        own_executor = parallel and executor is None
+        if own_executor:
+            try:
+                from concurrent.futures import ProcessPoolExecutor
+            except ImportError:
+                # Python 2 without the futures backport parses serially
+                parallel = own_executor = False
+            else:
+                executor = ProcessPoolExecutor(max_workers=workers)
+        if not parallel:
+            for key, fname, node_types in jobs:
+                results[key] = self._scan_detached(fname, node_types)
+                self._cache_put(fname, node_types, results[key], fingerprints[key])
+        else:
+            try:
+                futures = [(key, fname, node_types,
+                            executor.submit(_scan_table_file, self._base_file, fname, node_types,
+                                            self._compact, self._stats is not None,
+                                            self._use_mmap))
+                           for key, fname, node_types in jobs]
+                for key, fname, node_types, future in futures:
+                    results[key], file_stats = future.result()
+                    for info in file_stats:
+                        self._stats.add(info)
+                    self._cache_put(fname, node_types, results[key], fingerprints[key])
+            finally:
+                if own_executor:
+                    executor.shutdown()
+
+        def scan(key, fname, node_types, owner):
+            return self._attach(results.pop(key), owner)
+        return scan
+
+    def _table_jobs(self, rec):
+        """List (position key, file name, node types) for all study and assay files.
+        """
+        jobs = []
+        for si, study in enumerate(rec.studies):
+            jobs.append(((si, None), study.metadata["Study File Name"], self._study_node_types))
+            for ai, assay in enumerate(study.assays):
+                jobs.append(((si, ai), assay["Study Assay File Name"], self._assay_node_types))
+        return jobs
+
+    def _scan_cached(self, fname, node_types, owner):
+        """Scan a study or assay file, reusing and updating the parse cache.
+        """
+        if self._cache is None:
+            return self._attach(self._scan_table(fname, node_types, owner, spill=True), owner)
+        return self._attach(self._scan_cached_detached(fname, node_types), owner)
 
-        with open(os.path.join(self._dir, fname), "rU") as in_handle:
-            reader = csv.reader(in_handle, dialect="excel-tab")
-            headers = self._swap_synonyms(next(reader))
-            hgroups = self._collapse_header(headers)
-            htypes = self._characterize_header(headers, hgroups)
+    def _scan_cached_detached(self, fname, node_types):
+        """Scan a file with process nodes detached, reusing and updating the parse cache.
+        """
+        result = self._cache_get(fname, node_types)
+        if result is None:
+            fingerprint = self._cache_fingerprint(fname)
+            result = self._scan_detached(fname, node_types)
+            self._cache_put(fname, node_types, result, fingerprint)
+        return result
+
+    def _scan_detached(self, fname, node_types):
+        """Scan a file with process nodes not attached to a record, ready to pickle.
+        """
+        return self._detach(self._scan_table(fname, node_types, ISATabAssayRecord()))
+
+    def _detach(self, result):
+        nodes, process_nodes, state = result
+        if process_nodes is not None:
+            for process_node in process_nodes.values():
+                process_node.study_assay = None
+        return result
+
+    def _attach(self, result, owner):
+        """Make a record the owner of scanned process nodes and parse state.
+        Returns the nodes and process nodes.
+        """
+        nodes, process_nodes, state = result
+        if process_nodes is not None:
+            for process_node in process_nodes.values():
+                process_node.study_assay = owner
+        if self._storage is not None and nodes is not None:
+            if isinstance(nodes, dict):
+                nodes = self._storage.store_nodes(nodes)
+            if process_nodes is not None:
+                process_nodes = self._storage.store_nodes(process_nodes, owner)
+            state.storage = self._storage
+        owner._table_state = state
+        if self._attribute_index:
+            owner.attribute_index = AttributeIndex.from_nodes(nodes)
+        return nodes, process_nodes
+
+    def _cache_get(self, fname, node_types):
+        if self._cache is None:
+            return None
+        if self._stats is not None:
+            start = clock()
+        result = self._cache.get(os.path.join(self._dir, fname), self._cache_kind(node_types))
+        if result is not None and self._stats is not None:
+            self._record_file(fname, node_types, clock() - start, result, cached=True)
+        return result
+
+    def _cache_fingerprint(self, fname):
+        """Fingerprint a file before scanning it, for _cache_put.
+        """
+        if self._cache is None:
+            return None
+        return self._cache.fingerprint(os.path.join(self._dir, fname))
 
-            processing_indices = [i for i, x in enumerate(htypes) if x == "processing"]
-            node_indices = [i for i, x in enumerate(htypes) if x == "node" or x=="node_assay"]
+    def _cache_put(self, fname, node_types, result, fingerprint=None):
+        if self._cache is not None and result[0] is not None:
+            self._cache.put(os.path.join(self._dir, fname), self._cache_kind(node_types), result,
+                            fingerprint)
 
-            for processing_index in processing_indices:
-                try:
-                    input_index = find_lt(node_indices, processing_index)
-                    output_index = find_gt(node_indices, processing_index)
+    def _cache_kind(self, node_types):
+        return ("table", tuple(node_types), self._compact)
 
-                except ValueError:
-                    # print "Invalid indices for process nodes"
-                    break
-                input_header = headers[hgroups[input_index][0]]
-                output_header = headers[hgroups[output_index][0]]
-                processing_header = headers[hgroups[processing_index][0]]
-                line_number = 0
-                max_number = 0
-
-                #reading line by line and identifying inputs outputs and create
-                process_number = 1
-                input_process_map = {}
-                output_process_map = {}
-                for line in reader:
-                    if line_number >=  max_number:
-                        input_name = line[hgroups[input_index][0]]
-                        input_node_index = self._build_node_index(input_header,input_name)
-
-                        output_name = line[hgroups[output_index][0]]
-                        output_node_index = self._build_node_index(output_header, output_name)
-
-                        #if both input_name and output_name are empty, ignore the row
-                        if (not input_name and not output_name):
-                            continue
-                        try:
-                            unique_process_name = input_process_map[input_node_index]
-                        except KeyError:
-                            try:
-                                unique_process_name = output_process_map[output_node_index]
-                            except KeyError:
-                                processing_name = line[hgroups[processing_index][0]]
-                                unique_process_name = processing_name+str(process_number)
-
-                        try:
-                            process_node = process_nodes[unique_process_name]
-                        except KeyError:
-                            #create process node
-                            process_node = ProcessNodeRecord(unique_process_name, processing_header, study)
-                            process_number += 1
-
-                        if not (input_node_index in process_node.inputs):
-                            process_node.inputs.append(input_node_index)
-                        if not (output_node_index in process_node.outputs):
-                            process_node.outputs.append(output_node_index)
-                        input_process_map[input_node_index] = unique_process_name
-                        output_process_map[output_node_index] = unique_process_name
-
-                        max_number = max(len(process_node.inputs), len(process_node.outputs))
-                        line_number += 1
-                        process_nodes[unique_process_name] = process_node
-                    else:
-                        line_number += 1
-                study.process_nodes = process_nodes
+    def _record_file(self, fname, node_types, seconds, result, process_seconds=None,
+                     cached=False):
+        """Add statistics for a scanned study or assay file to the ParseStats.
+        """
+        nodes, process_nodes, state = result
+        kind = "study" if list(node_types) == self._study_node_types else "assay"
+        self._stats.add_file(os.path.join(self._dir, fname), kind, seconds,
+                             rows=state.rows if state is not None else None,
+                             nodes=len(nodes) if nodes is not None else None,
+                             process_nodes=len(process_nodes) if process_nodes is not None else None,
+                             process_seconds=process_seconds, cached=cached,
+                             bytes_read=state.offset if state is not None and not cached else None)
 
+    def _get_process_nodes(self, fname, study):
+        _, process_nodes = self._scan_study(fname, [], study)
+        if process_nodes is not None:
+            study.process_nodes = process_nodes
 
     def _parse_study(self, fname, node_types):
         """Parse study or assay row oriented file around the supplied base node.
         """
+        nodes, _ = self._scan_study(fname, node_types)
+        return nodes
+
+    def _scan_study(self, fname, node_types, study=None):
+        """Parse nodes and process nodes from a study or assay file in a single pass.
+        Process nodes are only collected when a study (or assay) record is
+        supplied to own them; they are None if the file has no usable
+        Protocol REF column. Returns (None, None) for missing files.
+        """
+        nodes, process_nodes, _ = self._scan_table(fname, node_types, study)
+        return nodes, process_nodes
+
+    def _scan_table(self, fname, node_types, study=None, spill=False):
+        """Scan a study or assay file, returning nodes, process nodes and a TableState.
+        With spill and a NodeStorage, nodes are written to a NodeStore as
+        they are found instead of being collected in memory.
+        """
         if not os.path.exists(os.path.join(self._dir, fname)):
+            return None, None, None
+        if self._stats is not None:
+            start = clock()
+        in_handle, plan, reader = self._read_table(fname)
+        with in_handle:
+            nodes = {}
+            if spill and self._storage is not None:
+                nodes = self._storage.node_store()
+            scanners = self._node_scanners(plan, node_types, nodes)
+            if self._use_mmap:
+                reader.limit_columns(max([plan.max_col] + [col for _, col, _ in scanners]))
+            builder = None
+            add_row = None
+            if study is not None:
+                builder = self._process_builder(plan, study)
+                if builder is not None:
+                    add_row = builder.add_row
+                    if self._stats is not None:
+                        add_row = TimedCall(add_row)
+
+            # the header row is scanned for nodes like any data row; columns
+            # renamed by synonyms (Array Data File...) have always produced
+            # nodes from their original header name
+            self._scan_nodes(list(plan.raw_header), scanners, plan)
+            for line in reader:
+                self._scan_nodes(line, scanners, plan)
+                if add_row is not None:
+                    add_row(line)
+            rows = reader.line_num - 1
+            # rows appended while scanning have been read, so resume after them
+            offset = in_handle.offset
+
+        nodes = self._merge_nodes(nodes, scanners)
+        process_nodes = builder.process_nodes if builder is not None else None
+        # the builder is only needed again if rows are appended, so it is
+        # rebuilt by update_record rather than kept with every record; the
+        # path is absolute as states are cached and used from other directories
+        state = TableState(os.path.abspath(os.path.join(self._dir, fname)), offset,
+                           plan.raw_header, node_types, self._compact, rows)
+        result = nodes, process_nodes, state
+        if self._stats is not None:
+            self._record_file(fname, node_types, clock() - start, result,
+                              getattr(add_row, "seconds", None))
+        return result
+
+    def _merge_nodes(self, nodes, scanners):
+        """Add finalized nodes found by scanners, in node type order.
+        """
+        for _, _, type_nodes in scanners:
+            for node_index, node in type_nodes.items():
+                if node_index not in nodes:
+                    nodes[node_index] = self._finalize_metadata(node)
+        return nodes
+
+    def update_record(self, record):
+        """Merge rows appended to the file of a study or assay record since it was parsed.
+        Rows are read from the byte offset reached by the previous scan. When
+        the header changed or the file shrank, the file is parsed again in
+        full instead, as are records kept in a NodeStorage, whose old stores
+        are cleared. Process nodes are built again from the rows before the
+        offset followed by the appended rows, and the builder is dropped.
+        """
+        state = record._table_state
+        fname = os.path.basename(state.path)
+        with TableLines(state.path) as in_handle:
+            header = next(csv.reader(in_handle, dialect="excel-tab"), None)
+        stored = getattr(state, "storage", None) is not None
+        if header is None or tuple(header) != state.raw_header or \
+           os.path.getsize(state.path) < state.offset or stored:
+            old = [record.nodes, record.process_nodes] if stored else []
+            nodes, process_nodes = self._attach(
+                self._scan_table(fname, state.node_types, record, spill=True), record)
+            record.nodes = nodes
+            record.process_nodes = process_nodes if process_nodes is not None else {}
+            for store in old:
+                if hasattr(store, "store_id"):
+                    store.clear()
+            return record
+        plan = self._header_plan(state.raw_header)
+        builder = self._rebuild_process_builder(state, plan, record)
+        scanners = self._node_scanners(plan, state.node_types)
+        rows, state.offset = _read_rows(state.path, state.offset)
+        state.rows += len(rows)
+        for line in rows:
+            if line:
+                self._scan_nodes(line, scanners, plan)
+                if builder is not None:
+                    builder.add_row(line)
+        self._merge_nodes(record.nodes, scanners)
+        if builder is not None:
+            record.process_nodes = builder.process_nodes
+        if self._attribute_index:
+            record.attribute_index = AttributeIndex.from_nodes(record.nodes)
+        return record
+
+    def _rebuild_process_builder(self, state, plan, record):
+        """Rebuild the process graph builder of a record from the rows scanned so far.
+        Returns None for files without process steps.
+        """
+        builder = self._process_builder(plan, record)
+        if builder is not None:
+            rows, _ = _read_rows(state.path, 0, state.offset)
+            for line in rows[1:]:
+                if line:
+                    builder.add_row(line)
+        return builder
+
+    def _read_table(self, fname):
+        """Open a study or assay file, returning the handle, header plan and row reader.
+        """
+        if self._use_mmap:
+            reader = MappedTableReader(os.path.join(self._dir, fname))
+            return reader, self._header_plan(next(reader)), reader
+        in_handle = TableLines(os.path.join(self._dir, fname))
+        reader = csv.reader(in_handle, dialect="excel-tab")
+        plan = self._header_plan(next(reader))
+        return in_handle, plan, reader
+
+    def _node_scanners(self, plan, node_types, store=None):
+        """Prepare (node type, name column, nodes) for node types present in a header.
+        With a NodeStore, nodes go to the store as they are found.
+        """
+        scanners = []
+        for node_type in node_types:
+            try:
+                found = {} if not hasattr(store, "store_id") else \
+                    _StoredNodes(self, store, len(scanners))
+                scanners.append((node_type, plan.header.index(node_type), found))
+            except ValueError:
+                #print "Could not find standard header name: %s in %s" \
+                #                        % (node_type, header)
+                pass
+        return scanners
+
+    def _scan_nodes(self, line, scanners, plan):
+        """Add nodes named in a row, keeping the first row seen for each node.
+        The key values of a row are computed once and shared by the new
+        nodes it names; _finalize_metadata gives each node its own copy.
+        """
+        keyvals = None
+        for node_type, name_index, nodes in scanners:
+            name = line[name_index]
+            #skip the header line and empty lines
+            if (not name) or name in plan.header_names:
+                continue
+            #to deal with same name used for different node types (e.g. Source Name and Sample Name using the same string)
+            node_index = build_node_index(node_type, name)
+            if node_index not in nodes:
+                if keyvals is None:
+                    keyvals = plan.keyvals(line, collections.defaultdict(set))
+                node = self._node_class(self._intern(name), node_type)
+                node.metadata = keyvals
+                nodes[self._intern(node_index)] = node
+
+    def _header_plan(self, raw_header):
+        """Retrieve the plan for a header, shared by files with identical headers.
+        """
+        key = tuple(raw_header)
+        try:
+            return self._plans[key]
+        except KeyError:
+            plan = HeaderPlan(self, raw_header)
+            self._plans[key] = plan
+            return plan
+
+    def _process_builder(self, plan, study):
+        """Prepare a process graph builder for all Protocol REF columns.
+        """
+        if not plan.process_steps:
             return None
-        nodes = {}
-        with open(os.path.join(self._dir, fname), "rU") as in_handle:
-            reader = csv.reader(in_handle, dialect="excel-tab")
-            header = self._swap_synonyms(next(reader))
-            hgroups = self._collapse_header(header)
-            htypes = self._characterize_header(header, hgroups)
-
-            for node_type in node_types:
-                try:
-                    name_index = header.index(node_type)
-                except ValueError:
-                    name_index = None
-
-                if name_index is None:
-                    #print "Could not find standard header name: %s in %s" \
-                    #                        % (node_type, header)
-                    continue
-
-                in_handle.seek(0, 0)
-                for line in reader:
-                    name = line[name_index]
-                    #to deal with same name used for different node types (e.g. Source Name and Sample Name using the same string)
-                    node_index = self._build_node_index(node_type,name)
-                    #skip the header line and empty lines
-                    if name in header:
-                        continue
-                    if (not name):
-                        continue
-                    try:
-                        node = nodes[node_index]
-                    except KeyError:
-                        #print("creating node ", name, "  index", node_index)
-                        node = NodeRecord(name, node_type)
-                        node.metadata = collections.defaultdict(set)
-                        nodes[node_index] = node
-                        attrs = self._line_keyvals(line, header, hgroups, htypes, node.metadata)
-                        nodes[node_index].metadata = attrs
-
-        return dict([(k, self._finalize_metadata(v)) for k, v in nodes.items()])
+        return ProcessGraphBuilder(study,
+                                   headers=plan.header,
+                                   steps=plan.process_steps,
+                                   strings=self._strings)
 
     def _finalize_metadata(self, node):
         """Convert node metadata back into a standard dictionary and list.
@@ -354,43 +839,39 @@ class StudyAssayParser:
             #val = list(val)
             #if isinstance(val[0], tuple):
             #    val = [dict(v) for v in val]
+            # in compact mode values are already shared by the header plan
             final[key] = list(val)
         node.metadata = final
         return node
 
-    def _line_keyvals(self, line, header, hgroups, htypes, out):
-        out = self._line_by_type(line, header, hgroups, htypes, out, "node")
-        out = self._line_by_type(line, header, hgroups, htypes, out, "attribute",
-                                 self._collapse_attributes)
-        out = self._line_by_type(line, header, hgroups, htypes, out, "processing",
-                                 self._collapse_attributes)
-        return out
+    def _intern(self, val):
+        """Share equal strings between nodes in compact mode.
+        """
+        return _shared_value(self._strings, val)
 
-    def _line_by_type(self, line, header, hgroups, htypes, out, want_type,
-                      collapse_quals_fn = None):
-        """Parse out key value pairs for line information based on a group of values.
+    def _shared_attrs(self, attrs_type):
+        """Retrieve the table of shared values of an Attrs type in compact mode, or None.
         """
-        for index, htype in ((i, t) for i, t in enumerate(htypes) if t == want_type):
-            col = hgroups[index][0]
-            key = header[col]#self._clean_header(header[col])
-            if collapse_quals_fn:
-                val = collapse_quals_fn(line, header, hgroups[index])
-            else:
-                val = line[col]
-            out[key].add(val)
-        return out
+        if self._attrs_values is None:
+            return None
+        return self._attrs_values.setdefault(attrs_type, {})
 
     def _collapse_attributes(self, line, header, indexes):
         """Combine attributes in multiple columns into single named tuple.
         """
-        names = []
-        vals = []
-        pat = re.compile("[\W]+")
-        for i in indexes:
-            names.append(pat.sub("_", self._clean_header(header[i])))
-            vals.append(line[i])
-        Attrs = collections.namedtuple('Attrs', names)
-        return Attrs(*vals)
+        return self._attrs_type(header, indexes)(*[line[i] for i in indexes])
+
+    def _attrs_type(self, header, indexes):
+        """Retrieve the Attrs type for a group of attribute columns.
+        """
+        group = tuple(header[i] for i in indexes)
+        try:
+            return self._attrs_types[group]
+        except KeyError:
+            names = tuple(_attr_name_pat.sub("_", self._clean_header(h)) for h in group)
+            attrs_type = attrs_record_type(names)
+            self._attrs_types[group] = attrs_type
+            return attrs_type
 
     def _clean_header(self, header):
         """Remove ISA-Tab specific information from Header[real name] headers.
@@ -433,27 +914,465 @@ class StudyAssayParser:
     def _swap_synonyms(self, header):
         return [self._synonyms.get(h, h) for h in header]
 
-    #to ensure uniqueness of node indexes
     def _build_node_index(self, type, name):
-        if type=="Source Name":
-            return "source-"+name
+        return build_node_index(type, name)
+
+
+def _shared_value(strings, val):
+    """Retrieve the shared copy of a string from a table of strings, adding it if new.
+    """
+    if strings is None:
+        return val
+    return strings.setdefault(val, val)
+
+#to ensure uniqueness of node indexes
+def build_node_index(type, name):
+    if type=="Source Name":
+        return "source-"+name
+    else:
+        if type == "Sample Name":
+            return "sample-"+name
         else:
-            if type == "Sample Name":
-                return "sample-"+name
+            if type == "Extract Name":
+                return "extract-"+name
             else:
-                if type == "Extract Name":
-                    return "extract-"+name
+                if type == "Raw Data File":
+                   return "rawdatafile-"+name
                 else:
-                    if type == "Raw Data File":
-                       return "rawdatafile-"+name
+                    if type=="Derived Data File":
+                        return "deriveddatafile-"+name
                     else:
-                        if type=="Derived Data File":
-                            return "deriveddatafile-"+name
+                        if type=="Acquisition Parameter Data File":
+                            return "acquisitionparameterfile-"+name
                         else:
-                            if type=="Acquisiton Parameter Data File":
-                                return "acquisitionparameterfile-"+name
-                            else:
-                                "ERROR - Type not being considered! ", type
+                            # other node columns (Labeled Extract Name, Assay Name...)
+                            # are linked by process nodes
+                            return type.lower().replace(" ", "")+"-"+name
+
+
+class TableState:
+    """Position reached by the last scan of a study or assay file.
+    Keeps what is needed to merge rows appended afterwards: the byte offset
+    scanned up to, the header and the node types collected, along with the
+    number of rows read. The process graph builder is not kept; updates
+    rebuild it from the file.
+    """
+    def __init__(self, path, offset, raw_header, node_types, compact=False, rows=0):
+        self.path = path
+        self.offset = offset
+        self.raw_header = raw_header
+        self.node_types = list(node_types)
+        self.compact = compact
+        self.rows = rows
+        # NodeStorage holding the nodes, if any
+        self.storage = None
+
+class _StoredNodes:
+    """Nodes of one node type written to a NodeStore as a scan finds them.
+    Stands in for the dictionary of a node scanner: each node is
+    finalized and stored when added, and only its index is kept.
+    """
+    def __init__(self, s_parser, store, group):
+        self._s_parser = s_parser
+        self._store = store
+        self._group = group
+        self._seen = set()
+
+    def __contains__(self, node_index):
+        return node_index in self._seen
+
+    def __setitem__(self, node_index, node):
+        self._seen.add(node_index)
+        self._store.add(node_index, self._s_parser._finalize_metadata(node), self._group)
+
+    def items(self):
+        return []
+
+def _read_rows(path, offset, end=None):
+    """Read complete rows of a file from a byte offset up to end, or the end of the file.
+    Returns the rows and the offset after the last complete line, so a row
+    still being written is left for the next read. Lines may end in \n,
+    \r\n or \r; unless the line before offset ended in \r alone, a \r
+    at the end of the file is left as well, as its \n may follow.
+    """
+    with open(path, "rb") as in_handle:
+        in_handle.seek(max(offset - 1, 0))
+        previous = in_handle.read(1) if offset > 0 else b""
+        data = in_handle.read() if end is None else in_handle.read(end - offset)
+    if end is None and data.endswith(b"\r") and previous != b"\r":
+        data = data[:-1]
+    data = data[:max(data.rfind(b"\n"), data.rfind(b"\r")) + 1]
+    lines = data.splitlines(True)
+    if str is not bytes:
+        lines = [l.decode("utf-8", "replace") for l in lines]
+    return list(csv.reader(lines, dialect="excel-tab")), offset + len(data)
+
+def split_line_ends(line):
+    """Split a line read from a binary handle at \r line ends as well as \n.
+    """
+    if b"\r" in line:
+        return line.splitlines(True)
+    return [line]
+
+class TableLines:
+    """Lines of a study or assay file, ready for csv.reader.
+    Files are decoded as UTF-8 on Python 3, like investigation files, with
+    invalid bytes replaced, and read as bytes on Python 2, where csv does
+    not handle unicode. Lines may end in \n, \r\n or \r. offset counts
+    the bytes of the lines read.
+    """
+    def __init__(self, path):
+        self._handle = open(path, "rb")
+        self.offset = 0
+
+    def __iter__(self):
+        if str is bytes:
+            return self._split_lines()
+        return (line.decode("utf-8", "replace") for line in self._split_lines())
+
+    def _split_lines(self):
+        for line in self._handle:
+            self.offset += len(line)
+            for part in split_line_ends(line):
+                yield part
+
+    def fileno(self):
+        return self._handle.fileno()
+
+    def close(self):
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+def _scan_table_file(base_file, fname, node_types, compact=False, collect_stats=False,
+                     use_mmap=False):
+    """Parse a study or assay file inside a worker process.
+    Process nodes are returned detached, and attached to their owner once
+    results are merged back. Returns the scan result and a list of file
+    statistics, empty unless collect_stats is set.
+    Each job gets its own parser, so long lived workers do not accumulate
+    shared values and header plans across investigations, and threads
+    running jobs concurrently do not share statistics.
+    """
+    stats = ParseStats() if collect_stats else None
+    s_parser = StudyAssayParser(base_file, compact=compact, stats=stats, use_mmap=use_mmap)
+    result = s_parser._scan_detached(fname, node_types)
+    return result, stats.files if collect_stats else []
+
+
+class MappedTableReader:
+    """Read the rows of a tab delimited study or assay file through a memory map.
+    Lines are located in the mapped buffer, so the file is paged in by the
+    operating system and repeated scans are served from the page cache
+    instead of being copied through file buffers. Files without quotes are
+    split directly on tabs; after limit_columns only the cells up to the
+    given column are split off, with the rest of the row left in a single
+    trailing cell. Files with quoted values are read with csv from the
+    mapped lines. Can be used in place of the file handle and csv reader
+    returned by open and csv.reader.
+    This is not faster than reading through file buffers: splitting rows and
+    building nodes take most of the time, not reading. On a 160k row
+    synthetic investigation (benchmarks/speed.py --rows 20000, with and
+    without --mmap) table scans, process nodes and full parses took the
+    same time within 4%, and wide files with 40 characteristics did not
+    change that. It is kept for files read repeatedly from the page cache.
+    """
+    def __init__(self, path):
+        self._handle = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped
+            self._map = None
+        self._encoding = None if str is bytes else "utf-8"
+        self._maxsplit = -1
+        self._line_num = 0
+        self._csv = None
+        if self._map is not None and self._map.find(b'"') >= 0:
+            lines = (part for line in iter(self._map.readline, b"")
+                     for part in split_line_ends(line))
+            if self._encoding is not None:
+                lines = (line.decode(self._encoding, "replace") for line in lines)
+            self._csv = csv.reader(lines, dialect="excel-tab")
+            self._rows = self._csv
+        else:
+            self._rows = self._split_rows()
+
+    def limit_columns(self, max_col):
+        """Only split rows read from now on up to column max_col.
+        """
+        self._maxsplit = max_col + 1 if max_col >= 0 else 0
+
+    @property
+    def line_num(self):
+        return self._csv.line_num if self._csv is not None else self._line_num
+
+    @property
+    def offset(self):
+        """Byte offset after the last line read."""
+        return self._map.tell() if self._map is not None else 0
+
+    def _split_rows(self):
+        if self._map is None:
+            return
+        encoding = self._encoding
+        # the header is split in full, before limit_columns is called
+        maxsplit = -1
+        line_num = 0
+        try:
+            for line in iter(self._map.readline, b""):
+                line = line.rstrip(b"\r\n")
+                # old style line ends leave carriage returns inside the line
+                for part in (line.split(b"\r") if b"\r" in line else (line,)):
+                    line_num += 1
+                    if not part:
+                        yield []
+                    elif encoding is None:
+                        yield part.split(b"\t", maxsplit)
+                    else:
+                        yield part.decode(encoding, "replace").split(u"\t", maxsplit)
+                    maxsplit = self._maxsplit
+        finally:
+            self._line_num = line_num
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._rows)
+    next = __next__
+
+    def fileno(self):
+        return self._handle.fileno()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+
+class HeaderPlan:
+    """Interpretation of a study or assay header, computed once per header.
+    Holds the synonym swapped header, column groups and their types, plus
+    the extraction slots used to turn a row into node metadata:
+      - slots -- list of (key, extractor) pairs, applied in order
+      - process_steps -- (input columns, processing column, output columns) for
+                         each Protocol REF column with node columns on both
+                         sides; node columns are ordered closest first
+    """
+    def __init__(self, parser, raw_header):
+        self.raw_header = tuple(raw_header)
+        self.header = parser._swap_synonyms(raw_header)
+        self.hgroups = parser._collapse_header(self.header)
+        self.htypes = parser._characterize_header(self.header, self.hgroups)
+        self.header_names = frozenset(self.header)
+        self.slots = []
+        for want_type in ("node", "attribute", "processing"):
+            for index, htype in enumerate(self.htypes):
+                if htype == want_type:
+                    group = self.hgroups[index]
+                    key = self.header[group[0]]#self._clean_header(header[col])
+                    if want_type == "node":
+                        extractor = self._node_extractor(group[0], parser._strings)
+                    else:
+                        attrs_type = parser._attrs_type(self.header, group)
+                        extractor = self._attrs_extractor(attrs_type, group,
+                                                          parser._shared_attrs(attrs_type))
+                    self.slots.append((key, extractor))
+        self.process_steps = self._process_steps(parser._col_types["node_assay"])
+        # highest column read when scanning rows for nodes and processes
+        self.max_col = max([-1] + [col for index, htype in enumerate(self.htypes)
+                                   if htype in ("node", "node_assay", "attribute", "processing")
+                                   for col in self.hgroups[index]])
+
+    def _node_extractor(self, col, strings=None):
+        """Retrieve the name in a node column, shared through a table of strings if given.
+        """
+        if strings is None:
+            return operator.itemgetter(col)
+        def extract(line):
+            name = line[col]
+            return strings.setdefault(name, name)
+        return extract
+
+    def _attrs_extractor(self, attrs_type, group, shared=None):
+        """Build the Attrs value of a group of columns.
+        With a table of shared values, keyed by the cells of the group, rows
+        with equal cells get the same Attrs object, built once.
+        """
+        if len(group) == 1:
+            col = group[0]
+            if shared is None:
+                return lambda line: attrs_type(line[col])
+            def extract(line):
+                cell = line[col]
+                try:
+                    return shared[cell]
+                except KeyError:
+                    val = shared[cell] = attrs_type(cell)
+                    return val
+            return extract
+        getter = operator.itemgetter(*group)
+        if shared is None:
+            return lambda line: attrs_type(*getter(line))
+        def extract(line):
+            cells = getter(line)
+            try:
+                return shared[cells]
+            except KeyError:
+                val = shared[cells] = attrs_type(*cells)
+                return val
+        return extract
+
+    def _process_steps(self, node_assay_names):
+        processing_indices = [i for i, x in enumerate(self.htypes) if x == "processing"]
+        # Labeled Extract Name and Assay Name columns are also typed as
+        # attributes, but still separate the steps of a protocol
+        node_indices = [i for i, x in enumerate(self.htypes) if x == "node" or x=="node_assay"
+                        or self.header[self.hgroups[i][0]] in node_assay_names]
+        steps = []
+        for processing_index in processing_indices:
+            pos = bisect.bisect_left(node_indices, processing_index)
+            input_cols = tuple(self.hgroups[i][0] for i in reversed(node_indices[:pos]))
+            output_cols = tuple(self.hgroups[i][0] for i in node_indices[pos:])
+            if not input_cols or not output_cols:
+                # print "Invalid indices for process nodes"
+                continue
+            steps.append((input_cols, self.hgroups[processing_index][0], output_cols))
+        return steps
+
+    def row(self, line):
+        """Retrieve the values of a row as a dictionary of lists, keyed like node metadata.
+        """
+        out = {}
+        for key, extractor in self.slots:
+            out.setdefault(key, []).append(extractor(line))
+        return out
+
+    def keyvals(self, line, out):
+        """Add the key value pairs of a row to a dictionary of sets.
+        """
+        for key, extractor in self.slots:
+            out[key].add(extractor(line))
+        return out
+
+
+class ProcessGraphBuilder:
+    """Build process nodes around every Protocol REF column from a stream of rows.
+    Each processing column is a step of the protocol, with inputs and outputs
+    from the closest node columns on either side; all steps share one
+    dictionary of process nodes, so provenance follows the whole chain
+    from the first to the last node column.
+    """
+    def __init__(self, study, headers, steps, strings=None):
+        self.study = study
+        # compact parsing passes a table of values shared with the nodes
+        self._process_class = CompactProcessNodeRecord if strings is not None else ProcessNodeRecord
+        self._strings = strings
+        self.process_nodes = {}
+        # (column, name) -> node index, shared since the output column of a
+        # step is the input column of the next
+        self._node_indexes = {}
+        # (process name, node index) for every output added to a process
+        self._outputs = set()
+        self._steps = [ProcessStep(headers, input_cols, processing_col, output_cols)
+                       for input_cols, processing_col, output_cols in steps]
+
+    def add_row(self, line):
+        """Assign the inputs and outputs of a row to new or existing processes.
+        """
+        for step in self._steps:
+            step.add_row(self, line)
+
+    def _intern(self, val):
+        return _shared_value(self._strings, val)
+
+
+class ProcessStep:
+    """Group the rows of one Protocol REF column into process nodes.
+    The input and output of a row are the closest node columns on either
+    side with a value, so empty columns (an unused Image File) are skipped.
+    """
+    def __init__(self, headers, input_cols, processing_col, output_cols):
+        self._input_cols = [(col, headers[col]) for col in input_cols]
+        self._output_cols = [(col, headers[col]) for col in output_cols]
+        self._processing_col = processing_col
+        self._processing_header = headers[processing_col]
+        self._process_number = 1
+        self._input_process_map = {}
+        self._output_process_map = {}
+
+    def add_row(self, builder, line):
+        """Assign the input and output of a row to a new or existing process.
+        The builder is passed in rather than kept, so steps and builder do not
+        form a reference cycle holding on to the study.
+        """
+        input_node_index = self._node_index(builder, line, self._input_cols)
+        output_node_index = self._node_index(builder, line, self._output_cols)
+        #if input or output is missing, ignore the row
+        if input_node_index is None or output_node_index is None:
+            return
+
+        unique_process_name = self._input_process_map.get(input_node_index)
+        # an input stays with the first process it was added to
+        new_input = unique_process_name is None
+        if unique_process_name is None:
+            unique_process_name = self._output_process_map.get(output_node_index)
+        process_nodes = builder.process_nodes
+        if unique_process_name is None:
+            processing_name = line[self._processing_col]
+            unique_process_name = processing_name + str(self._process_number)
+            # the same protocol can be used by more than one Protocol REF column
+            while unique_process_name in process_nodes:
+                self._process_number += 1
+                unique_process_name = processing_name + str(self._process_number)
+
+        process_node = process_nodes.get(unique_process_name)
+        if process_node is None:
+            #create process node
+            process_node = builder._process_class(unique_process_name,
+                                                   self._processing_header,
+                                                   builder.study)
+            process_nodes[unique_process_name] = process_node
+            self._process_number += 1
+
+        # inputs and outputs stay ordered lists; outputs can move between
+        # processes, so only they need a set for constant time membership
+        if new_input:
+            process_node.inputs.append(input_node_index)
+            self._input_process_map[input_node_index] = unique_process_name
+        edge = (unique_process_name, output_node_index)
+        if edge not in builder._outputs:
+            builder._outputs.add(edge)
+            process_node.outputs.append(output_node_index)
+        self._output_process_map[output_node_index] = unique_process_name
+
+    def _node_index(self, builder, line, cols):
+        """Retrieve the index of the closest node with a value in a row, or None.
+        """
+        node_indexes = builder._node_indexes
+        for col, header in cols:
+            name = line[col]
+            if name:
+                try:
+                    return node_indexes[(col, name)]
+                except KeyError:
+                    node_index = builder._intern(build_node_index(header, name))
+                    node_indexes[(col, name)] = node_index
+                    return node_index
+        return None
 
 
 _record_str = \
@@ -516,7 +1435,7 @@ class ISATabRecord:
         self.studies = []
 
     def __str__(self):
-        return _record_str.format(md=pprint.pformat(self.metadata).replace("\n", "\n" + " " * 3),
+        return _record_str.format(md=_pformat(self.metadata, 3),
                                   ont=self.ontology_refs,
                                   pub=self.publications,
                                   contact=self.contacts,
@@ -537,8 +1456,8 @@ class ISATabStudyRecord:
         self.process_nodes = {}
 
     def __str__(self):
-        return _study_str.format(md=pprint.pformat(self.metadata).replace("\n", "\n" + " " * 5),
-                                 design_descriptors=pprint.pformat(self.design_descriptors).replace("\n", "\n" + " " * 5),
+        return _study_str.format(md=_pformat(self.metadata, 5),
+                                 design_descriptors=_pformat(self.design_descriptors, 5),
                                  publications="\n".join(str(x) for x in self.publications),
                                  factors="\n".join(str(x) for x in self.factors),
                                  assays="\n".join(str(x) for x in self.assays),
@@ -557,11 +1476,67 @@ class ISATabAssayRecord:
         self.process_nodes = {}
 
     def __str__(self):
-        return _assay_str.format(md=pprint.pformat(self.metadata).replace("\n", "\n" + " " * 7),
+        return _assay_str.format(md=_pformat(self.metadata, 7),
                                  nodes="\n".join(str(x) for x in self.nodes.values()),
                                  process_nodes="\n".join(str(x) for x in self.process_nodes.values())
         )
 
+class LazyNodes:
+    """Parse the nodes and process nodes of a record from its file on first access.
+    Loaded nodes are kept until unload() is called; the next access parses
+    the file again.
+    """
+    _lazy_attrs = ("nodes", "process_nodes", "attribute_index")
+
+    def __getattr__(self, name):
+        if name in self._lazy_attrs:
+            self.load()
+            try:
+                return self.__dict__[name]
+            except KeyError:
+                pass
+        raise AttributeError(name)
+
+    def load(self):
+        """Parse the associated study or assay file, unless already loaded.
+        """
+        if not self.loaded:
+            nodes, process_nodes = self._parser._scan_cached(self._fname, self._node_types, self)
+            self.nodes = nodes
+            self.process_nodes = process_nodes if process_nodes is not None else {}
+        return self
+
+    def unload(self):
+        """Drop loaded nodes, process nodes and attribute index to free memory.
+        """
+        for attr in self._lazy_attrs + ("_table_state",):
+            self.__dict__.pop(attr, None)
+
+    @property
+    def loaded(self):
+        return "nodes" in self.__dict__
+
+class LazyStudyRecord(LazyNodes, ISATabStudyRecord):
+    """Represent a study whose Study file is parsed on first access.
+    """
+    def __init__(self, s_parser, study):
+        ISATabStudyRecord.__init__(self)
+        self.__dict__.update(study.__dict__)
+        self.unload()
+        self._parser = s_parser
+        self._fname = self.metadata["Study File Name"]
+        self._node_types = s_parser._study_node_types
+
+class LazyAssayRecord(LazyNodes, ISATabAssayRecord):
+    """Represent an assay whose Assay file is parsed on first access.
+    """
+    def __init__(self, s_parser, metadata):
+        ISATabAssayRecord.__init__(self, metadata)
+        self.unload()
+        self._parser = s_parser
+        self._fname = self.metadata["Study Assay File Name"]
+        self._node_types = s_parser._assay_node_types
+
 class NodeRecord:
     """Represent a data or material node within an ISA-Tab Study/Assay file.
     """
@@ -571,14 +1546,71 @@ class NodeRecord:
         self.metadata = {}
 
     def __str__(self):
-        return _node_str.format(md=pprint.pformat(self.metadata).replace("\n", "\n" + " " * 9),
-                                name=self.name,
-                                type=self.ntype)
+        return _format_node(self)
+
+
+def _owner_ref(owner):
+    """Weak reference to the study or assay owning a process node.
+    Records hold their process nodes, so a strong reference back would make
+    every record a reference cycle, only freed by the garbage collector.
+    Values that cannot be weakly referenced, like None, are kept as is.
+    """
+    try:
+        return weakref.ref(owner)
+    except TypeError:
+        return owner
+
+def _owner(ref):
+    return ref() if isinstance(ref, weakref.ref) else ref
 
 
 class ProcessNodeRecord:
     """Represent a process node within an ISA-Tab Study/Assay file (corresponds to Protocol REF).
+    study_assay refers weakly to the owning record, and becomes None once the
+    record is no longer used elsewhere.
+    """
+    def __init__(self, name="", ntype="", study_assay=""):
+        self.ntype = ntype
+        self.study_assay = study_assay
+        self.name = name
+        self.inputs = []
+        self.outputs = []
+
+    study_assay = property(lambda self: _owner(self._study_assay),
+                           lambda self, owner: setattr(self, "_study_assay", _owner_ref(owner)))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_study_assay"] = self.study_assay
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.study_assay = state["_study_assay"]
+
+    def __str__(self):
+        return _format_process_node(self)
+
+
+class CompactNodeRecord(object):
+    """NodeRecord without a per instance dictionary, used by compact parsing.
+    """
+    __slots__ = ("ntype", "name", "metadata")
+
+    def __init__(self, name="", ntype=""):
+        self.ntype = ntype
+        self.name = name
+        self.metadata = {}
+
+    def __str__(self):
+        return _format_node(self)
+
+
+class CompactProcessNodeRecord(object):
+    """ProcessNodeRecord without a per instance dictionary, used by compact parsing.
     """
+    __slots__ = ("ntype", "_study_assay", "name", "inputs", "outputs")
+
     def __init__(self, name="", ntype="", study_assay=""):
         self.ntype = ntype
         self.study_assay = study_assay
@@ -586,8 +1618,32 @@ class ProcessNodeRecord:
         self.inputs = []
         self.outputs = []
 
+    study_assay = ProcessNodeRecord.study_assay
+
+    def __getstate__(self):
+        return (self.ntype, self.study_assay, self.name, self.inputs, self.outputs)
+
+    def __setstate__(self, state):
+        self.ntype, self.study_assay, self.name, self.inputs, self.outputs = state
+
     def __str__(self):
-        return _process_node_str.format(inputs=pprint.pformat(self.inputs).replace("\n", "\n" + " " * 9),
-                                outputs=pprint.pformat(self.outputs).replace("\n", "\n" + " " * 9),
-                                name=self.name,
-                                type=self.ntype)
+        return _format_process_node(self)
+
+
+def _pformat(value, indent):
+    """Pretty print a value, indenting continuation lines to line up.
+    pprint is only needed to display records, so it is imported on first use.
+    """
+    import pprint
+    return pprint.pformat(value).replace("\n", "\n" + " " * indent)
+
+def _format_node(node):
+    return _node_str.format(md=_pformat(node.metadata, 9),
+                            name=node.name,
+                            type=node.ntype)
+
+def _format_process_node(process_node):
+    return _process_node_str.format(inputs=_pformat(process_node.inputs, 9),
+                                    outputs=_pformat(process_node.outputs, 9),
+                                    name=process_node.name,
+                                    type=process_node.ntype)
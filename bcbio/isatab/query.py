@@ -0,0 +1,121 @@
+"""Select nodes of ISA-Tab studies and assays by attribute values.
+Parsing with attribute_index=True gives each study and assay record an
+attribute_index: an AttributeIndex mapping metadata keys and values to
+the node indexes holding them, so queries like all samples with
+Characteristics[organism] of Mus musculus look up a dictionary instead of
+unpacking the Attrs tuples of every node. Attribute values are indexed
+by their main value, the first field of the Attrs tuple, or the label of
+the term for values replaced by term ids; node name columns like Sample
+Name by the name itself.
+samples selects study samples matching a set of conditions, and
+data_files joins selected samples to the data files of each assay through
+the Sample Name column of the assay file.
+"""
+import collections
+
+
+class AttributeIndex:
+    """Node indexes by metadata key and value, plus by node type.
+      - values -- key -> value -> set of node indexes
+      - types -- node type -> set of node indexes
+    """
+    def __init__(self):
+        self.values = collections.defaultdict(lambda: collections.defaultdict(set))
+        self.types = collections.defaultdict(set)
+
+    @classmethod
+    def from_nodes(cls, nodes, terms=None):
+        index = cls()
+        for node_index, node in (nodes or {}).items():
+            index.add(node_index, node, terms)
+        return index
+
+    def add(self, node_index, node, terms=None):
+        """Index the metadata of a node, looking up term ids in a TermTable.
+        """
+        self.types[node.ntype].add(node_index)
+        for key, vals in node.metadata.items():
+            key_values = self.values[key]
+            for val in vals:
+                if isinstance(val, tuple):
+                    val = val[0] if val else ""
+                elif isinstance(val, int) and terms is not None:
+                    val = terms.label(val)
+                if val:
+                    key_values[val].add(node_index)
+
+    def keys(self):
+        return list(self.values.keys())
+
+    def distinct(self, key):
+        """Retrieve the distinct values of a metadata key.
+        """
+        return sorted(self.values[key].keys()) if key in self.values else []
+
+    def lookup(self, key, value):
+        """Retrieve node indexes with a value for a key; value may be a list of alternatives.
+        """
+        key_values = self.values.get(key)
+        if key_values is None:
+            return set()
+        if isinstance(value, (list, tuple, set, frozenset)):
+            out = set()
+            for val in value:
+                out |= key_values.get(val, set())
+            return out
+        return set(key_values.get(value, ()))
+
+    def select(self, conditions=None, ntype=None):
+        """Retrieve node indexes matching all conditions.
+        conditions is a dictionary or list of (key, value) pairs, where a
+        value may be a list of alternatives; ntype restricts the nodes to
+        one node type (or a list of types).
+        """
+        if ntype is not None:
+            ntypes = [ntype] if isinstance(ntype, str) else ntype
+            out = set()
+            for cur_type in ntypes:
+                out |= self.types.get(cur_type, set())
+        else:
+            out = None
+        if isinstance(conditions, dict):
+            conditions = conditions.items()
+        # start from the most selective condition, stopping once nothing is left
+        matches = sorted((self.lookup(key, value) for key, value in conditions or []), key=len)
+        for match in matches:
+            out = match if out is None else out & match
+            if not out:
+                break
+        if out is None:
+            out = set()
+            for nodes in self.types.values():
+                out |= nodes
+        return out
+
+    def __getstate__(self):
+        return {"values": dict((k, dict(v)) for k, v in self.values.items()),
+                "types": dict(self.types)}
+
+    def __setstate__(self, state):
+        self.__init__()
+        for key, key_values in state["values"].items():
+            self.values[key].update(key_values)
+        self.types.update(state["types"])
+
+
+def samples(study, conditions=None):
+    """Retrieve node indexes of study samples matching all conditions.
+    """
+    return study.attribute_index.select(conditions, "Sample Name")
+
+def data_files(study, sample_indexes, ntypes=("Raw Data File", "Derived Data File")):
+    """Join study samples to the data files of each assay of the study.
+    Returns (assay, set of data file node indexes) for every assay, found
+    through the Sample Name values of the assay nodes.
+    """
+    names = set(study.nodes[x].name for x in sample_indexes if x in study.nodes)
+    out = []
+    for assay in study.assays:
+        index = assay.attribute_index
+        out.append((assay, index.select([("Sample Name", names)], ntypes) if names else set()))
+    return out
@@ -0,0 +1,208 @@
+"""Random access to the rows of large study and assay files by node.
+Retrieving the rows for one sample or data file out of a large a_ file
+normally means parsing the whole file. A RowIndex maps node indexes
+(source-..., sample-..., rawdatafile-..., as used as keys of the nodes
+dictionaries) to the byte offsets of the rows naming them, so lookups seek
+straight to those rows and parse nothing else.
+The index is stored in a sidecar file next to the table (a_assay.txt.rowidx)
+together with the fingerprint of the table it was built from, and is
+rebuilt automatically when the table changes. Changes are detected by
+size and modification time, so opening an index reads only the sidecar;
+hashing the table contents as well is optional. Sidecars are read with
+an unpickler that refuses anything but plain values, so a crafted index
+file cannot run code; such files are rebuilt.
+"""
+import io
+import os
+import csv
+import pickle
+import tempfile
+import collections
+
+from bcbio.isatab.cache import file_fingerprint
+from bcbio.isatab.parser import (StudyAssayParser, NodeRecord, build_node_index,
+                                 split_line_ends)
+from bcbio.isatab.serialize import _plain_unpickler
+
+# bump when the layout of index files changes
+INDEX_VERSION = 2
+
+_index_ext = ".rowidx"
+
+
+class RowIndex:
+    """Byte offsets of the rows naming each node of a study or assay file.
+      - path -- the indexed study or assay file
+      - header -- header row of the file
+      - offsets -- node index -> list of row byte offsets, in file order
+      - names -- node name -> node indexes of every node type with that name
+      - fingerprint -- file_fingerprint of the file when indexed
+    """
+    def __init__(self, path, header, offsets, fingerprint, names=None):
+        self.path = path
+        self.header = header
+        self.offsets = offsets
+        self.fingerprint = fingerprint
+        if names is None:
+            names = collections.defaultdict(list)
+            for node_index in offsets:
+                names[node_index.split("-", 1)[-1]].append(node_index)
+            names = dict(names)
+        self.names = names
+        self._s_parser = StudyAssayParser(path)
+        self._plan = self._s_parser._header_plan(header)
+
+    @classmethod
+    def open(cls, path, index_file=None, content_hash=False):
+        """Retrieve the index of a file, rebuilding the sidecar if the file changed.
+        The file is compared by size and modification time; content_hash=True
+        also compares a hash of its contents, which reads the whole file.
+        """
+        if index_file is None:
+            index_file = path + _index_ext
+        fingerprint = file_fingerprint(path, content_hash)
+        try:
+            with open(index_file, "rb") as in_handle:
+                version, stored, header, offsets, names = _plain_unpickler(in_handle).load()
+            if version == INDEX_VERSION and \
+               stored[:2] == fingerprint[:2] and (not content_hash or stored[2] == fingerprint[2]):
+                return cls(path, header, offsets, stored, names)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+        index = cls.build(path, content_hash)
+        index.save(index_file)
+        return index
+
+    @classmethod
+    def build(cls, path, content_hash=False):
+        """Index a study or assay file by reading it once.
+        All node columns are indexed, along with the study and assay node
+        types StudyAssayParser collects, using the same node indexes.
+        content_hash=True stores a hash of the contents in the fingerprint.
+        """
+        fingerprint = file_fingerprint(path, content_hash)
+        offsets = collections.defaultdict(list)
+        names = collections.OrderedDict()
+        s_parser = StudyAssayParser(path)
+        with open(path, "rb") as in_handle:
+            rows = _offset_rows(in_handle)
+            header = next(rows, (0, None))[1]
+            if header is None:
+                return cls(path, [], {}, fingerprint)
+            plan = s_parser._header_plan(header)
+            node_cols = [(plan.header[i], i) for i in _node_columns(s_parser, plan)]
+            for offset, line in rows:
+                for node_type, col in node_cols:
+                    try:
+                        name = line[col]
+                    except IndexError:
+                        continue
+                    if (not name) or name in plan.header_names:
+                        continue
+                    node_index = build_node_index(node_type, name)
+                    cur = offsets[node_index]
+                    if not cur:
+                        names.setdefault(name, []).append(node_index)
+                    if not cur or cur[-1] != offset:
+                        cur.append(offset)
+        return cls(path, header, dict(offsets), fingerprint, dict(names))
+
+    def save(self, index_file=None):
+        """Write the index to its sidecar file.
+        """
+        if index_file is None:
+            index_file = self.path + _index_ext
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_file)),
+                                        suffix=".tmp")
+        with os.fdopen(fd, "wb") as out_handle:
+            pickle.dump((INDEX_VERSION, self.fingerprint, self.header, self.offsets,
+                         self.names), out_handle, pickle.HIGHEST_PROTOCOL)
+        getattr(os, "replace", os.rename)(tmp_file, index_file)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, node_index):
+        return node_index in self.offsets
+
+    def keys(self):
+        return self.offsets.keys()
+
+    def find(self, name):
+        """Retrieve the node indexes of every node type with a given name.
+        """
+        return list(self.names.get(name, []))
+
+    def rows(self, node_index):
+        """Retrieve the rows naming a node, as lists of values.
+        """
+        out = []
+        with open(self.path, "rb") as in_handle:
+            for offset in self.offsets.get(node_index, []):
+                in_handle.seek(offset)
+                out.append(next(_offset_rows(in_handle))[1])
+        return out
+
+    def row_dicts(self, node_index):
+        """Retrieve the rows naming a node as dictionaries, like iter_assay_rows.
+        """
+        return [self._plan.row(line) for line in self.rows(node_index)]
+
+    def node(self, node_index):
+        """Retrieve a node as StudyAssayParser builds it, from its first row.
+        """
+        rows = self.rows(node_index)
+        if not rows:
+            raise KeyError(node_index)
+        for node_type, col in [(self._plan.header[i], i)
+                               for i in _node_columns(self._s_parser, self._plan)]:
+            if col < len(rows[0]) and build_node_index(node_type, rows[0][col]) == node_index:
+                node = NodeRecord(rows[0][col], node_type)
+                node.metadata = self._plan.keyvals(rows[0], collections.defaultdict(set))
+                return self._s_parser._finalize_metadata(node)
+        raise KeyError(node_index)
+
+
+def _node_columns(s_parser, plan):
+    """Columns holding node names: node columns plus the parser's node types.
+    """
+    cols = set()
+    for index, htype in enumerate(plan.htypes):
+        if htype in ("node", "node_assay"):
+            cols.add(plan.hgroups[index][0])
+    for node_type in s_parser._study_node_types + s_parser._assay_node_types:
+        if node_type in plan.header:
+            cols.add(plan.header.index(node_type))
+    return sorted(cols)
+
+def _offset_rows(in_handle):
+    """Iterate over (byte offset, row) pairs from the current position of a binary handle.
+    Lines end in \n, \r\n or \r, as for the parser. Quoted values spanning
+    lines are joined into a single row.
+    """
+    encoding = None if str is bytes else "utf-8"
+    offset = in_handle.tell()
+    start = offset
+    pending = []
+    quotes = 0
+    for line in (part for line in iter(in_handle.readline, b"")
+                 for part in split_line_ends(line)):
+        if not pending:
+            start = offset
+        offset += len(line)
+        pending.append(line)
+        quotes += line.count(b'"')
+        if quotes % 2:
+            continue
+        text = b"".join(pending)
+        pending = []
+        quotes = 0
+        if encoding is not None:
+            text = text.decode(encoding, "replace")
+        if '"' in text:
+            row = next(csv.reader(io.StringIO(text, newline="") if encoding is not None
+                                  else io.BytesIO(text), dialect="excel-tab"), [])
+        else:
+            text = text.rstrip("\r\n")
+            row = text.split("\t") if text else []
+        yield start, row
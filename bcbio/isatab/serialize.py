@@ -0,0 +1,352 @@
+"""Save parsed ISA-Tab records to a file and load them back without re-parsing.
+dump writes a whole record tree, investigation and study metadata, nodes
+with their Attrs values and process nodes, as a stream of items. Nodes
+and process nodes are written in batches of up to batch_size per item,
+so the output is never built up in memory. Two formats are available:
+  - jsonl -- one JSON object per line, readable by any JSON tool
+  - binary -- each item pickled on its own, smaller on Python 3
+load reads either format back into ISATabRecord objects, re-linking the
+process nodes to their study or assay. Loaded records are not connected
+to their files, so they cannot be passed to update.
+
+Values repeat heavily across nodes, so every distinct value (metadata
+keys, node types, strings, Attrs values and term ids) is written once,
+in a values item just before the first batch using it, and referred to
+by its position in this shared table. Lists of values and node layouts
+(node type and metadata keys) are shared the same way, so a node is
+written as its index, name, layout and one list number per metadata key.
+Loading builds each distinct value once and shares it between nodes, as
+compact parsing does; every node gets its own metadata lists.
+Every Attrs type is written once too, as a list of field names with a
+number; Attrs values refer to it as [number, value, ...]. A term table
+built with parse(terms=True) is written as a list of (source, accession,
+label) triples.
+
+Binary input must be requested with load(..., format="binary"). It is
+read with an unpickler that refuses anything but plain lists, dicts,
+strings and numbers, so loading a file cannot run code; other pickles
+fail with pickle.UnpicklingError.
+"""
+import gc
+import json
+import pickle
+
+from bcbio.isatab.parser import (ISATabRecord, ISATabStudyRecord, ISATabAssayRecord,
+                                 NodeRecord, ProcessNodeRecord, CompactNodeRecord,
+                                 CompactProcessNodeRecord, attrs_record_type)
+from bcbio.isatab.query import AttributeIndex
+from bcbio.isatab.terms import TermTable
+
+# bump when the layout of items changes
+FORMAT_VERSION = 1
+
+_binary_magic = b"ISATAB-PICKLE\n"
+
+# field names of each item kind, used as the keys of JSON objects
+_item_fields = {
+    "isatab": ("version",),
+    "investigation": ("metadata", "ontology_refs", "publications", "contacts"),
+    "terms": ("terms",),
+    "study": ("metadata", "design_descriptors", "publications", "factors",
+              "protocols", "contacts"),
+    "assay": ("metadata", "record"),
+    "attrs": ("id", "fields"),
+    "values": ("values",),
+    "lists": ("lists",),
+    "layouts": ("layouts",),
+    "nodes": ("nodes",),
+    "processes": ("processes",)}
+
+
+def dump(rec, out_handle, format="jsonl", batch_size=1000):
+    """Write a parsed record to a binary file handle, as jsonl or binary.
+    Lazy records are loaded study by study while writing.
+    """
+    if format == "jsonl":
+        writer = _JsonWriter(out_handle)
+    elif format == "binary":
+        writer = _BinaryWriter(out_handle)
+    else:
+        raise ValueError("Unknown serialization format: %s" % format)
+    for item in iter_items(rec, batch_size):
+        writer.write(item)
+
+def iter_items(rec, batch_size=1000):
+    """Iterate over the items describing a record, as (kind, value, ...) tuples.
+    """
+    table = _ValueTable()
+    yield ("isatab", FORMAT_VERSION)
+    yield ("investigation", rec.metadata, rec.ontology_refs, rec.publications, rec.contacts)
+    if "terms" in rec.__dict__:
+        yield ("terms", [list(x) for x in rec.terms.terms])
+    for study in rec.studies:
+        yield ("study", study.metadata, study.design_descriptors, study.publications,
+               study.factors, study.protocols, study.contacts)
+        for item in _iter_node_items(study, table, batch_size):
+            yield item
+        for assay in study.assays:
+            if isinstance(assay, dict):
+                yield ("assay", assay, False)
+                continue
+            yield ("assay", assay.metadata, True)
+            for item in _iter_node_items(assay, table, batch_size):
+                yield item
+
+def _iter_node_items(study_assay, table, batch_size):
+    """Write nodes, then process nodes, in batches preceded by the values they add.
+    """
+    value_id = table.value_id
+    list_id = table.list_id
+    layout_id = table.layout_id
+    batch = []
+    for node_index, node in study_assay.nodes.items():
+        items = list(node.metadata.items())
+        row = [node_index, node.name, layout_id(node.ntype, [key for key, _ in items])]
+        row.extend(list_id(vals) for _, vals in items)
+        batch.append(row)
+        if len(batch) >= batch_size:
+            for item in table.new_items():
+                yield item
+            yield ("nodes", batch)
+            batch = []
+    if batch:
+        for item in table.new_items():
+            yield item
+        yield ("nodes", batch)
+        batch = []
+    for node_index, node in study_assay.process_nodes.items():
+        batch.append([node_index, node.name, value_id(node.ntype),
+                      list(node.inputs), list(node.outputs)])
+        if len(batch) >= batch_size:
+            for item in table.new_items():
+                yield item
+            yield ("processes", batch)
+            batch = []
+    if batch:
+        for item in table.new_items():
+            yield item
+        yield ("processes", batch)
+
+
+class _ValueTable:
+    """Distinct values written so far, numbered in order of first use.
+    Values are keyed with their type, so equal Attrs tuples of different
+    columns keep their own field names.
+    """
+    def __init__(self):
+        self._ids = {}
+        self._attrs_ids = {}
+        self._list_ids = {}
+        self._layout_ids = {}
+        self._new_values = []
+        self._new_attrs = []
+        self._new_lists = []
+        self._new_layouts = []
+
+    def list_id(self, vals):
+        """Number a list of values, adding it to the lists to write if new.
+        """
+        key = tuple(self.value_id(val) for val in vals)
+        try:
+            return self._list_ids[key]
+        except KeyError:
+            self._new_lists.append(list(key))
+            list_id = self._list_ids[key] = len(self._list_ids)
+            return list_id
+
+    def layout_id(self, ntype, keys):
+        """Number a node type and metadata keys, adding them to the layouts if new.
+        """
+        key = tuple(self.value_id(x) for x in [ntype] + keys)
+        try:
+            return self._layout_ids[key]
+        except KeyError:
+            self._new_layouts.append(list(key))
+            layout_id = self._layout_ids[key] = len(self._layout_ids)
+            return layout_id
+
+    def value_id(self, val):
+        key = (val.__class__, val)
+        try:
+            return self._ids[key]
+        except KeyError:
+            pass
+        if isinstance(val, tuple):
+            fields = val._fields
+            attrs_id = self._attrs_ids.get(fields)
+            if attrs_id is None:
+                attrs_id = self._attrs_ids[fields] = len(self._attrs_ids)
+                self._new_attrs.append(("attrs", attrs_id, list(fields)))
+            out = [attrs_id] + list(val)
+        else:
+            out = val
+        value_id = self._ids[key] = len(self._ids)
+        self._new_values.append(out)
+        return value_id
+
+    def new_items(self):
+        """Retrieve items declaring what was added since the last call.
+        Items declare new Attrs types, then new values, lists and layouts.
+        """
+        items = self._new_attrs
+        for kind, new in [("values", self._new_values), ("lists", self._new_lists),
+                          ("layouts", self._new_layouts)]:
+            if new:
+                items.append((kind, new))
+        self._new_attrs = []
+        self._new_values = []
+        self._new_lists = []
+        self._new_layouts = []
+        return items
+
+
+def load(in_handle, compact=False, attribute_index=False, format="jsonl", pause_gc=True):
+    """Read a record written by dump from a binary file handle.
+    format must match the format written: binary input is only read with
+    format="binary", through an unpickler limited to plain values. compact
+    and attribute_index build nodes and indexes like the options of parse.
+    Cyclic garbage collection is switched off until loading is done, as it
+    otherwise takes most of the time on large records, and switched back
+    on afterwards if it was on before. This affects the whole process, so
+    pass pause_gc=False when another thread turns collection on or off
+    meanwhile.
+    """
+    if not pause_gc or not gc.isenabled():
+        return _load(in_handle, compact, attribute_index, format)
+    gc.disable()
+    try:
+        return _load(in_handle, compact, attribute_index, format)
+    finally:
+        gc.enable()
+
+def _load(in_handle, compact, attribute_index, format):
+    node_class = CompactNodeRecord if compact else NodeRecord
+    process_class = CompactProcessNodeRecord if compact else ProcessNodeRecord
+    attrs_types = {}
+    values = []
+    lists = []
+    layouts = []
+    rec = None
+    study_assay = None
+    owners = []
+    for item in _read_items(in_handle, format):
+        kind = item[0]
+        if kind == "nodes":
+            nodes = study_assay.nodes
+            get_list = lists.__getitem__
+            for row in item[1]:
+                ntype, keys = layouts[row[2]]
+                node = node_class(row[1], ntype)
+                node.metadata = dict(zip(keys, map(list, map(get_list, row[3:]))))
+                nodes[row[0]] = node
+        elif kind == "processes":
+            process_nodes = study_assay.process_nodes
+            for node_index, name, ntype_id, inputs, outputs in item[1]:
+                node = process_class(name, values[ntype_id], study_assay)
+                node.inputs = inputs
+                node.outputs = outputs
+                process_nodes[node_index] = node
+        elif kind == "values":
+            values.extend(attrs_types[val[0]](*val[1:]) if isinstance(val, list) else val
+                          for val in item[1])
+        elif kind == "lists":
+            get_value = values.__getitem__
+            lists.extend(tuple(map(get_value, ids)) for ids in item[1])
+        elif kind == "layouts":
+            layouts.extend((values[ids[0]], [values[i] for i in ids[1:]]) for ids in item[1])
+        elif kind == "attrs":
+            attrs_types[item[1]] = attrs_record_type(item[2])
+        elif kind == "assay":
+            if item[2]:
+                study_assay = ISATabAssayRecord(item[1])
+                owners.append(study_assay)
+                rec.studies[-1].assays.append(study_assay)
+            else:
+                rec.studies[-1].assays.append(item[1])
+        elif kind == "study":
+            study_assay = ISATabStudyRecord()
+            (_, study_assay.metadata, study_assay.design_descriptors, study_assay.publications,
+             study_assay.factors, study_assay.protocols, study_assay.contacts) = item
+            owners.append(study_assay)
+            rec.studies.append(study_assay)
+        elif kind == "terms":
+            rec.terms = TermTable(rec.ontology_refs)
+            for term in item[1]:
+                rec.terms.add(*term)
+        elif kind == "investigation":
+            rec = ISATabRecord()
+            _, rec.metadata, rec.ontology_refs, rec.publications, rec.contacts = item
+        elif kind == "isatab":
+            if item[1] != FORMAT_VERSION:
+                raise ValueError("Unsupported serialization version: %s" % item[1])
+        else:
+            raise ValueError("Unexpected item in serialized record: %s" % kind)
+    if rec is None:
+        raise ValueError("No ISA-Tab record found in serialized input")
+    if attribute_index:
+        for owner in owners:
+            owner.attribute_index = AttributeIndex.from_nodes(owner.nodes,
+                                                              rec.__dict__.get("terms"))
+    return rec
+
+def _read_items(in_handle, format):
+    start = in_handle.read(len(_binary_magic))
+    if format == "binary":
+        if start != _binary_magic:
+            raise ValueError("Input is not a binary serialized record")
+        while 1:
+            # a new unpickler per item, as each was pickled with its own memo
+            try:
+                yield _plain_unpickler(in_handle).load()
+            except EOFError:
+                break
+    elif format == "jsonl":
+        if start == _binary_magic:
+            raise ValueError("Input is a binary serialized record; load it with format='binary'")
+        line = start + in_handle.readline()
+        while line:
+            if line.strip():
+                obj = json.loads(line.decode("utf-8"))
+                kind = obj["t"]
+                yield (kind,) + tuple(obj[x] for x in _item_fields[kind])
+            line = in_handle.readline()
+    else:
+        raise ValueError("Unknown serialization format: %s" % format)
+
+def _plain_unpickler(in_handle):
+    """Unpickler for binary items, refusing to load any class or function.
+    """
+    if str is bytes:
+        import cPickle
+        unpickler = cPickle.Unpickler(in_handle)
+        unpickler.find_global = _refuse_global
+        return unpickler
+    return _PlainUnpickler(in_handle)
+
+def _refuse_global(module, name):
+    raise pickle.UnpicklingError("Serialized records hold only plain values, not %s.%s"
+                                 % (module, name))
+
+class _PlainUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        _refuse_global(module, name)
+
+
+class _JsonWriter:
+    def __init__(self, out_handle):
+        self._handle = out_handle
+
+    def write(self, item):
+        obj = dict(zip(_item_fields[item[0]], item[1:]))
+        obj["t"] = item[0]
+        self._handle.write(json.dumps(obj, separators=(",", ":")).encode("utf-8") + b"\n")
+
+
+class _BinaryWriter:
+    def __init__(self, out_handle):
+        out_handle.write(_binary_magic)
+        self._handle = out_handle
+
+    def write(self, item):
+        # items hold only plain values, so they load without finding classes
+        pickle.dump(item, self._handle, pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,127 @@
+"""Timing and size statistics collected while parsing ISA-Tab.
+Pass a ParseStats object to bcbio.isatab.parse to find out where a slow
+parse spends its time. It records wall time for the phases of the parse
+(finding the investigation file, reading it, reading study and assay
+files) and, for every file read, its size, the bytes actually read, rows,
+nodes and process nodes created, time spent building the process graph and
+whether the result came from a ParseCache. A callback receives each file
+as it finishes. Without a ParseStats object nothing is measured.
+"""
+import os
+import time
+import collections
+import contextlib
+
+clock = getattr(time, "perf_counter", time.time)
+
+
+class ParseStats:
+    """Collect phase timings and per-file statistics for parses.
+      - phases -- seconds spent in each phase of parse, by name
+      - files -- dictionary of statistics for every file read, in order
+      - callback -- optional function called with each file dictionary
+    """
+    def __init__(self, callback=None):
+        self.phases = collections.OrderedDict()
+        self.files = []
+        self.callback = callback
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a block of work, adding to the total for a named phase.
+        """
+        start = clock()
+        try:
+            yield self
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + clock() - start
+
+    def add_file(self, path, kind, seconds, rows=None, nodes=None, process_nodes=None,
+                 process_seconds=None, cached=False, bytes_read=None):
+        """Record statistics for one investigation, study or assay file.
+        file_bytes is the size of the file on disk; bytes_read defaults to
+        none for cached results and the whole file otherwise.
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        if bytes_read is None:
+            bytes_read = 0 if cached else size
+        info = {"path": path, "kind": kind, "seconds": seconds, "file_bytes": size,
+                "bytes_read": bytes_read,
+                "rows": rows, "nodes": nodes, "process_nodes": process_nodes,
+                "process_seconds": process_seconds, "cached": cached}
+        self.add(info)
+        return info
+
+    def add(self, info):
+        """Record a file dictionary, as built by add_file in this or another process.
+        """
+        self.files.append(info)
+        if self.callback is not None:
+            self.callback(info)
+
+    def totals(self):
+        """Summarize files by kind: count, seconds, bytes, rows, nodes and cache hits.
+        """
+        out = collections.OrderedDict()
+        for info in self.files:
+            cur = out.setdefault(info["kind"], collections.OrderedDict(
+                [("files", 0), ("cache_hits", 0), ("seconds", 0.0), ("process_seconds", 0.0),
+                 ("file_bytes", 0), ("bytes_read", 0), ("rows", 0), ("nodes", 0),
+                 ("process_nodes", 0)]))
+            cur["files"] += 1
+            cur["cache_hits"] += 1 if info["cached"] else 0
+            for key in ["seconds", "process_seconds", "file_bytes", "bytes_read", "rows", "nodes",
+                        "process_nodes"]:
+                cur[key] += info[key] or 0
+        return out
+
+    def as_dict(self):
+        """Retrieve all statistics as plain dictionaries and lists.
+        """
+        return {"phases": dict(self.phases), "files": [dict(x) for x in self.files],
+                "totals": dict((k, dict(v)) for k, v in self.totals().items())}
+
+    def to_json(self, **kwargs):
+        import json
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def __str__(self):
+        lines = ["%-14s %9.3fs" % (name, secs) for name, secs in self.phases.items()]
+        for kind, cur in self.totals().items():
+            lines.append("%-14s %9.3fs %5s files %5s cached %10s rows %10s nodes" %
+                         (kind, cur["seconds"], cur["files"], cur["cache_hits"],
+                          cur["rows"], cur["nodes"]))
+        return "\n".join(lines)
+
+
+class TimedCall:
+    """Wrap a function, adding up the time spent in calls to it.
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.seconds = 0.0
+
+    def __call__(self, *args):
+        start = clock()
+        try:
+            return self.fn(*args)
+        finally:
+            self.seconds += clock() - start
+
+
+class _NullPhase:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        return False
+
+_null_phase = _NullPhase()
+
+def phase(stats, name):
+    """Time a named phase on stats, or do nothing when stats is None.
+    """
+    return stats.phase(name) if stats is not None else _null_phase
@@ -0,0 +1,312 @@
+"""Keep parsed nodes in an SQLite database instead of in memory.
+Parsing with a NodeStorage passed as storage replaces the nodes and
+process_nodes dictionaries of every study and assay by NodeStore objects.
+These behave like the dictionaries, in the same order, but keep each node
+pickled in a database file. Only the most recently used nodes are held in
+memory, up to cache_bytes of pickled data shared by all stores of the
+storage.
+
+Memory is bounded for stored nodes, not for a whole parse. Serial scans
+without a cache write nodes to the database as they are found, but still
+keep, for the file being scanned:
+  - the index of every node found, to skip rows repeating a node
+  - the process nodes and the process graph builder, which are stored
+    once the file has been read
+Scans through a ParseCache or in worker processes hold the nodes of a
+whole file in memory before storing them. Peak memory therefore still
+grows with the largest study or assay file, though not with the number
+of files.
+
+A NodeStorage with a path keeps its database file when closed. Opening
+it again with the same path gives back each store by its store_id
+through open_store; store_ids lists them.
+A node read from a store stays the same object while it is cached, and
+changes made to it are written back when it leaves the cache. Process
+nodes are stored without their study_assay, which is set back to the
+owning record when they are loaded.
+"""
+import os
+import pickle
+import sqlite3
+import weakref
+import tempfile
+import threading
+import collections
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+_create_sql = ["CREATE TABLE IF NOT EXISTS nodes (store INTEGER, key TEXT, grp INTEGER, "
+               "seq INTEGER, value BLOB, PRIMARY KEY (store, key))",
+               "CREATE INDEX IF NOT EXISTS nodes_order ON nodes (store, grp, seq)"]
+
+# rows written between commits
+_commit_every = 10000
+
+
+class NodeStorage:
+    """SQLite database holding the nodes of studies and assays, with a shared cache.
+      - path -- database file, kept by close() and reopened with its stores;
+        a temporary file removed by close() by default
+      - cache_bytes -- memory budget for cached nodes, in pickled bytes
+    """
+    def __init__(self, path=None, cache_bytes=64 * 1024 * 1024, page_size=1000):
+        self._remove = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix=".isanodes")
+            os.close(fd)
+        self.path = path
+        self.cache_bytes = cache_bytes
+        self.page_size = page_size
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.text_factory = str
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        for sql in _create_sql:
+            self._conn.execute(sql)
+        row = self._conn.execute("SELECT MAX(store) FROM nodes").fetchone()
+        self._next_store = (row[0] + 1) if row[0] is not None else 0
+        self._lock = threading.RLock()
+        # (store id, key) -> (store, node, pickled data), least recently used first
+        self._cache = collections.OrderedDict()
+        self._cached_bytes = 0
+        self._writes = 0
+
+    def node_store(self, owner=None):
+        """Create an empty NodeStore; owner becomes the study_assay of loaded process nodes.
+        """
+        with self._lock:
+            store_id = self._next_store
+            self._next_store += 1
+        return NodeStore(self, store_id, owner)
+
+    def open_store(self, store_id, owner=None):
+        """Reopen a NodeStore with nodes in the database, continuing its order.
+        """
+        with self._lock:
+            row = self._execute("SELECT MAX(grp), MAX(seq) FROM nodes WHERE store=?",
+                                (store_id,)).fetchone()
+        if row[1] is None:
+            raise KeyError("No nodes stored for NodeStore %s in %s" % (store_id, self.path))
+        store = NodeStore(self, store_id, owner)
+        store._last_group, store._seq = row
+        return store
+
+    def store_ids(self):
+        """List the ids of stores with nodes in the database.
+        """
+        with self._lock:
+            return [row[0] for row in
+                    self._execute("SELECT DISTINCT store FROM nodes ORDER BY store")]
+
+    def store_nodes(self, nodes, owner=None):
+        """Move a dictionary of nodes into a new NodeStore, keeping their order.
+        """
+        store = self.node_store(owner)
+        for node_index, node in nodes.items():
+            store.add(node_index, node)
+        return store
+
+    def flush(self):
+        """Write back changed cached nodes and commit to the database file.
+        """
+        with self._lock:
+            for (_, node_index), (store, node, data) in list(self._cache.items()):
+                store._write_back(node_index, node, data)
+            self._conn.commit()
+
+    def close(self):
+        """Close the database, removing it if it is a temporary file.
+        Changes to a database file given as path are written first.
+        """
+        with self._lock:
+            if not self._remove:
+                self.flush()
+            self._cache.clear()
+            self._cached_bytes = 0
+            self._conn.close()
+            if self._remove and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _execute(self, sql, args=()):
+        cursor = self._conn.execute(sql, args)
+        if not sql.startswith("SELECT"):
+            self._writes += 1
+            if self._writes >= _commit_every:
+                self._conn.commit()
+                self._writes = 0
+        return cursor
+
+    def _cache_add(self, store, key, node, data):
+        cache_key = (store.store_id, key)
+        old = self._cache.pop(cache_key, None)
+        if old is not None:
+            self._cached_bytes -= len(old[2])
+        self._cache[cache_key] = (store, node, data)
+        self._cached_bytes += len(data)
+        while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+            (_, old_key), (old_store, old_node, old_data) = self._cache.popitem(last=False)
+            self._cached_bytes -= len(old_data)
+            old_store._write_back(old_key, old_node, old_data)
+
+    def _cache_drop(self, store, key=None):
+        if key is not None:
+            keys = [(store.store_id, key)]
+        else:
+            keys = [k for k in self._cache if k[0] == store.store_id]
+        for cache_key in keys:
+            old = self._cache.pop(cache_key, None)
+            if old is not None:
+                self._cached_bytes -= len(old[2])
+
+
+class NodeStore(MutableMapping):
+    """Dictionary of node index to node kept in a NodeStorage database.
+    """
+    def __init__(self, storage, store_id, owner=None):
+        self.storage = storage
+        self.store_id = store_id
+        # the owner holds this store, so it is referred to weakly
+        self._owner = weakref.ref(owner) if owner is not None else None
+        self._seq = 0
+        self._last_group = 0
+
+    @property
+    def owner(self):
+        return self._owner() if self._owner is not None else None
+
+    def add(self, node_index, node, group=0):
+        """Write a new node without caching it, ordered by group, then by addition.
+        """
+        with self.storage._lock:
+            self._seq += 1
+            self._last_group = max(self._last_group, group)
+            self.storage._execute("INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?)",
+                                  (self.store_id, node_index, group, self._seq,
+                                   sqlite3.Binary(self._dumps(node))))
+            self.storage._cache_drop(self, node_index)
+
+    def __getitem__(self, node_index):
+        storage = self.storage
+        with storage._lock:
+            cache_key = (self.store_id, node_index)
+            try:
+                entry = storage._cache.pop(cache_key)
+                storage._cache[cache_key] = entry
+                return entry[1]
+            except KeyError:
+                pass
+            row = storage._execute("SELECT value FROM nodes WHERE store=? AND key=?",
+                                   (self.store_id, node_index)).fetchone()
+            if row is None:
+                raise KeyError(node_index)
+            return self._cached(node_index, bytes(row[0]))
+
+    def __setitem__(self, node_index, node):
+        with self.storage._lock:
+            data = self._dumps(node)
+            cursor = self.storage._execute(
+                "UPDATE nodes SET value=? WHERE store=? AND key=?",
+                (sqlite3.Binary(data), self.store_id, node_index))
+            if cursor.rowcount == 0:
+                # new nodes go last, as in a dictionary
+                self._seq += 1
+                self.storage._execute("INSERT INTO nodes VALUES (?, ?, ?, ?, ?)",
+                                      (self.store_id, node_index, self._last_group,
+                                       self._seq, sqlite3.Binary(data)))
+            self.storage._cache_add(self, node_index, node, data)
+
+    def __delitem__(self, node_index):
+        with self.storage._lock:
+            cursor = self.storage._execute("DELETE FROM nodes WHERE store=? AND key=?",
+                                           (self.store_id, node_index))
+            self.storage._cache_drop(self, node_index)
+            if cursor.rowcount == 0:
+                raise KeyError(node_index)
+
+    def __contains__(self, node_index):
+        with self.storage._lock:
+            if (self.store_id, node_index) in self.storage._cache:
+                return True
+            return self.storage._execute("SELECT 1 FROM nodes WHERE store=? AND key=?",
+                                         (self.store_id, node_index)).fetchone() is not None
+
+    def __len__(self):
+        with self.storage._lock:
+            return self.storage._execute("SELECT COUNT(*) FROM nodes WHERE store=?",
+                                         (self.store_id,)).fetchone()[0]
+
+    def __iter__(self):
+        for node_index, _ in self._pages("key, NULL"):
+            yield node_index
+
+    def items(self):
+        """Iterate over (node index, node) pairs, reading the database a page at a time.
+        """
+        storage = self.storage
+        for node_index, data in self._pages("key, value"):
+            with storage._lock:
+                entry = storage._cache.get((self.store_id, node_index))
+                node = entry[1] if entry is not None else self._cached(node_index, bytes(data))
+            yield node_index, node
+
+    def values(self):
+        for _, node in self.items():
+            yield node
+
+    def keys(self):
+        return iter(self)
+
+    def clear(self):
+        """Remove all nodes of the store from the database.
+        """
+        with self.storage._lock:
+            self.storage._execute("DELETE FROM nodes WHERE store=?", (self.store_id,))
+            self.storage._cache_drop(self)
+
+    def _pages(self, columns):
+        """Read rows in order, a page at a time, resuming after the last row read.
+        """
+        sql = ("SELECT %s, grp, seq FROM nodes WHERE store=? AND (grp > ? OR (grp = ? AND "
+               "seq > ?)) ORDER BY grp, seq LIMIT ?" % columns)
+        grp, seq = -1, -1
+        while 1:
+            with self.storage._lock:
+                rows = self.storage._execute(sql, (self.store_id, grp, grp, seq,
+                                                   self.storage.page_size)).fetchall()
+            for row in rows:
+                yield row[0], row[1]
+            if len(rows) < self.storage.page_size:
+                break
+            grp, seq = rows[-1][2], rows[-1][3]
+
+    def _cached(self, node_index, data):
+        node = pickle.loads(data)
+        owner = self.owner
+        if owner is not None and hasattr(node, "study_assay"):
+            node.study_assay = owner
+        self.storage._cache_add(self, node_index, node, data)
+        return node
+
+    def _write_back(self, node_index, node, data):
+        """Store a node leaving the cache again if it changed since it was read.
+        """
+        new_data = self._dumps(node)
+        if new_data != data:
+            self.storage._execute("UPDATE nodes SET value=? WHERE store=? AND key=?",
+                                  (sqlite3.Binary(new_data), self.store_id, node_index))
+
+    def _dumps(self, node):
+        # process nodes are stored without their owner, set again on loading
+        owner = getattr(node, "study_assay", None)
+        if owner is not None:
+            node.study_assay = None
+        try:
+            return pickle.dumps(node, pickle.HIGHEST_PROTOCOL)
+        finally:
+            if owner is not None:
+                node.study_assay = owner
+
+    def __repr__(self):
+        return "<NodeStore %s: %s nodes>" % (self.store_id, len(self))
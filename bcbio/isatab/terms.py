@@ -0,0 +1,130 @@
+"""Shared table of ontology terms used by the nodes of an investigation.
+Characteristics, Factor Values and other attributes annotated with an
+ontology are parsed into Attrs tuples holding the term label, its Term
+Source REF and its Term Accession Number, repeated for every node using
+the term. A TermTable collects the distinct (source, accession, label)
+triples of a whole investigation once, and can replace these Attrs values
+in node metadata by integer term ids, so equal terms are stored once and
+compared as integers. Values with neither a Term Source REF nor a Term
+Accession Number are plain labels and are left as they are. Term sources
+resolve to the ONTOLOGY SOURCE REFERENCE entries of the investigation.
+Parsing with terms=True builds the table as rec.terms and encodes every
+study and assay.
+"""
+import copy
+import collections
+
+Term = collections.namedtuple("Term", ["source", "accession", "label"])
+
+# qualifier fields of a term attribute, sorted
+_term_fields = ("Term_Accession_Number", "Term_Source_REF")
+
+
+class TermTable:
+    """Distinct ontology terms of an investigation, numbered from 0.
+      - terms -- list of Term tuples, indexed by term id
+      - ontology_refs -- ontology source references of the investigation
+    """
+    def __init__(self, ontology_refs=None):
+        self.terms = []
+        self.ontology_refs = ontology_refs or []
+        self._ids = {}
+
+    @classmethod
+    def from_record(cls, rec, encode=True):
+        """Collect the terms of every study and assay of an ISATabRecord.
+        With encode, term attributes in node metadata are replaced by term ids.
+        """
+        table = cls(rec.ontology_refs)
+        table.encode_record(rec, replace=encode)
+        return table
+
+    def add(self, source, accession, label):
+        """Retrieve the id of a term, adding it to the table if new.
+        """
+        key = (source, accession, label)
+        try:
+            return self._ids[key]
+        except KeyError:
+            term_id = self._ids[key] = len(self.terms)
+            self.terms.append(Term(source, accession, label))
+            return term_id
+
+    def term_id(self, value):
+        """Retrieve the term id for an Attrs value annotated with an ontology term.
+        Returns None for values that are not a label with a Term Source REF
+        and Term Accession Number, or that leave both of them blank.
+        """
+        if not is_term_attrs(value):
+            return None
+        return self.add(value.Term_Source_REF, value.Term_Accession_Number, value[0])
+
+    def encode_record(self, rec, replace=True):
+        """Add the terms of all studies and assays, replacing them by ids if replace is set.
+        """
+        for study in rec.studies:
+            for record in [study] + list(study.assays):
+                self.encode_nodes(getattr(record, "nodes", None) or {}, replace)
+        return rec
+
+    def encode_nodes(self, nodes, replace=True):
+        """Add the terms of a dictionary of nodes, replacing them by ids if replace is set.
+        Nodes with terms are replaced in the dictionary by copies with new
+        metadata, so node objects shared with other records are unchanged
+        and NodeStore dictionaries write the encoded nodes back. Values
+        already replaced by ids are left unchanged.
+        """
+        for node_index, node in nodes.items():
+            metadata = {}
+            for key, vals in node.metadata.items():
+                term_ids = [self.term_id(val) for val in vals]
+                if replace and any(term_id is not None for term_id in term_ids):
+                    metadata[key] = [val if term_id is None else term_id
+                                     for val, term_id in zip(vals, term_ids)]
+            if metadata:
+                new_node = copy.copy(node)
+                new_node.metadata = dict(node.metadata)
+                new_node.metadata.update(metadata)
+                nodes[node_index] = new_node
+
+    def term(self, term_id):
+        return self.terms[term_id]
+
+    def label(self, term_id):
+        return self.terms[term_id].label
+
+    def source(self, term_id):
+        """Retrieve the ontology source reference dictionary of a term, or None.
+        """
+        source = self.terms[term_id].source
+        for ref in self.ontology_refs:
+            if ref.get("Term Source Name") == source:
+                return ref
+        return None
+
+    def find(self, label=None, source=None, accession=None):
+        """Retrieve the ids of terms matching all given label, source and accession.
+        """
+        return set(term_id for term_id, term in enumerate(self.terms)
+                   if (label is None or term.label == label) and
+                   (source is None or term.source == source) and
+                   (accession is None or term.accession == accession))
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __getstate__(self):
+        return {"terms": [tuple(x) for x in self.terms], "ontology_refs": self.ontology_refs}
+
+    def __setstate__(self, state):
+        self.__init__(state["ontology_refs"])
+        for term in state["terms"]:
+            self.add(*term)
+
+def is_term_attrs(value):
+    """Check for an Attrs value made of a label, Term Source REF and Term Accession Number.
+    At least one of the Term Source REF and Term Accession Number is filled in.
+    """
+    return isinstance(value, tuple) and len(value) == 3 and \
+        tuple(sorted(getattr(value, "_fields", ())[1:])) == _term_fields and \
+        bool(value.Term_Source_REF or value.Term_Accession_Number)
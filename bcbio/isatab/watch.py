@@ -0,0 +1,217 @@
+"""Keep a parsed ISA-Tab investigation in sync with its files.
+A Watcher parses an investigation once and keeps the ISATabRecord in
+memory. Each poll compares the size and modification time of the
+investigation, study and assay files with those seen at the last load.
+When only study or assay files changed, just those files are parsed
+again; a change to the investigation file, or to a study file that had
+no nodes, parses everything again.
+Reloads never modify the current record. A new ISATabRecord is built,
+with copies of the studies and assays whose files did not change, which
+reuse their node objects, and replaces the record in a single
+assignment, so a reader holding watcher.record always sees one
+consistent tree. Polls run on request, or every interval seconds in a
+background thread started with start().
+"""
+import os
+import copy
+import time
+import threading
+import collections
+
+from bcbio.isatab.parser import (ISATabRecord, ISATabStudyRecord, ISATabAssayRecord,
+                                 StudyAssayParser, _find_investigation, _read_investigation)
+from bcbio.isatab.stats import clock
+
+class ReloadEvent:
+    """A reload of changed files by a Watcher.
+      - paths -- changed files, as absolute paths
+      - full -- True if the whole investigation was parsed again
+      - seconds -- time spent checking files and building the new record
+      - time -- when the new record was put in place, as time.time()
+    """
+    def __init__(self, paths, full, seconds, time):
+        self.paths = paths
+        self.full = full
+        self.seconds = seconds
+        self.time = time
+
+    def __repr__(self):
+        return "ReloadEvent(%d files, full=%s, %.3fs)" % (len(self.paths), self.full,
+                                                         self.seconds)
+
+
+class Watcher:
+    """Parsed ISA-Tab investigation reloaded when its files change.
+      - record -- current ISATabRecord; replaced, never modified, by reloads
+      - reloads -- most recent ReloadEvent objects, oldest first
+      - error -- exception raised by the last failed background poll, or None
+      - callback -- optional function called with each ReloadEvent
+    cache, compact, use_mmap and attribute_index work as for parse.
+    """
+    def __init__(self, isatab_ref, interval=1.0, callback=None, cache=None, compact=False,
+                 use_mmap=False, attribute_index=False, history=100):
+        self.isatab_ref = os.path.abspath(_find_investigation(isatab_ref))
+        self.interval = interval
+        self.callback = callback
+        self.reloads = collections.deque(maxlen=history)
+        self.error = None
+        self._parser_args = (cache, compact, None, use_mmap, attribute_index)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._fingerprints = {}
+        self.record = None
+        with self._lock:
+            self.record = self._parse_all()
+
+    def poll(self):
+        """Reload files changed since the last load.
+        Returns a ReloadEvent, or None if nothing changed. If parsing fails
+        the record is left as it was, and the files are read again on the
+        next poll.
+        """
+        with self._lock:
+            start = clock()
+            current = dict((path, _stat_fingerprint(path)) for path in self._fingerprints)
+            changed = sorted(path for path, fingerprint in current.items()
+                             if fingerprint != self._fingerprints[path])
+            if not changed:
+                return None
+            full = self.isatab_ref in changed
+            record = None if full else self._reload_tables(set(changed), current)
+            if record is None:
+                full = True
+                record = self._parse_all()
+            self.record = record
+            event = ReloadEvent(changed, full, clock() - start, time.time())
+            self.reloads.append(event)
+        if self.callback is not None:
+            self.callback(event)
+        return event
+
+    def start(self):
+        """Poll every interval seconds in a background thread until stop() is called.
+        """
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="isatab-watcher")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the background thread, waiting for a running poll to finish.
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+                self.error = None
+            except Exception as e:
+                self.error = e
+
+    def _new_parser(self):
+        return StudyAssayParser(self.isatab_ref, *self._parser_args)
+
+    def _parse_all(self):
+        """Parse the whole investigation, recording fingerprints of all its files.
+        Fingerprints are taken before reading, so a file written during the
+        parse is seen as changed on the next poll.
+        """
+        fingerprints = {self.isatab_ref: _stat_fingerprint(self.isatab_ref)}
+        rec = _read_investigation(self.isatab_ref, self._parser_args[0])
+        s_parser = self._new_parser()
+        for _, fname, _ in s_parser._table_jobs(rec):
+            path = os.path.abspath(os.path.join(s_parser._dir, fname))
+            fingerprints[path] = _stat_fingerprint(path)
+        rec = s_parser.parse(rec)
+        self._fingerprints = fingerprints
+        return rec
+
+    def _reload_tables(self, changed, fingerprints):
+        """Build a new record with changed study and assay files parsed again.
+        Returns None when a full parse is needed instead: a changed study
+        file without a study in the record, or one that no longer has nodes.
+        """
+        s_parser = self._new_parser()
+        path_of = lambda fname: os.path.abspath(os.path.join(s_parser._dir, fname))
+        seen = set()
+        rec = ISATabRecord()
+        rec.__dict__.update(self.record.__dict__)
+        rec.studies = []
+        for old_study in self.record.studies:
+            study_path = path_of(old_study.metadata["Study File Name"])
+            seen.add(study_path)
+            study = ISATabStudyRecord()
+            study.__dict__.update(old_study.__dict__)
+            if study_path in changed:
+                nodes, process_nodes = s_parser._scan_cached(
+                    old_study.metadata["Study File Name"], s_parser._study_node_types, study)
+                if not nodes:
+                    return None
+                study.nodes = nodes
+                study.process_nodes = process_nodes if process_nodes is not None else {}
+            else:
+                _rehome(old_study, study)
+            study.assays = []
+            for old_assay in old_study.assays:
+                fname = old_assay.metadata["Study Assay File Name"]
+                seen.add(path_of(fname))
+                if path_of(fname) in changed:
+                    assay = ISATabAssayRecord(old_assay.metadata)
+                    assay.nodes, process_nodes = s_parser._scan_cached(
+                        fname, s_parser._assay_node_types, assay)
+                    if process_nodes is not None:
+                        assay.process_nodes = process_nodes
+                    study.assays.append(assay)
+                else:
+                    assay = ISATabAssayRecord()
+                    assay.__dict__.update(old_assay.__dict__)
+                    _rehome(old_assay, assay)
+                    study.assays.append(assay)
+            rec.studies.append(study)
+        if changed - seen:
+            return None
+        self._fingerprints.update((path, fingerprints[path]) for path in changed)
+        return rec
+
+def _rehome(old, owner):
+    """Give a copied study or assay record its own nodes, process nodes and parse state.
+    Node objects are reused, in a new dictionary, and process nodes are
+    copied for the new owner. The parse state is copied, and updates build
+    new process nodes, so merging rows into either record leaves the other
+    unchanged.
+    """
+    if isinstance(old.nodes, dict):
+        owner.nodes = dict(old.nodes)
+    state = getattr(old, "_table_state", None)
+    if state is not None:
+        owner._table_state = copy.copy(state)
+    out = {}
+    for node_index, process_node in old.process_nodes.items():
+        new_node = process_node.__class__(process_node.name, process_node.ntype, owner)
+        new_node.inputs = list(process_node.inputs)
+        new_node.outputs = list(process_node.outputs)
+        out[node_index] = new_node
+    owner.process_nodes = out
+
+def _stat_fingerprint(path):
+    """Identify the state of a file by size and modification time; None if missing.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
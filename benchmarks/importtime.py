@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Time importing bcbio.isatab in fresh interpreters.
+Each repeat starts a new Python process that imports the bcbio namespace
+package, then bcbio.isatab, then the parser through bcbio.isatab.parse,
+and reports the best time of each step along with the modules the
+bcbio.isatab import loaded. The namespace package is declared through
+pkg_resources and is timed on its own, since other bcbio distributions
+share it. Importing bcbio.isatab should not load the parser or heavy
+standard library modules; --check exits with an error if it does, or if
+the import takes longer than --max-ms.
+
+Usage:
+    importtime.py [--repeat 10] [--check] [--max-ms 50] [--json]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# modules that a plain import of the package should leave unloaded
+heavy_modules = ["bcbio.isatab.parser", "pprint", "csv", "glob", "mmap", "sqlite3"]
+
+_probe = """
+import sys, time, json
+start = time.time()
+import bcbio
+namespace = time.time() - start
+before = set(sys.modules)
+start = time.time()
+import bcbio.isatab
+package = time.time() - start
+loaded = sorted(set(sys.modules) - before)
+start = time.time()
+bcbio.isatab.parse
+parser = time.time() - start
+print(json.dumps({"namespace": namespace, "package": package, "parser": parser,
+                  "loaded": loaded}))
+"""
+
+
+def main(args):
+    runs = [_probe_run() for _ in range(args.repeat)]
+    loaded = runs[0]["loaded"]
+    report = {"python": sys.version.split()[0],
+              "namespace_ms": min(r["namespace"] for r in runs) * 1000.0,
+              "package_ms": min(r["package"] for r in runs) * 1000.0,
+              "parser_ms": min(r["parser"] for r in runs) * 1000.0,
+              "modules": len(loaded),
+              "heavy": [m for m in heavy_modules if m in loaded]}
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print("import bcbio          %8.2f ms" % report["namespace_ms"])
+        print("import bcbio.isatab   %8.2f ms  %4s modules" % (report["package_ms"],
+                                                             report["modules"]))
+        print("bcbio.isatab.parse    %8.2f ms" % report["parser_ms"])
+        if report["heavy"]:
+            print("loaded by package import: %s" % ", ".join(report["heavy"]))
+    if args.check and (report["heavy"] or report["package_ms"] > args.max_ms):
+        sys.exit(1)
+
+def _probe_run():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([root_dir] + [x for x in [env.get("PYTHONPATH")] if x])
+    out = subprocess.check_output([sys.executable, "-c", _probe], env=env)
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--check", action="store_true",
+                        help="Fail if the import loads heavy modules or exceeds --max-ms")
+    parser.add_argument("--max-ms", type=float, default=50.0)
+    parser.add_argument("--json", action="store_true", help="Report as JSON")
+    main(parser.parse_args())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Compare memory used by standard and compact parsing of study and assay files.
+The study and assay files of the BII-I-1 and BII-S-3 test examples are
+scaled up by repeating their rows with distinct node names, then parsed
+with StudyAssayParser with and without compact=True. Reports memory held
+by the parsed records, with their nodes, process nodes and parse state,
+measured with tracemalloc, and the best time to parse the tables without
+tracing, so the memory saved is weighed against the time it costs.
+
+Usage:
+    memory.py [--copies 200] [example ...]
+"""
+from __future__ import print_function
+
+import os
+import csv
+import sys
+import shutil
+import argparse
+import time
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from bcbio.isatab.parser import StudyAssayParser, ISATabAssayRecord
+
+test_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                        "test", "isatab")
+
+
+def main(examples, copies):
+    work_dir = tempfile.mkdtemp()
+    try:
+        for example in examples:
+            data_dir = os.path.join(work_dir, example)
+            os.makedirs(data_dir)
+            tables = sorted(f for f in os.listdir(os.path.join(test_dir, example))
+                            if f.startswith(("s_", "a_")))
+            nrows = 0
+            for fname in tables:
+                nrows += scale_table(os.path.join(test_dir, example, fname),
+                                     os.path.join(data_dir, fname), copies)
+            base_file = os.path.join(data_dir, "i_Investigation.txt")
+            standard = parsed_memory(base_file, tables, False)
+            compact = parsed_memory(base_file, tables, True)
+            standard_secs = parse_seconds(base_file, tables, False)
+            compact_secs = parse_seconds(base_file, tables, True)
+            print("%s: %s rows, standard %.1f MB in %.2fs, compact %.1f MB in %.2fs, "
+                  "reduction %.0f%%, time %+.0f%%" %
+                  (example, nrows, standard / 1e6, standard_secs, compact / 1e6, compact_secs,
+                   100.0 * (standard - compact) / standard,
+                   100.0 * (compact_secs - standard_secs) / standard_secs))
+    finally:
+        shutil.rmtree(work_dir)
+
+def parsed_memory(base_file, tables, compact):
+    """Memory held by records parsed from a set of tables, as parse keeps them.
+    """
+    tracemalloc.start()
+    results = parse_tables(base_file, tables, compact)
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return used
+
+def parse_seconds(base_file, tables, compact, repeat=3):
+    """Best time to parse a set of tables, without tracing memory.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        parse_tables(base_file, tables, compact)
+        secs = time.time() - start
+        best = secs if best is None else min(best, secs)
+    return best
+
+def parse_tables(base_file, tables, compact):
+    """Parse a set of tables into records, as parse keeps them.
+    """
+    s_parser = StudyAssayParser(base_file, compact=compact)
+    results = []
+    for fname in tables:
+        node_types = s_parser._study_node_types if fname.startswith("s_") \
+                     else s_parser._assay_node_types
+        owner = ISATabAssayRecord()
+        owner.nodes, owner.process_nodes = s_parser._scan_cached(fname, node_types, owner)
+        results.append(owner)
+    return results
+
+def scale_table(in_file, out_file, copies):
+    """Repeat the rows of a study or assay file, with distinct node names per copy.
+    """
+    s_parser = StudyAssayParser(in_file)
+    with open(in_file) as in_handle:
+        reader = csv.reader(in_handle, dialect="excel-tab")
+        header = next(reader)
+        rows = [r for r in reader if r]
+    plan = s_parser._header_plan(header)
+    node_cols = set(plan.hgroups[i][0] for i, htype in enumerate(plan.htypes)
+                    if htype in ("node", "node_assay"))
+    with open(out_file, "w") as out_handle:
+        writer = csv.writer(out_handle, dialect="excel-tab")
+        writer.writerow(header)
+        for i in range(copies):
+            for row in rows:
+                writer.writerow([("%s-%s" % (x, i) if x and j in node_cols else x)
+                                 for j, x in enumerate(row)])
+    return len(rows) * copies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("examples", nargs="*", default=["BII-I-1", "BII-S-3"])
+    parser.add_argument("--copies", type=int, default=200)
+    args = parser.parse_args()
+    main(args.examples, args.copies)
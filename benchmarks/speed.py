@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""Time parsing of a synthetic ISA-Tab investigation, phase by phase.
+Generates an investigation with benchmarks/synthetic.py, then times
+InvestigationParser.parse, StudyAssayParser._parse_study and
+StudyAssayParser._get_process_nodes over all study and assay files, and a
+complete bcbio.isatab.parse. Reports the best time of each phase over the
+repeats, throughput in rows per second and resident memory. Each phase
+runs in a fresh Python process, so its peak resident memory is its own;
+the increase over the process after imports is reported as well.
+
+Usage:
+    speed.py [--studies 2] [--assays 3] [--rows 20000] [--shape BII-I-1] [--json]
+"""
+from __future__ import print_function
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from bcbio import isatab
+from bcbio.isatab.parser import InvestigationParser, StudyAssayParser, ISATabAssayRecord
+
+import synthetic
+
+
+def main(args):
+    work_dir = tempfile.mkdtemp()
+    try:
+        inv_file, nrows = synthetic.write_investigation(
+            work_dir, studies=args.studies, assays=args.assays, rows=args.rows,
+            characteristics=args.characteristics, factors=args.factors,
+            protocols=args.protocols, shape=args.shape)
+        results = []
+        for name, table_rows in zip(phase_names, [False, True, True, True]):
+            result = _run_phase(name, inv_file, args.repeat, args.mmap)
+            rows = nrows if table_rows else None
+            result.update({"phase": name, "rows": rows,
+                           "rows_per_second": rows / result["seconds"] if rows else None})
+            results.append(result)
+        report = {"config": {"studies": args.studies, "assays": args.assays,
+                             "rows": args.rows, "characteristics": args.characteristics,
+                             "factors": args.factors, "protocols": args.protocols,
+                             "shape": args.shape, "mmap": args.mmap, "total_rows": nrows},
+                  "phases": results}
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            print("%(shape)s: %(studies)s studies, %(assays)s assays each, "
+                  "%(total_rows)s rows" % report["config"])
+            for r in results:
+                print("%-40s %8.3fs %12s rows/s %8.1f MB peak RSS %+8.1f MB" %
+                      (r["phase"], r["seconds"],
+                       "%.0f" % r["rows_per_second"] if r["rows_per_second"] else "-",
+                       r["peak_rss_mb"], r["phase_rss_mb"]))
+    finally:
+        shutil.rmtree(work_dir)
+
+phase_names = ["InvestigationParser.parse", "StudyAssayParser._parse_study",
+               "StudyAssayParser._get_process_nodes", "parse"]
+
+def _run_phase(name, inv_file, repeat, mmap):
+    """Time a phase in a new Python process, returning its timing and memory.
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), "--run-phase", name,
+           "--investigation", inv_file, "--repeat", str(repeat)]
+    if mmap:
+        cmd.append("--mmap")
+    out = subprocess.check_output(cmd)
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+def run_phase(name, inv_file, repeat, mmap):
+    """Time one phase in this process, printing the best time and memory as JSON.
+    """
+    with io.open(inv_file, encoding="utf-8", newline="") as in_handle:
+        rec = InvestigationParser().parse(in_handle)
+    tables = []
+    for study in rec.studies:
+        tables.append((study.metadata["Study File Name"], "study"))
+        tables.extend((a["Study Assay File Name"], "assay") for a in study.assays)
+
+    def investigation():
+        with io.open(inv_file, encoding="utf-8", newline="") as in_handle:
+            InvestigationParser().parse(in_handle)
+
+    def study_tables():
+        s_parser = StudyAssayParser(inv_file, use_mmap=mmap)
+        for fname, kind in tables:
+            s_parser._parse_study(fname, s_parser._study_node_types if kind == "study"
+                                  else s_parser._assay_node_types)
+
+    def process_nodes():
+        s_parser = StudyAssayParser(inv_file, use_mmap=mmap)
+        for fname, _ in tables:
+            s_parser._get_process_nodes(fname, ISATabAssayRecord())
+
+    def full_parse():
+        isatab.parse(inv_file, use_mmap=mmap)
+
+    fn = dict(zip(phase_names, [investigation, study_tables, process_nodes, full_parse]))[name]
+    start_rss = _peak_rss_mb()
+    best = min(_timeit(fn) for _ in range(repeat))
+    peak_rss = _peak_rss_mb()
+    print(json.dumps({"seconds": best, "peak_rss_mb": peak_rss,
+                      "phase_rss_mb": peak_rss - start_rss}))
+
+def _timeit(fn):
+    start = time.time()
+    fn()
+    return time.time() - start
+
+def _peak_rss_mb():
+    """Peak resident memory so far; ru_maxrss is in kilobytes on Linux, bytes on OS X.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--studies", type=int, default=2)
+    parser.add_argument("--assays", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--characteristics", type=int, default=4)
+    parser.add_argument("--factors", type=int, default=2)
+    parser.add_argument("--protocols", type=int, default=0,
+                        help="Extra Protocol REF columns in assays")
+    parser.add_argument("--shape", default="BII-I-1", choices=sorted(synthetic._assay_shapes))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--mmap", action="store_true",
+                        help="Read study and assay files through memory maps; "
+                             "compare with a run without it, it is not faster")
+    parser.add_argument("--json", action="store_true", help="Report as JSON")
+    # used internally to run each phase in its own process
+    parser.add_argument("--run-phase", choices=phase_names, help=argparse.SUPPRESS)
+    parser.add_argument("--investigation", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_phase:
+        run_phase(args.run_phase, args.investigation, args.repeat, args.mmap)
+    else:
+        main(args)
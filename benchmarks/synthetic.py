@@ -0,0 +1,155 @@
+"""Generate synthetic ISA-Tab investigations of configurable size.
+Investigations follow the shapes of the test examples: microarray assays
+as in BII-I-1, sequencing assays as in BII-S-3, and ArrayExpress style
+Comment heavy sequencing assays as in the mage example. The number of
+studies, assays per study, rows per file and Characteristics, Factor Value
+and extra Protocol REF columns can be scaled independently. Values are
+drawn from small vocabularies so they repeat like in real submissions.
+"""
+import os
+import csv
+
+_organisms = [("Saccharomyces cerevisiae (Baker's yeast)", "NEWT", "4932"),
+              ("Mus musculus (Mouse)", "NEWT", "10090"),
+              ("Homo sapiens", "NEWT", "9606")]
+_units = [("hour", "UO", "0000032"), ("day", "UO", "0000033")]
+
+# assay node and protocol steps after Sample Name, per shape:
+# (Protocol REF value, output node header, extra columns after the node)
+_assay_shapes = {
+    "BII-I-1": [("RNA extraction", "Extract Name", []),
+                ("labeling", "Labeled Extract Name", ["Label", "Term Source REF", "Term Accession Number"]),
+                ("nucleic acid hybridization", "Hybridization Assay Name",
+                 ["Comment[ArrayExpress Accession]", "Array Design REF"]),
+                ("data collection", "Array Data File", []),
+                ("normalization data transformation", "Normalization Name", []),
+                ("data transformation", "Derived Array Data File", [])],
+    "BII-S-3": [("nucleic acid extraction", "Extract Name",
+                 ["Material Type", "Term Source REF", "Term Accession Number"]),
+                ("pyrosequencing", "Assay Name", ["Parameter Value[sequencing instrument]"]),
+                ("sequence analysis", "Raw Data File", [])],
+    "mage": [("nucleic acid extraction", "Extract Name",
+              ["Comment[LIBRARY_LAYOUT]", "Comment[LIBRARY_SOURCE]",
+               "Comment[LIBRARY_STRATEGY]", "Comment[LIBRARY_SELECTION]"]),
+             ("nucleic acid sequencing", "Assay Name",
+              ["Comment[ENA_EXPERIMENT]", "Comment[ENA_RUN]", "Comment[FASTQ_URI]"]),
+             ("data transformation", "Raw Data File", [])],
+}
+
+
+def write_investigation(out_dir, studies=1, assays=2, rows=1000, characteristics=4,
+                        factors=2, protocols=0, shape="BII-I-1"):
+    """Write a synthetic investigation to a directory.
+    Returns the investigation file and the total number of study and
+    assay rows written.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    study_info = []
+    nrows = 0
+    for si in range(studies):
+        study_file = "s_study%s.txt" % (si + 1)
+        _write_study(os.path.join(out_dir, study_file), si, rows, characteristics, factors)
+        nrows += rows
+        assay_files = []
+        for ai in range(assays):
+            assay_file = "a_study%s_assay%s.txt" % (si + 1, ai + 1)
+            _write_assay(os.path.join(out_dir, assay_file), si, ai, rows, factors,
+                         protocols, shape)
+            assay_files.append(assay_file)
+            nrows += rows
+        study_info.append((study_file, assay_files))
+    inv_file = os.path.join(out_dir, "i_Investigation.txt")
+    _write_investigation_file(inv_file, study_info, shape)
+    return inv_file, nrows
+
+def _term(vals, i):
+    return list(vals[i % len(vals)])
+
+def _write_study(out_file, si, rows, characteristics, factors):
+    header = ["Source Name"]
+    for ci in range(characteristics):
+        header += ["Characteristics[characteristic %s]" % ci if ci else "Characteristics[organism]",
+                   "Term Source REF", "Term Accession Number"]
+    header += ["Protocol REF", "Sample Name"]
+    for fi in range(factors):
+        header += ["Factor Value[factor %s]" % fi, "Unit", "Term Source REF", "Term Accession Number"]
+    with open(out_file, "w") as out_handle:
+        writer = csv.writer(out_handle, dialect="excel-tab")
+        writer.writerow(header)
+        for i in range(rows):
+            row = ["source-%s-%s" % (si, i // 2)]
+            for ci in range(characteristics):
+                if ci == 0:
+                    row += _term(_organisms, i)
+                else:
+                    row += ["value %s" % ((i + ci) % 5), "EFO", "%07d" % ((i + ci) % 5)]
+            row += ["sample collection", "sample-%s-%s" % (si, i)]
+            for fi in range(factors):
+                row += [str((i + fi) % 4)] + _term(_units, fi)
+            writer.writerow(row)
+
+def _write_assay(out_file, si, ai, rows, factors, protocols, shape):
+    steps = _assay_shapes[shape]
+    header = ["Sample Name"]
+    for pi in range(protocols):
+        header += ["Protocol REF", "Parameter Value[parameter %s]" % pi]
+    for protocol, node, extra in steps:
+        header += ["Protocol REF", node] + extra
+    for fi in range(factors):
+        header += ["Factor Value[factor %s]" % fi, "Unit", "Term Source REF", "Term Accession Number"]
+    with open(out_file, "w") as out_handle:
+        writer = csv.writer(out_handle, dialect="excel-tab")
+        writer.writerow(header)
+        for i in range(rows):
+            row = ["sample-%s-%s" % (si, i)]
+            for pi in range(protocols):
+                row += ["protocol %s" % pi, "setting %s" % (i % 3)]
+            for protocol, node, extra in steps:
+                if node.endswith("File"):
+                    name = "%s-%s-%s.dat" % (node.split()[0].lower(), ai, i)
+                else:
+                    name = "%s-%s-%s-%s" % (node.split()[0].lower(), si, ai, i)
+                row += [protocol, name] + ["%s %s" % (x.split("[")[-1].rstrip("]"), i % 3)
+                                           for x in extra]
+            for fi in range(factors):
+                row += [str((i + fi) % 4)] + _term(_units, fi)
+            writer.writerow(row)
+
+def _write_investigation_file(out_file, study_info, shape):
+    lines = [["ONTOLOGY SOURCE REFERENCE"],
+             ["Term Source Name", "NEWT", "UO", "EFO", "OBI"],
+             ["Term Source File", "", "", "", ""],
+             ["Term Source Version", "", "", "", ""],
+             ["Term Source Description", "NEWT UniProt Taxonomy Database", "Unit Ontology",
+              "Experimental Factor Ontology", "Ontology for Biomedical Investigations"],
+             ["INVESTIGATION"],
+             ["Investigation Identifier", "SYN-%s" % shape],
+             ["Investigation Title", "Synthetic %s shaped investigation" % shape],
+             ["INVESTIGATION PUBLICATIONS"],
+             ["Investigation PubMed ID", ""],
+             ["INVESTIGATION CONTACTS"],
+             ["Investigation Person Last Name", ""]]
+    protocols = ["sample collection"] + [p for p, _, _ in _assay_shapes[shape]]
+    for si, (study_file, assay_files) in enumerate(study_info):
+        lines += [["STUDY"],
+                  ["Study Identifier", "SYN-S-%s" % (si + 1)],
+                  ["Study Title", "Synthetic study %s" % (si + 1)],
+                  ["Study File Name", study_file],
+                  ["STUDY DESIGN DESCRIPTORS"],
+                  ["Study Design Type", ""],
+                  ["STUDY PUBLICATIONS"],
+                  ["Study PubMed ID", ""],
+                  ["STUDY FACTORS"],
+                  ["Study Factor Name", "factor 0"],
+                  ["STUDY ASSAYS"],
+                  ["Study Assay Measurement Type"] + ["synthetic"] * len(assay_files),
+                  ["Study Assay File Name"] + assay_files,
+                  ["STUDY PROTOCOLS"],
+                  ["Study Protocol Name"] + protocols,
+                  ["STUDY CONTACTS"],
+                  ["Study Person Last Name", ""]]
+    with open(out_file, "w") as out_handle:
+        writer = csv.writer(out_handle, dialect="excel-tab")
+        for line in lines:
+            writer.writerow(line)
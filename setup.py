@@ -13,5 +13,7 @@ setup(name = "biopy-isatab",
       namespace_packages = ["bcbio"],
       packages = find_packages(),
       scripts = [],
+      entry_points = {
+          "console_scripts": ["isatab-batch = bcbio.isatab.batch:main"]},
       install_requires = [
       ])
@@ -1,13 +1,47 @@
 """Tests for parsing and extracting information from ISA-Tab formatted metadata.
 """
+import gc
+import io
+import csv
 import os
+import sys
+import json
+import pickle
+import shutil
+import subprocess
+import weakref
+import tempfile
+import threading
+import collections
 import unittest
 from bcbio import isatab
+from bcbio.isatab import parser, batch, query, serialize, watch, terms
 
 class IsatabTest(unittest.TestCase):
     def setUp(self):
         self._dir = os.path.join(os.path.dirname(__file__), "isatab")
 
+    def _minimal_rec(self):
+        """Investigation record for the minimal example, without reading i_ files.
+        """
+        rec = parser.ISATabRecord()
+        study = parser.ISATabStudyRecord()
+        study.metadata["Study File Name"] = "s_SB-S-E1.txt"
+        study.assays = [{"Study Assay File Name": "a_C2C12expr.txt"},
+                        {"Study Assay File Name": "a_C2C12expr.txt"}]
+        rec.studies.append(study)
+        return rec
+
+    def _work_dir(self, example=None):
+        """Create a temporary directory, removed after the test.
+        With the name of an example directory, a copy of it is made inside.
+        """
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        if example is not None:
+            shutil.copytree(os.path.join(self._dir, example), os.path.join(work_dir, example))
+        return work_dir
+
     def test_basic_parsing(self):
         """Test general parsing of an example ISA directory.
         """
@@ -25,10 +59,11 @@ class IsatabTest(unittest.TestCase):
         assert len(study.assays) == 3
         assert study.assays[0].metadata["Study Assay File Name"] == "a_metabolome.txt"
         study = rec.studies[1]
-        assert study.nodes['NZ_0hrs_Grow_1'].metadata["organism"][0].organism == \
+        node = study.nodes['sample-NZ_0hrs_Grow_1']
+        assert node.metadata["Characteristics[organism]"][0].organism == \
                "Saccharomyces cerevisiae (Baker's yeast)"
-        assert study.assays[0].nodes['E-MAXD-4-raw-data-426648783.txt'
-                                     ].metadata["ArrayExpress Accession"][0][0] == \
+        assert study.assays[0].nodes['rawdatafile-E-MAXD-4-raw-data-426648783.txt'
+                                     ].metadata["Comment[ArrayExpress Accession]"][0][0] == \
                                      "E-MAXD-4"
 
     def test_minimal_parsing(self):
@@ -44,9 +79,33 @@ class IsatabTest(unittest.TestCase):
 
         sname = "C2C12 sample1 rep3"
         study = rec.studies[0]
-        assay_node = study.assays[0].nodes["AFFY#35C.CEL"]
+        assay_node = study.assays[0].nodes["rawdatafile-AFFY#35C.CEL"]
         assert assay_node.metadata["Sample Name"] == [sname]
-        assert study.nodes[sname].metadata["strain"][0][0] == "C3H"
+        assert study.nodes["sample-" + sname].metadata["Characteristics[strain]"][0][0] == "C3H"
+        assert gc.isenabled()
+        gc.disable()
+        try:
+            isatab.parse(work_dir)
+            assert not gc.isenabled()
+        finally:
+            gc.enable()
+        assert len(isatab.parse(work_dir, pause_gc=False).studies) == 1
+        # process nodes refer weakly to their record, so dropped records are
+        # freed without the garbage collector
+        gc.disable()
+        try:
+            for compact in [False, True]:
+                new_rec = isatab.parse(work_dir, compact=compact)
+                new_assay = new_rec.studies[0].assays[0]
+                assert all(p.study_assay is new_assay for p in new_assay.process_nodes.values())
+                loaded = pickle.loads(pickle.dumps(new_rec, pickle.HIGHEST_PROTOCOL))
+                assert all(p.study_assay is loaded.studies[0].assays[0]
+                           for p in loaded.studies[0].assays[0].process_nodes.values())
+                dropped = weakref.ref(new_assay)
+                del new_rec, new_assay, loaded
+                assert dropped() is None
+        finally:
+            gc.enable()
 
     def test_nextgen_parsing(self):
         """Parse ISA-Tab file representing next gen sequencing data
@@ -55,8 +114,8 @@ class IsatabTest(unittest.TestCase):
         rec = isatab.parse(work_dir)
         assay = rec.studies[0].assays[0]
         assert assay.metadata['Study Assay Technology Platform'] == '454 Genome Sequencer FLX'
-        assert assay.nodes.has_key("ftp://ftp.ncbi.nih.gov/pub/TraceDB/ShortRead/"
-                                   "SRA000266/EWOEPZA01.sff")
+        assert ("rawdatafile-ftp://ftp.ncbi.nih.gov/pub/TraceDB/ShortRead/"
+                "SRA000266/EWOEPZA01.sff") in assay.nodes
 
     def test_get_genelists(self):
         """Identify derived genelists available in ISA-Tab experiment
@@ -65,11 +124,12 @@ class IsatabTest(unittest.TestCase):
         rec = isatab.parse(work_dir)
         study = rec.studies[0]
         assay = study.assays[0]
-        assay_node = assay.nodes["KLS1nature.CEL"]
-        study_node = study.nodes[assay_node.metadata["Sample Name"][0]]
+        assay_node = assay.nodes["rawdatafile-KLS1nature.CEL"]
+        study_node = study.nodes["sample-" + assay_node.metadata["Sample Name"][0]]
         assert "16862118-Figure2bSRAS.txt" in assay_node.metadata["Derived Data File"]
         expects = ["Mus musculus (Mouse)", "C57BL/6", "bone marrow"]
-        attrs = ["Organism", "strain", "Organism Part"]
+        attrs = ["Characteristics[Organism]", "Characteristics[strain]",
+                 "Characteristics[Organism Part]"]
         for attr, expect in zip(attrs, expects):
             assert study_node.metadata[attr][0][0] == expect
 
@@ -80,9 +140,27 @@ class IsatabTest(unittest.TestCase):
         rec = isatab.parse(work_dir)
         assert len(rec.studies) == 1
         study = rec.studies[0]
-        node = study.nodes["ERS025105"]
-        assert node.metadata["FASTQ_URI"][0].FASTQ_URI == \
+        node = study.nodes["comment[ena_sample]-ERS025105"]
+        assert node.metadata["Comment[FASTQ_URI]"][0].FASTQ_URI == \
+               "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR030/ERR030907/ERR030907.fastq.gz"
+
+    def test_node_index_keys(self):
+        """Key nodes by their type, including comment and intermediate node columns.
+        """
+        assert parser.build_node_index("Acquisition Parameter Data File", "params.txt") == \
+               "acquisitionparameterfile-params.txt"
+        assert parser.build_node_index("Labeled Extract Name", "le1") == "labeledextractname-le1"
+        rec = isatab.parse(os.path.join(self._dir, "mage"))
+        node = rec.studies[0].nodes["comment[ena_sample]-ERS025105"]
+        assert node.ntype == "Comment[ENA_SAMPLE]"
+        assert node.metadata["Comment[FASTQ_URI]"][0].FASTQ_URI == \
                "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR030/ERR030907/ERR030907.fastq.gz"
+        rec = isatab.parse(os.path.join(self._dir, "minimal"))
+        process_nodes = rec.studies[0].assays[0].process_nodes
+        assert process_nodes["data collection1"].inputs == ["assayname-C2C12 sample1 rep3"]
+        assert process_nodes["data collection1"].outputs == ["rawdatafile-AFFY#35C.CEL"]
+        edges = set(x for p in process_nodes.values() for x in p.inputs + p.outputs)
+        assert any(x.startswith("labeledextractname-") for x in edges)
 
     def test_repeated_header(self):
         """Handle ISA-Tab inputs with repeated header names.
@@ -90,5 +168,856 @@ class IsatabTest(unittest.TestCase):
         work_dir = os.path.join(self._dir, "BII-S-6")
         rec = isatab.parse(work_dir)
 
+    def test_single_pass_scan(self):
+        """Collect nodes and process nodes from one read of an assay file.
+        """
+        work_dir = os.path.join(self._dir, "minimal")
+        s_parser = parser.StudyAssayParser(os.path.join(work_dir, "i_Investigation.txt"))
+        assay = parser.ISATabAssayRecord()
+        nodes, process_nodes = s_parser._scan_study("a_C2C12expr.txt",
+                                                   s_parser._assay_node_types, assay)
+        assert sorted(nodes.keys()) == sorted(s_parser._parse_study(
+            "a_C2C12expr.txt", s_parser._assay_node_types).keys())
+        assert nodes["rawdatafile-AFFY#35C.CEL"].metadata["Sample Name"] == \
+               ["C2C12 sample1 rep3"]
+        assert len(process_nodes) > 0
+        for process_node in process_nodes.values():
+            assert process_node.study_assay is assay
+            if process_node.name.startswith("RNA extraction"):
+                assert process_node.inputs[0].startswith("sample-")
+
+    def test_attrs_pickle(self):
+        """Attribute tuples share a type per header group and round trip via pickle.
+        """
+        work_dir = os.path.join(self._dir, "minimal")
+        s_parser = parser.StudyAssayParser(os.path.join(work_dir, "i_Investigation.txt"))
+        nodes = s_parser._parse_study("s_SB-S-E1.txt", s_parser._study_node_types)
+        strains = [n.metadata["Characteristics[strain]"][0] for n in nodes.values()
+                   if "Characteristics[strain]" in n.metadata]
+        assert len(set(type(x) for x in strains)) == 1
+        attrs = strains[0]
+        loaded = pickle.loads(pickle.dumps(attrs, pickle.HIGHEST_PROTOCOL))
+        assert loaded == attrs
+        assert loaded.strain == attrs.strain
+        assert type(loaded) is type(attrs)
+
+    def test_header_plan(self):
+        """Compile header interpretation once and share it between identical headers.
+        """
+        s_parser = parser.StudyAssayParser(os.path.join(self._dir, "minimal",
+                                                        "i_Investigation.txt"))
+        header = ["Source Name", "Characteristics[organism]", "Term Source REF",
+                  "Protocol REF", "Sample Name", "Array Data File"]
+        plan = s_parser._header_plan(header)
+        assert s_parser._header_plan(list(header)) is plan
+        assert plan.header[-1] == "Raw Data File"
+        assert plan.process_steps == [((0,), 3, (4, 5))]
+        line = ["s1", "Homo sapiens", "NCBITaxon", "collect", "x1", "x1.CEL"]
+        out = plan.keyvals(line, collections.defaultdict(set))
+        assert out["Sample Name"] == set(["x1"])
+        organism = list(out["Characteristics[organism]"])[0]
+        assert organism.organism == "Homo sapiens"
+        assert organism.Term_Source_REF == "NCBITaxon"
+        assert list(out["Protocol REF"])[0][0] == "collect"
+
+    @unittest.skipIf(sys.version_info < (3, 2), "process pools require concurrent.futures")
+    def test_parallel_parsing(self):
+        """Parse study and assay files in worker processes, matching a serial parse.
+        """
+        base_file = os.path.join(self._dir, "minimal", "i_Investigation.txt")
+        serial = parser.StudyAssayParser(base_file).parse(self._minimal_rec())
+        pooled = parser.StudyAssayParser(base_file).parse(self._minimal_rec(), workers=2,
+                                                          min_parallel_bytes=0)
+        for expect, study in zip(serial.studies, pooled.studies):
+            assert list(study.nodes.keys()) == list(expect.nodes.keys())
+            for assay, expect_assay in zip(study.assays, expect.assays):
+                assert list(assay.nodes.keys()) == list(expect_assay.nodes.keys())
+                for name, process_node in assay.process_nodes.items():
+                    assert process_node.study_assay is assay
+                    assert process_node.inputs == expect_assay.process_nodes[name].inputs
+                    assert process_node.outputs == expect_assay.process_nodes[name].outputs
+            node = study.nodes["sample-C2C12 sample1 rep3"]
+            assert node.metadata == expect.nodes["sample-C2C12 sample1 rep3"].metadata
+
+        # jobs running in threads report statistics of their own files only
+        from concurrent.futures import ThreadPoolExecutor
+        stats = isatab.ParseStats()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            threaded = parser.StudyAssayParser(base_file, stats=stats).parse(
+                self._minimal_rec(), executor=executor, min_parallel_bytes=0)
+        assert [os.path.basename(x["path"]) for x in stats.files] == \
+               ["s_SB-S-E1.txt", "a_C2C12expr.txt", "a_C2C12expr.txt"]
+        assert list(threaded.studies[0].assays[0].nodes.keys()) == \
+               list(serial.studies[0].assays[0].nodes.keys())
+
+    def test_streaming_rows(self):
+        """Iterate over assay rows and nodes without building the full record.
+        """
+        work_dir = os.path.join(self._dir, "minimal")
+        assay_file = os.path.join(work_dir, "a_C2C12expr.txt")
+        rows = isatab.iter_assay_rows(assay_file)
+        row = next(rows)
+        assert row["Sample Name"] == ["C2C12 sample1 rep3"]
+        assert row["Protocol REF"][0][0]
+        assert len(list(rows)) > 0
+
+        s_parser = parser.StudyAssayParser(os.path.join(work_dir, "i_Investigation.txt"))
+        expected = s_parser._parse_study("a_C2C12expr.txt", s_parser._assay_node_types)
+        # nodes named in the same row get equal metadata of their own
+        sample = expected["sample-C2C12 sample1 rep3"].metadata
+        extract = expected["extract-C2C12 sample1 rep3"].metadata
+        assert sample == extract and sample is not extract
+        assert sample["Sample Name"] is not extract["Sample Name"]
+        seen = 0
+        for node_index, node in isatab.iter_nodes(assay_file):
+            assert node.metadata == expected[node_index].metadata
+            seen += 1
+        assert seen > 0
+
+    def test_lazy_parsing(self):
+        """Parse study and assay files only when their nodes are accessed.
+        """
+        base_file = os.path.join(self._dir, "minimal", "i_Investigation.txt")
+        rec = parser.StudyAssayParser(base_file).parse_lazy(self._minimal_rec())
+        study = rec.studies[0]
+        assay = study.assays[0]
+        assert not study.loaded and not assay.loaded
+        assert assay.metadata["Study Assay File Name"] == "a_C2C12expr.txt"
+        assert "rawdatafile-AFFY#35C.CEL" in assay.nodes
+        assert assay.loaded and not study.loaded
+        assert len(assay.process_nodes) > 0
+        assert study.nodes["sample-C2C12 sample1 rep3"].metadata["Characteristics[strain]"][0][0] == "C3H"
+        study.unload()
+        assert not study.loaded
+        assert "sample-C2C12 sample1 rep3" in study.nodes
+
+    def test_parse_cache(self):
+        """Reuse cached parse results for files that did not change.
+        """
+        work_dir = self._work_dir("minimal")
+        data_dir = os.path.join(work_dir, "minimal")
+        base_file = os.path.join(data_dir, "i_Investigation.txt")
+        cache = isatab.ParseCache(os.path.join(work_dir, "cache"))
+        first = parser.StudyAssayParser(base_file, cache).parse(self._minimal_rec())
+        # both assays share a file, so the second is already cached
+        assert (cache.hits, cache.misses) == (1, 2)
+        second = parser.StudyAssayParser(base_file, cache).parse(self._minimal_rec())
+        assert (cache.hits, cache.misses) == (4, 2)
+        assert sorted(second.studies[0].nodes.keys()) == sorted(first.studies[0].nodes.keys())
+        assay = second.studies[0].assays[0]
+        for process_node in assay.process_nodes.values():
+            assert process_node.study_assay is assay
+
+        with open(os.path.join(data_dir, "s_SB-S-E1.txt"), "a") as out_handle:
+            out_handle.write("\t".join(["new source"] + [""] * 21 +
+                                        ["collect", "new sample", "", "", ""]) + "\n")
+        third = parser.StudyAssayParser(base_file, cache).parse(self._minimal_rec())
+        assert (cache.hits, cache.misses) == (6, 3)
+        assert "sample-new sample" in third.studies[0].nodes
+        assert cache.stats()["entries"] == 2
+
+        # a file changed while it was parsed is not stored as up to date
+        study_file = os.path.join(data_dir, "s_SB-S-E1.txt")
+        fingerprint = cache.fingerprint(study_file)
+        with open(study_file, "a") as out_handle:
+            out_handle.write("\n")
+        cache.put(study_file, "stale", "parsed before the change", fingerprint)
+        assert cache.get(study_file, "stale") is None
+
+        small = isatab.ParseCache(os.path.join(work_dir, "cache"), max_bytes=1)
+        small.put(base_file, "investigation", self._minimal_rec())
+        assert small.evictions > 0 and small.stats()["bytes"] <= 1
+
+    def test_incremental_update(self):
+        """Merge rows appended to an assay file without parsing it again.
+        """
+        work_dir = self._work_dir("minimal")
+        data_dir = os.path.join(work_dir, "minimal")
+        base_file = os.path.join(data_dir, "i_Investigation.txt")
+        rec = parser.StudyAssayParser(base_file).parse(self._minimal_rec())
+        assay_file = os.path.join(data_dir, "a_C2C12expr.txt")
+        with open(assay_file) as in_handle:
+            last = in_handle.readlines()[-1].rstrip("\r\n").split("\t")
+        with open(assay_file, "a") as out_handle:
+            out_handle.write("\t".join(x.replace(".CEL", "-new.CEL") for x in last) + "\n")
+        assay = rec.studies[0].assays[0]
+        nprocess = len(assay.process_nodes)
+        isatab.update(rec, [assay_file])
+        new_nodes = [k for k in assay.nodes if k.endswith("-new.CEL")]
+        assert len(new_nodes) == 1
+        assert assay.nodes[new_nodes[0]].metadata["Sample Name"] == [last[0].strip('"')]
+        assert len(assay.process_nodes) == nprocess
+        expect = parser.StudyAssayParser(base_file).parse(self._minimal_rec())
+        expect_assay = expect.studies[0].assays[0]
+        assert sorted(assay.nodes.keys()) == sorted(expect_assay.nodes.keys())
+        assert sorted((k, p.inputs, p.outputs) for k, p in assay.process_nodes.items()) == \
+               sorted((k, p.inputs, p.outputs) for k, p in expect_assay.process_nodes.items())
+        assert all(p.study_assay is assay for p in assay.process_nodes.values())
+
+        # a changed header triggers a full re-parse of the file
+        with open(assay_file) as in_handle:
+            lines = in_handle.readlines()
+        with open(assay_file, "w") as out_handle:
+            out_handle.write(lines[0].replace("Sample Name", "Source Name"))
+            out_handle.writelines(lines[1:])
+        isatab.update(rec, [assay_file])
+        assert not any(k.startswith("sample-") for k in assay.nodes)
+
+        # files of an investigation opened by a relative path are found
+        # from any working directory, including by cached states
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(work_dir)
+        cache = isatab.ParseCache(os.path.join(work_dir, "cache"))
+        parser.StudyAssayParser(os.path.join("minimal", "i_Investigation.txt"),
+                                cache).parse(self._minimal_rec())
+        os.chdir(self._dir)
+        rec = parser.StudyAssayParser(base_file, cache).parse(self._minimal_rec())
+        assay = rec.studies[0].assays[0]
+        assert cache.hits > 0 and os.path.isabs(assay._table_state.path)
+        with open(assay_file, "a") as out_handle:
+            out_handle.write("\t".join(x.replace(".CEL", "-rel.CEL") for x in last) + "\n")
+        nnodes = len(assay.nodes)
+        isatab.update(rec, [assay_file])
+        assert len(assay.nodes) == nnodes + 1
+
+        # rows of files with \r line ends are merged as well
+        cr_dir = os.path.join(self._work_dir("minimal"), "minimal")
+        cr_file = os.path.join(cr_dir, "a_C2C12expr.txt")
+        with open(os.path.join(self._dir, "minimal", "a_C2C12expr.txt"), "rb") as in_handle:
+            text = in_handle.read().replace(b"\r\n", b"\n").replace(b"\n", b"\r")
+        with open(cr_file, "wb") as out_handle:
+            out_handle.write(text)
+        cr_base = os.path.join(cr_dir, "i_Investigation.txt")
+        rec = parser.StudyAssayParser(cr_base).parse(self._minimal_rec())
+        last = text.rstrip(b"\r").split(b"\r")[-1]
+        with open(cr_file, "ab") as out_handle:
+            out_handle.write(last.replace(b".CEL", b"-new.CEL") + b"\r")
+        assay = rec.studies[0].assays[0]
+        isatab.update(rec, [cr_file])
+        expect = parser.StudyAssayParser(cr_base).parse(self._minimal_rec())
+        assert sorted(assay.nodes.keys()) == sorted(expect.studies[0].assays[0].nodes.keys())
+        assert "rawdatafile-AFFY#37A-new.CEL" in assay.nodes
+        assert assay._table_state.offset == os.path.getsize(cr_file)
+        # a \r after \r\n line ends waits for its \n
+        crlf_file = os.path.join(cr_dir, "a_crlf.txt")
+        with open(crlf_file, "wb") as out_handle:
+            out_handle.write(b"Sample Name\r\nfirst\r\nsecond\r")
+        assert parser._read_rows(crlf_file, 13) == ([["first"]], 20)
+
+    def test_update_after_append_during_scan(self):
+        """Resume after the rows a scan read, including rows appended while scanning.
+        """
+        work_dir = self._work_dir("minimal")
+        data_dir = os.path.join(work_dir, "minimal")
+        base_file = os.path.join(data_dir, "i_Investigation.txt")
+        assay_file = os.path.join(data_dir, "a_C2C12expr.txt")
+        with open(assay_file) as in_handle:
+            last = in_handle.readlines()[-1].rstrip("\r\n")
+        new_row = lambda suffix: last.replace(".CEL", "-%s.CEL" % suffix) + "\n"
+        # larger than read buffers, so appended rows are read by the running scan
+        with open(assay_file, "a") as out_handle:
+            out_handle.writelines(new_row("pad%s" % i) for i in range(500))
+        appended = []
+
+        class AppendingParser(parser.StudyAssayParser):
+            def _read_table(self, fname):
+                self.fname = fname
+                return parser.StudyAssayParser._read_table(self, fname)
+
+            def _scan_nodes(self, line, scanners, plan):
+                if self.fname == os.path.basename(assay_file) and not appended and \
+                   line != list(plan.raw_header):
+                    with open(assay_file, "a") as out_handle:
+                        out_handle.write(new_row("during"))
+                    appended.append(line)
+                return parser.StudyAssayParser._scan_nodes(self, line, scanners, plan)
+        rec = parser.ISATabRecord()
+        study = self._minimal_rec().studies[0]
+        study.assays = study.assays[:1]
+        rec.studies.append(study)
+        rec = AppendingParser(base_file).parse(rec)
+        assay = rec.studies[0].assays[0]
+        assert assay._table_state.offset == os.path.getsize(assay_file)
+        with open(assay_file, "a") as out_handle:
+            out_handle.write(new_row("after"))
+        isatab.update(rec, [assay_file])
+        with open(assay_file) as in_handle:
+            assert assay._table_state.rows == len(in_handle.readlines()) - 1
+        assert assay._table_state.offset == os.path.getsize(assay_file)
+        assert [k for k in assay.nodes if k.endswith("-after.CEL")]
+
+    def test_process_graph(self):
+        """Follow provenance from sources to assay nodes through the process graph.
+        """
+        base_file = os.path.join(self._dir, "minimal", "i_Investigation.txt")
+        rec = parser.StudyAssayParser(base_file).parse(self._minimal_rec())
+        graph = isatab.ProcessGraph.from_study(rec.studies[0])
+        sample = "sample-C2C12 sample1 rep3"
+        assert sample in graph
+        assert graph.parents(sample) == set(["source-C2C12 sample1 rep3"])
+        assert graph.sources(sample) == set(["source-C2C12 sample1 rep3"])
+        assert "extract-C2C12 sample1 rep3" in graph.children(sample)
+        assert "extract-C2C12 sample1 rep3" in graph.downstream("source-C2C12 sample1 rep3")
+        assert "source-C2C12 sample1 rep3" in graph.upstream("extract-C2C12 sample1 rep3")
+        assert graph.upstream("source-C2C12 sample1 rep3") == set()
+        # every Protocol REF column adds a step, from samples to data files
+        upstream = graph.upstream("rawdatafile-AFFY#35C.CEL")
+        assert "labeledextractname-C2C12 sample1 rep3" in upstream
+        assert "assayname-C2C12 sample1 rep3" in upstream
+        assert graph.sources("rawdatafile-AFFY#35C.CEL") == set(["source-C2C12 sample1 rep3"])
+        assert graph.parents("normalizationname-MAS5") >= set(["rawdatafile-AFFY#35C.CEL",
+                                                                "rawdatafile-AFFY#37A.CEL"])
+        steps = rec.studies[0].assays[0].process_nodes.values()
+        assert not any(node_index.endswith("-") for p in steps for node_index in p.outputs)
+
+    def test_columnar_table(self):
+        """Load an assay file into dictionary encoded columns and filter rows.
+        """
+        assay_file = os.path.join(self._dir, "minimal", "a_C2C12expr.txt")
+        table = isatab.load_table(assay_file)
+        rows = list(isatab.iter_assay_rows(assay_file))
+        assert len(table) == len(rows)
+        assert "Raw Data File" in table and "Array Data File" not in table
+        protocols = table["Protocol REF"]
+        assert isinstance(protocols, isatab.columnar.DictColumn)
+        assert len(protocols.categories) == 1
+        assert protocols.where(protocols.categories[0]) == list(range(len(table)))
+        samples = table["Sample Name"]
+        assert samples.to_list() == [r["Sample Name"][0] for r in rows]
+        selected = table.where("Raw Data File", "AFFY#35C.CEL")
+        assert len(selected) == 1
+        subset = table.take(selected)
+        assert subset["Sample Name"][0] == "C2C12 sample1 rep3"
+        files = table["Raw Data File"]
+        assert files.isin(["AFFY#35C.CEL", "AFFY#36C.CEL", "missing"]) == \
+               [i for i, x in enumerate(files.to_list()) if x in ("AFFY#35C.CEL", "AFFY#36C.CEL")]
+        subset_protocols = subset["Protocol REF"]
+        subset_protocols.append("new protocol")
+        assert "new protocol" not in protocols.categories
+        assert table.column("Protocol REF", 1)[0] == "labeling"
+        wide = isatab.columnar.DictColumn()
+        for i in range(600):
+            wide.append("value %s" % (i % 300))
+        assert wide.codes.typecode == "i"
+        assert wide.isin(["value 1", "value 299"]) == [1, 299, 301, 599]
+
+    def test_compact_records(self):
+        """Build slotted node records sharing repeated values between nodes.
+        """
+        base_file = os.path.join(self._dir, "minimal", "i_Investigation.txt")
+        standard = parser.StudyAssayParser(base_file).parse(self._minimal_rec())
+        compact = parser.StudyAssayParser(base_file, compact=True).parse(self._minimal_rec())
+        nodes = compact.studies[0].nodes
+        assert sorted(nodes.keys()) == sorted(standard.studies[0].nodes.keys())
+        for node_index, node in nodes.items():
+            assert isinstance(node, parser.CompactNodeRecord)
+            assert not hasattr(node, "__dict__")
+            assert node.metadata == standard.studies[0].nodes[node_index].metadata
+            for key, vals in node.metadata.items():
+                expect = standard.studies[0].nodes[node_index].metadata[key]
+                assert [getattr(x, "_fields", None) for x in vals] == \
+                       [getattr(x, "_fields", None) for x in expect]
+        s_parser = parser.StudyAssayParser(base_file, compact=True)
+        plan = s_parser._header_plan(["Sample Name", "Comment[URL]", "Comment[Accession]"])
+        row = plan.row(["s1", "E-1", "E-1"])
+        assert row["Comment[URL]"][0]._fields != row["Comment[Accession]"][0]._fields
+        assert plan.row(["s2", "E-1", "E-1"])["Comment[URL]"][0] is row["Comment[URL]"][0]
+        organisms = [n.metadata["Characteristics[organism]"][0] for n in nodes.values()]
+        assert all(x is organisms[0] for x in organisms)
+        assay = compact.studies[0].assays[0]
+        for process_node in assay.process_nodes.values():
+            assert isinstance(process_node, parser.CompactProcessNodeRecord)
+            assert process_node.study_assay is assay
+        node = pickle.loads(pickle.dumps(nodes["sample-C2C12 sample1 rep3"], pickle.HIGHEST_PROTOCOL))
+        assert node.metadata == nodes["sample-C2C12 sample1 rep3"].metadata
+
+    def test_parse_stats(self):
+        """Record per-file statistics and cache hits when parsing with a ParseStats.
+        """
+        work_dir = self._work_dir()
+        base_file = os.path.join(self._dir, "minimal", "i_Investigation.txt")
+        cache = isatab.ParseCache(work_dir)
+        seen = []
+        stats = isatab.ParseStats(callback=seen.append)
+        parser.StudyAssayParser(base_file, cache, stats=stats).parse(self._minimal_rec())
+        assert [(x["kind"], x["cached"]) for x in stats.files] == \
+               [("study", False), ("assay", False), ("assay", True)]
+        assert seen == stats.files
+        study, assay = stats.files[:2]
+        assert study["rows"] == 9 and study["nodes"] > 0
+        assert study["file_bytes"] == os.path.getsize(os.path.join(self._dir, "minimal",
+                                                                   "s_SB-S-E1.txt"))
+        assert study["bytes_read"] == study["file_bytes"] and stats.files[2]["bytes_read"] == 0
+        assert assay["process_nodes"] > 0 and assay["process_seconds"] >= 0
+        totals = stats.as_dict()["totals"]
+        assert totals["assay"]["files"] == 2 and totals["assay"]["cache_hits"] == 1
+        assert json.loads(stats.to_json())["files"][0]["rows"] == 9
+
+    def test_investigation_tokenizer(self):
+        """Parse investigation sections, quoted values and ragged rows from text.
+        """
+        text = u"\r\n".join([u"ONTOLOGY SOURCE REFERENCE",
+                              u"Term Source Name\tNEWT\tUO\t\t",
+                              u"Term Source File",
+                              u"INVESTIGATION\t\t",
+                              u"Investigation Identifier\tBII-I-1",
+                              u'Investigation Description\t"Two\tlines\nof text "',
+                              u"STUDY",
+                              u"Study Identifier\tBII-S-1",
+                              u"STUDY FACTORS",
+                              u"Study Factor Name\tlimiting nutrient\trate",
+                              u""])
+        rec = parser.InvestigationParser().parse(io.StringIO(text, newline=""))
+        assert rec.ontology_refs == [{"Term Source Name": "NEWT", "Term Source File": ""},
+                                     {"Term Source Name": "UO", "Term Source File": ""}]
+        assert rec.metadata == {"Investigation Identifier": "BII-I-1",
+                                "Investigation Description": "Two\tlines\nof text"}
+        assert len(rec.studies) == 1
+        assert rec.studies[0].metadata == {"Study Identifier": "BII-S-1"}
+        assert [x["Study Factor Name"] for x in rec.studies[0].factors] == \
+               ["limiting nutrient", "rate"]
+
+    def test_mmap_reader(self):
+        """Read study and assay files through a memory map, with and without quotes.
+        """
+        work_dir = self._work_dir()
+        src_dir = os.path.join(self._dir, "minimal")
+        for fname in ["i_Investigation.txt", "s_SB-S-E1.txt", "a_C2C12expr.txt"]:
+            with open(os.path.join(src_dir, fname)) as in_handle:
+                text = in_handle.read()
+            if not fname.startswith("i_"):
+                text = text.replace('"', "").replace("\n", "\r\n")
+            with open(os.path.join(work_dir, fname), "w") as out_handle:
+                out_handle.write(text)
+        for data_dir in [src_dir, work_dir]:
+            base_file = os.path.join(data_dir, "i_Investigation.txt")
+            standard = parser.StudyAssayParser(base_file).parse(self._minimal_rec())
+            mapped = parser.StudyAssayParser(base_file, use_mmap=True).parse(self._minimal_rec())
+            for x, y in [(standard.studies[0], mapped.studies[0]),
+                         (standard.studies[0].assays[0], mapped.studies[0].assays[0])]:
+                assert sorted(x.nodes.keys()) == sorted(y.nodes.keys())
+                for node_index, node in x.nodes.items():
+                    assert node.metadata == y.nodes[node_index].metadata
+                assert sorted((k, p.inputs, p.outputs) for k, p in x.process_nodes.items()) == \
+                       sorted((k, p.inputs, p.outputs) for k, p in y.process_nodes.items())
+                assert x._table_state.offset == y._table_state.offset
+                assert x._table_state.rows == y._table_state.rows
+        # quoted files with \r line ends
+        cr_file = os.path.join(work_dir, "a_cr.txt")
+        with open(os.path.join(src_dir, "a_C2C12expr.txt"), "rb") as in_handle:
+            with open(cr_file, "wb") as out_handle:
+                out_handle.write(in_handle.read().replace(b"\r\n", b"\n").replace(b"\n", b"\r"))
+        with parser.MappedTableReader(cr_file) as reader:
+            with parser.TableLines(cr_file) as in_handle:
+                assert list(reader) == list(csv.reader(in_handle, dialect="excel-tab"))
+        with parser.MappedTableReader(os.path.join(work_dir, "a_C2C12expr.txt")) as reader:
+            header = next(reader)
+            reader.limit_columns(1)
+            row = next(reader)
+            assert len(header) > 3 and len(row) == 3
+            assert "\t" in row[2]
+
+    def test_row_index(self):
+        """Look up assay rows by node through a sidecar row offset index.
+        """
+        work_dir = self._work_dir()
+        assay_file = os.path.join(work_dir, "a_C2C12expr.txt")
+        shutil.copy(os.path.join(self._dir, "minimal", "a_C2C12expr.txt"), assay_file)
+        s_parser = parser.StudyAssayParser(assay_file)
+        nodes = s_parser._parse_study("a_C2C12expr.txt", s_parser._assay_node_types)
+        index = isatab.RowIndex.open(assay_file)
+        assert os.path.exists(assay_file + ".rowidx")
+        node = index.node("rawdatafile-AFFY#35C.CEL")
+        assert node.metadata == nodes["rawdatafile-AFFY#35C.CEL"].metadata
+        assert index.find("AFFY#35C.CEL") == ["rawdatafile-AFFY#35C.CEL"]
+        assert sorted(index.find("C2C12 sample1 rep1")) == \
+               ["extract-C2C12 sample1 rep1", "sample-C2C12 sample1 rep1"]
+        assert index.fingerprint[2] is None
+        assert isatab.RowIndex.open(assay_file).names == index.names
+        assert isatab.RowIndex.open(assay_file, content_hash=True).fingerprint[2] is not None
+        assert len(index.rows("sample-C2C12 sample1 rep1")) == 1
+        assert index.row_dicts("sample-C2C12 sample1 rep1")[0]["Sample Name"] == \
+               ["C2C12 sample1 rep1"]
+
+        with open(assay_file) as in_handle:
+            last = in_handle.read().rstrip("\n").split("\n")[-1]
+        with open(assay_file, "a") as out_handle:
+            out_handle.write(last.replace(".CEL", "-new.CEL") + "\n")
+        index = isatab.RowIndex.open(assay_file)
+        assert "rawdatafile-AFFY#37A-new.CEL" in index
+        assert len(index.rows("sample-C2C12 sample3 rep1")) == 2
+
+        # sidecars holding anything but plain values are rebuilt, not loaded
+        with open(assay_file + ".rowidx", "wb") as out_handle:
+            pickle.dump((2, index.fingerprint, [], collections.OrderedDict(), {}), out_handle)
+        assert isatab.RowIndex.open(assay_file).names == index.names
+
+        cr_file = os.path.join(work_dir, "a_cr.txt")
+        with open(assay_file, "rb") as in_handle:
+            with open(cr_file, "wb") as out_handle:
+                out_handle.write(in_handle.read().replace(b"\r\n", b"\n").replace(b"\n", b"\r"))
+        cr_index = isatab.RowIndex.build(cr_file)
+        assert cr_index.names == index.names
+        assert cr_index.rows("sample-C2C12 sample3 rep1") == \
+               index.rows("sample-C2C12 sample3 rep1")
+
+    def test_batch_parsing(self):
+        """Parse a tree of investigations, reporting broken ones without stopping.
+        """
+        work_dir = self._work_dir("minimal")
+        os.makedirs(os.path.join(work_dir, "broken", "nested"))
+        with open(os.path.join(work_dir, "broken", "nested", "i_broken.txt"), "w") as out_handle:
+            out_handle.write("UNKNOWN SECTION\nInvestigation Identifier\tbroken\n")
+        assert [os.path.relpath(x, work_dir) for x in batch.find_investigations(work_dir)] == \
+               [os.path.join("broken", "nested", "i_broken.txt"),
+                os.path.join("minimal", "i_Investigation.txt")]
+        summary = batch.BatchSummary()
+        results = [summary.add(x) for x in batch.parse_all(work_dir,
+                                                          transform=batch.record_counts)]
+        assert [x.ok for x in results] == [False, True]
+        assert "KeyError" in results[0].error
+        assert results[1].record == {"studies": 1, "assays": 1}
+        assert results[1].bytes > 0
+        totals = summary.as_dict()
+        assert (totals["parsed"], totals["failed"]) == (1, 1)
+        assert totals["bytes"] == results[1].bytes
+
+        stdout = sys.stdout
+        sys.stdout = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+        try:
+            assert batch.main([work_dir]) == 1
+            lines = [json.loads(x) for x in sys.stdout.getvalue().splitlines()]
+        finally:
+            sys.stdout = stdout
+        assert [x["ok"] for x in lines[:-1]] == [False, True]
+        assert (lines[-1]["parsed"], lines[-1]["failed"]) == (1, 1)
+
+    @unittest.skipIf(sys.version_info < (3, 2), "process pools require concurrent.futures")
+    def test_batch_worker_failure(self):
+        """Report investigations whose work cannot be sent back from a worker.
+        """
+        refs = [os.path.join(self._dir, "minimal", "i_Investigation.txt")] * 2
+        results = list(batch.parse_all(refs, workers=2, transform=lambda rec: rec,
+                                       lazy=True))
+        assert [x.ok for x in results] == [False, False]
+        assert [x.ref for x in results] == refs
+        assert all(x.record is None for x in results)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio API requires Python 3.7")
+    def test_parse_async(self):
+        """Parse from a coroutine with limited concurrency, and cancel a parse.
+        """
+        import asyncio
+        from bcbio.isatab import aio
+        work_dir = os.path.join(self._dir, "minimal")
+        standard = isatab.parse(work_dir)
+        rec = asyncio.run(aio.parse_async(work_dir, limit=1))
+        assert rec.metadata == standard.metadata
+        assert len(rec.studies) == len(standard.studies)
+        for x, y in [(standard.studies[0], rec.studies[0]),
+                     (standard.studies[0].assays[0], rec.studies[0].assays[0])]:
+            assert sorted(x.nodes.keys()) == sorted(y.nodes.keys())
+            assert sorted(x.process_nodes.keys()) == sorted(y.process_nodes.keys())
+            for process_node in y.process_nodes.values():
+                assert process_node.study_assay is y
+        storage = isatab.NodeStorage()
+        threads = []
+        store_nodes = storage.store_nodes
+        def record_thread(*args):
+            threads.append(threading.current_thread())
+            return store_nodes(*args)
+        storage.store_nodes = record_thread
+        try:
+            stored = asyncio.run(aio.parse_async(work_dir, storage=storage))
+            assert threads and threading.main_thread() not in threads
+            study = stored.studies[0]
+            assert hasattr(study.nodes, "store_id")
+            assert sorted(study.nodes.keys()) == sorted(standard.studies[0].nodes.keys())
+        finally:
+            storage.close()
+
+        loop = asyncio.new_event_loop()
+        try:
+            task = loop.create_task(aio.parse_async(work_dir))
+            loop.call_soon(task.cancel)
+            self.assertRaises(asyncio.CancelledError, loop.run_until_complete, task)
+        finally:
+            loop.close()
+
+    def test_attribute_index(self):
+        """Select samples by attribute values and join them to assay data files.
+        """
+        base_file = os.path.join(self._dir, "minimal", "i_Investigation.txt")
+        rec = parser.StudyAssayParser(base_file, attribute_index=True).parse(self._minimal_rec())
+        study = rec.studies[0]
+        conditions = {"Characteristics[organism]": "Mus musculus (Mouse)",
+                      "Source Name": ["C2C12 sample1 rep1", "C2C12 sample3 rep2"]}
+        found = query.samples(study, conditions)
+        expected = set(k for k, n in study.nodes.items() if n.ntype == "Sample Name" and
+                       n.metadata["Characteristics[organism]"][0][0] == "Mus musculus (Mouse)" and
+                       n.metadata["Source Name"][0] in conditions["Source Name"])
+        assert found == expected and len(found) == 2
+        assert query.samples(study, {"Characteristics[organism]": "Homo sapiens"}) == set()
+        assert "C2C12" in study.attribute_index.distinct("Factor Value[cell line]")
+        (assay, files), _ = query.data_files(study, found)
+        assert assay is study.assays[0]
+        assert files == set(k for k, n in assay.nodes.items()
+                            if n.ntype in ("Raw Data File", "Derived Data File") and
+                            n.metadata["Sample Name"][0] in ["C2C12 sample1 rep1",
+                                                             "C2C12 sample3 rep2"])
+        assert "rawdatafile-AFFY#35A.CEL" in files and "rawdatafile-AFFY#37B.CEL" in files
+        index = pickle.loads(pickle.dumps(assay.attribute_index))
+        assert index.select({"Sample Name": "C2C12 sample1 rep1"}) == \
+               assay.attribute_index.select({"Sample Name": "C2C12 sample1 rep1"})
+
+    def test_serialize(self):
+        """Write parsed records as jsonl and binary and load them back.
+        """
+        base_file = os.path.join(self._dir, "minimal", "i_Investigation.txt")
+        rec = parser.StudyAssayParser(base_file).parse(self._minimal_rec())
+        for format in ["jsonl", "binary"]:
+            out_handle = io.BytesIO()
+            serialize.dump(rec, out_handle, format)
+            out_handle.seek(0)
+            loaded = serialize.load(out_handle, attribute_index=True, format=format)
+            assert loaded.studies[0].metadata == rec.studies[0].metadata
+            assay = loaded.studies[0].assays[0]
+            orig = rec.studies[0].assays[0]
+            assert sorted(assay.nodes.keys()) == sorted(orig.nodes.keys())
+            for node_index, node in orig.nodes.items():
+                assert assay.nodes[node_index].ntype == node.ntype
+                assert assay.nodes[node_index].metadata == node.metadata
+            attrs = assay.nodes["rawdatafile-AFFY#35A.CEL"].metadata["Protocol REF"][0]
+            assert attrs._fields == \
+                   orig.nodes["rawdatafile-AFFY#35A.CEL"].metadata["Protocol REF"][0]._fields
+            for node_index, process in orig.process_nodes.items():
+                assert assay.process_nodes[node_index].inputs == process.inputs
+                assert assay.process_nodes[node_index].outputs == process.outputs
+            for process in assay.process_nodes.values():
+                assert process.study_assay is assay
+            assert hasattr(assay, "attribute_index")
+            lists = [vals for node in assay.nodes.values() for vals in node.metadata.values()]
+            assert len(set(id(vals) for vals in lists)) == len(lists)
+        out_handle = io.BytesIO()
+        serialize.dump(rec, out_handle, "binary")
+        out_handle.seek(0)
+        loaded = serialize.load(out_handle, format="binary")
+        assert gc.isenabled()
+        out_handle.seek(0)
+        gc.disable()
+        try:
+            serialize.load(out_handle, format="binary")
+            assert not gc.isenabled()
+        finally:
+            gc.enable()
+        out_handle.seek(0)
+        assert sorted(serialize.load(out_handle, format="binary", pause_gc=False).studies[0].nodes) \
+               == sorted(rec.studies[0].nodes)
+        assert sorted(loaded.studies[0].nodes) == sorted(rec.studies[0].nodes)
+        out_handle.seek(0)
+        self.assertRaises(ValueError, serialize.load, out_handle)
+        unsafe = io.BytesIO(serialize._binary_magic +
+                            pickle.dumps(collections.OrderedDict(), 2))
+        self.assertRaises(pickle.UnpicklingError, serialize.load, unsafe, format="binary")
+        out_handle = io.BytesIO()
+        serialize.dump(rec, out_handle, "jsonl")
+        first = json.loads(out_handle.getvalue().split(b"\n")[0].decode("utf-8"))
+        assert first == {"t": "isatab", "version": serialize.FORMAT_VERSION}
+        self.assertRaises(ValueError, serialize.dump, rec, io.BytesIO(), "xml")
+
+    def test_watcher(self):
+        """Reload only changed assay files, replacing the record as a whole.
+        """
+        work_dir = self._work_dir("minimal")
+        data_dir = os.path.join(work_dir, "minimal")
+        events = []
+        watcher = watch.Watcher(data_dir, callback=events.append)
+        assert watcher.poll() is None
+        old = watcher.record
+        old_study = old.studies[0]
+        nnodes = len(old_study.assays[0].nodes)
+        assay_file = os.path.join(data_dir, "a_C2C12expr.txt")
+        with open(assay_file) as in_handle:
+            last = in_handle.readlines()[-1].rstrip("\r\n").split("\t")
+        with open(assay_file, "a") as out_handle:
+            out_handle.write("\t".join(x.replace(".CEL", "-new.CEL") for x in last) + "\n")
+        event = watcher.poll()
+        assert event.paths == [os.path.abspath(assay_file)] and not event.full
+        assert events == [event] and event.seconds >= 0
+        new_study = watcher.record.studies[0]
+        assert watcher.record is not old and new_study is not old_study
+        assert len(new_study.assays[0].nodes) == nnodes + 1
+        assert len(old_study.assays[0].nodes) == nnodes
+        assert new_study.nodes == old_study.nodes
+        assert new_study.nodes is not old_study.nodes
+        assert all(p.study_assay is new_study for p in new_study.process_nodes.values())
+        assert new_study._table_state is not old_study._table_state
+        for node_index, process in new_study.process_nodes.items():
+            old_process = old_study.process_nodes[node_index]
+            assert process.inputs == old_process.inputs
+            assert process.inputs is not old_process.inputs
+            assert process.outputs is not old_process.outputs
+        assert all(p.study_assay is new_study.assays[0]
+                   for p in new_study.assays[0].process_nodes.values())
+        assert watcher.poll() is None
+
+        # unchanged assays are copied as well, so updating one record
+        # leaves the other alone
+        old_assay = watcher.record.studies[0].assays[0]
+        study_file = os.path.join(data_dir, "s_SB-S-E1.txt")
+        with open(study_file) as in_handle:
+            study_row = in_handle.readlines()[-1].rstrip("\r\n").split("\t")
+        with open(study_file, "a") as out_handle:
+            out_handle.write("\t".join(x + " new" if x.startswith("C2C12") else x
+                                       for x in study_row) + "\n")
+        assert watcher.poll().paths == [os.path.abspath(study_file)]
+        new_assay = watcher.record.studies[0].assays[0]
+        assert new_assay is not old_assay
+        assert new_assay.nodes == old_assay.nodes
+        assert all(p.study_assay is new_assay for p in new_assay.process_nodes.values())
+        with open(assay_file, "a") as out_handle:
+            out_handle.write("\t".join(x.replace(".CEL", "-newer.CEL") for x in last) + "\n")
+        isatab.update(watcher.record, [assay_file])
+        assert len(new_assay.nodes) == nnodes + 2
+        assert len(old_assay.nodes) == nnodes + 1
+        assert not hasattr(new_assay._table_state, "builder")
+        outputs = lambda assay: set(x for p in assay.process_nodes.values() for x in p.outputs)
+        assert "rawdatafile-AFFY#37A-newer.CEL" in outputs(new_assay)
+        assert "rawdatafile-AFFY#37A-newer.CEL" not in outputs(old_assay)
+
+        # changes to the investigation file parse everything again
+        with open(os.path.join(data_dir, "i_Investigation.txt"), "a") as out_handle:
+            out_handle.write("\n")
+        assert watcher.poll().full
+        assert len(watcher.record.studies[0].assays[0].nodes) == nnodes + 2
+
+    def test_term_table(self):
+        """Replace ontology term attributes by ids shared across the investigation.
+        """
+        work_dir = os.path.join(self._dir, "minimal")
+        rec = isatab.parse(work_dir, terms=True, attribute_index=True)
+        table = rec.terms
+        study = rec.studies[0]
+        expect = parser.StudyAssayParser(os.path.join(work_dir, "i_Investigation.txt")).parse(
+            self._minimal_rec()).studies[0]
+        organism_ids = set()
+        for node_index, node in study.nodes.items():
+            for key, vals in node.metadata.items():
+                for val, orig in zip(vals, expect.nodes[node_index].metadata[key]):
+                    if terms.is_term_attrs(orig):
+                        assert table.term(val) == (orig.Term_Source_REF,
+                                                   orig.Term_Accession_Number, orig[0])
+                        if key == "Characteristics[organism]":
+                            organism_ids.add(val)
+                    else:
+                        assert val == orig
+        mouse = table.find(label="Mus musculus (Mouse)")
+        assert organism_ids == mouse and len(mouse) == 1
+        mouse_id = list(mouse)[0]
+        assert table.source(mouse_id)["Term Source Name"] == "NEWT"
+        assert len(table) == len(set(table.terms))
+        assert query.samples(study, {"Characteristics[organism]": "Mus musculus (Mouse)"}) == \
+               set(k for k, n in study.nodes.items()
+                   if n.ntype == "Sample Name" and
+                   n.metadata["Characteristics[organism]"] == [mouse_id])
+        loaded = pickle.loads(pickle.dumps(table))
+        assert loaded.terms == table.terms and loaded.find(label="Mus musculus (Mouse)") == mouse
+        out_handle = io.BytesIO()
+        serialize.dump(rec, out_handle)
+        out_handle.seek(0)
+        assert serialize.load(out_handle).terms.terms == table.terms
+        self.assertRaises(ValueError, isatab.parse, work_dir, lazy=True, terms=True)
+
+    def test_term_table_copies(self):
+        """Encode terms into new nodes, leaving shared nodes and blank terms alone.
+        """
+        work_dir = os.path.join(self._dir, "minimal")
+        study = isatab.parse(work_dir, compact=True).studies[0]
+        orig_nodes = dict(study.nodes)
+        table = terms.TermTable()
+        table.encode_nodes(study.nodes)
+        node = orig_nodes["sample-C2C12 sample1 rep1"]
+        assert terms.is_term_attrs(node.metadata["Characteristics[organism]"][0])
+        assert study.nodes["sample-C2C12 sample1 rep1"] is not node
+        assert isinstance(study.nodes["sample-C2C12 sample1 rep1"].metadata[
+            "Characteristics[organism]"][0], int)
+        blank = parser.StudyAssayParser(work_dir)._attrs_type(
+            ["Characteristics[strain]", "Term Source REF", "Term Accession Number"],
+            [0, 1, 2])("C57BL/6", "", "")
+        assert not terms.is_term_attrs(blank) and table.term_id(blank) is None
+
+        storage = isatab.NodeStorage(cache_bytes=1)
+        try:
+            rec = isatab.parse(work_dir, terms=True, storage=storage)
+            node = rec.studies[0].nodes["sample-C2C12 sample1 rep1"]
+            assert node.metadata["Characteristics[organism]"] == \
+                   list(rec.terms.find(label="Mus musculus (Mouse)"))
+        finally:
+            storage.close()
+
+    @unittest.skipIf(sys.version_info < (3, 7), "deferred imports require Python 3.7")
+    def test_deferred_import(self):
+        """Importing the package leaves the parser unloaded until first used.
+        """
+        # the bcbio namespace package is imported first: pkg_resources loads pprint
+        code = ("import sys, bcbio; before = set(sys.modules); import bcbio.isatab; "
+                "loaded = 'bcbio.isatab.parser' in sys.modules; "
+                "from bcbio.isatab import parse, ProcessGraph; "
+                "print(loaded, 'bcbio.isatab.parser' in sys.modules, "
+                "'pprint' in set(sys.modules) - before)")
+        env = dict(os.environ, PYTHONPATH=os.path.join(os.path.dirname(__file__), os.pardir))
+        out = subprocess.check_output([sys.executable, "-c", code], env=env)
+        assert out.decode("utf-8").split() == ["False", "True", "False"]
+        assert isatab.parse is parser.parse
+        self.assertRaises(AttributeError, getattr, isatab, "no_such_name")
+
+    def test_node_storage(self):
+        """Keep nodes and process nodes in an SQLite store with a small cache.
+        """
+        work_dir = os.path.join(self._dir, "minimal")
+        expect = isatab.parse(work_dir)
+        storage = isatab.NodeStorage(cache_bytes=2048, page_size=3)
+        rec = isatab.parse(work_dir, storage=storage)
+        for old, new in zip([expect.studies[0]] + expect.studies[0].assays,
+                            [rec.studies[0]] + rec.studies[0].assays):
+            assert sorted(new.nodes.keys()) == sorted(old.nodes.keys())
+            for node_index, node in new.nodes.items():
+                assert node.metadata == old.nodes[node_index].metadata
+            assert sorted(new.process_nodes) == sorted(old.process_nodes)
+            for process_node in new.process_nodes.values():
+                assert process_node.study_assay is new
+        study = rec.studies[0]
+        node_index = list(study.nodes)[0]
+        study.nodes[node_index].metadata["Comment[note]"] = ["kept"]
+        for _ in study.nodes.values():
+            pass
+        assert study.nodes[node_index].metadata["Comment[note]"] == ["kept"]
+        assert storage._cached_bytes <= 2048 or len(storage._cache) == 1
+        del study.nodes[node_index]
+        assert node_index not in study.nodes
+        assert len(study.nodes) == len(expect.studies[0].nodes) - 1
+        storage.close()
+        assert not os.path.exists(storage.path)
+
+        # stores in a database file given as path are reopened by store_id
+        work_dir = self._work_dir()
+        path = os.path.join(work_dir, "nodes.isanodes")
+        storage = isatab.NodeStorage(path)
+        rec = isatab.parse(os.path.join(self._dir, "minimal"), storage=storage)
+        study = rec.studies[0]
+        store_id, keys = study.nodes.store_id, list(study.nodes)
+        study.nodes[keys[0]].metadata["Comment[note]"] = ["kept"]
+        storage.close()
+        storage = isatab.NodeStorage(path)
+        assert store_id in storage.store_ids()
+        nodes = storage.open_store(store_id)
+        assert list(nodes) == keys
+        assert nodes[keys[0]].metadata["Comment[note]"] == ["kept"]
+        nodes["sample-new"] = parser.NodeRecord("new", "Sample Name")
+        assert list(nodes)[-1] == "sample-new"
+        assert storage.node_store().store_id > max(storage.store_ids())
+        self.assertRaises(KeyError, storage.open_store, max(storage.store_ids()) + 1)
+        storage.close()
+
     if __name__ == '__main__':
         unittest.main()
\ No newline at end of file